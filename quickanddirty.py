@@ -27,9 +27,14 @@ if __name__ == "__main__":
     # assume the only argument is a valid filename
     FILENAME = sys.argv[1]
 
-    # open input file for reading line by line
+    # open input file for reading line by line; iterating the file object doesn't read it into memory at once
     with open(FILENAME, 'r') as infile:
-        for line in infile.readlines():
+        for line in infile:
+            # strip the line break and skip blank lines and comments
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
             sys.stdout.write("Loading %s ... " % line)
             # request the url via GET
             r = requests.get(line, stream=True)
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the downloader end to end against a local stand-in server.
+
+File: runbenchmark.py.
+
+The server serves synthetic images of the configured sizes after the configured latency, so the benchmark is
+repeatable offline. Every configuration runs download_images in a fresh subprocess, which keeps the peak RSS of the
+configurations apart and the server's cpu time out of the measurements.
+
+Examples:
+    python runbenchmark.py --workers 1,4,16 --sizes 16,256,2048 --latency 20
+    python runbenchmark.py --save metrics/benchmark.json
+    python runbenchmark.py --compare metrics/benchmark.json
+
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import os
+import re
+import resource
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import simpleandsolid
+
+
+class SyntheticImageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve /img/<size in KB>/<number>.jpg with a body of that size after the server's latency.
+    """
+    protocol_version = 'HTTP/1.1'
+    bodies = {}
+
+    def do_GET(self):
+        match = re.match(r'^/img/(\d+)/\d+\.jpg$', self.path)
+        if not match:
+            self.send_error(404)
+            return
+
+        size = int(match.group(1)) * 1024
+        if size not in self.bodies:
+            self.bodies[size] = os.urandom(size)
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        self.wfile.write(self.bodies[size])
+
+    def log_message(self, *args):
+        pass
+
+
+class SyntheticImageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def start_server(latency):
+    """
+    Start the stand-in server on a free port in a background thread.
+
+    :param latency: seconds to wait before answering a request
+    :return: the server
+    """
+    server = SyntheticImageServer(('127.0.0.1', 0), SyntheticImageHandler)
+    server.latency = latency
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run_child(params):
+    """
+    Download all urls of one configuration and measure it.
+
+    :param params: dictionary with urls, engine, workers and processes
+    :return: dictionary of results
+    """
+    workdir = tempfile.mkdtemp(prefix='benchmark')
+    try:
+        # the defaults of the downloader, without a configuration file
+        config = simpleandsolid.merge_configuration(
+            simpleandsolid.create_parser().parse_args([]),
+            dict.fromkeys(['input_file', 'output_dir', 'verbosity', 'log_level', 'log_file', 'config_file'])
+        )
+        config.update({
+            'input_file': os.path.join(workdir, 'urls.txt'),
+            'output_dir': workdir,
+            'engine': params['engine'],
+            'workers': params['workers'],
+            'processes': params['processes'],
+            # everything comes from a single host per process, so it must not be the limit
+            'host_connections': params['workers'],
+            'pool_size': params['workers']
+        })
+        with open(config['input_file'], 'w') as outfile:
+            outfile.write('\n'.join(params['urls']) + '\n')
+
+        logger = logging.getLogger('simpleandsolid.benchmark')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+
+        run = simpleandsolid.create_run(config)
+        started = time.time()
+        simpleandsolid.download_images(config, logger, run=run)
+        seconds = time.time() - started
+        stats = run['stats']
+        results = {
+            'seconds': seconds,
+            'downloaded': stats.get('downloaded'),
+            'failed': stats.get('failed'),
+            'bytes': sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir)
+                         if name != 'urls.txt'),
+            'p50': stats.percentile('latency', 0.5),
+            'p99': stats.percentile('latency', 0.99),
+            # kilobytes on Linux; the largest of the download processes with --processes
+            'max_rss': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                           resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        }
+        simpleandsolid.finish_run(run, logger)
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+
+def measure(urls, engine, workers, processes):
+    """
+    Run one configuration in a subprocess.
+
+    :param urls: list of urls to download
+    :param engine: name of the download engine
+    :param workers: number of concurrent downloads
+    :param processes: number of download processes
+    :return: dictionary of results
+    """
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = child.communicate(json.dumps({'urls': urls, 'engine': engine, 'workers': workers,
+                                           'processes': processes}))[0]
+    if child.returncode:
+        raise RuntimeError('Benchmark of %s with %d workers failed' % (engine, workers))
+    return json.loads(output)
+
+
+def create_parser():
+    """
+    Create the argument parser.
+
+    :return: argparse.ArgumentParser
+    """
+    def int_list(value):
+        return [int(item) for item in value.split(',')]
+
+    parser = argparse.ArgumentParser(description='Benchmark simpleandsolid against a local stand-in server')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--urls', type=int, default=200, help='Number of urls per run, default: 200')
+    parser.add_argument('--sizes', type=int_list, default=[16, 256, 2048],
+                        help='Comma separated image sizes in KB, used in turn, default: 16,256,2048')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='Milliseconds the server waits before answering, default: 20')
+    parser.add_argument('--workers', type=int_list, default=[1, 4, 16],
+                        help='Comma separated worker counts, default: 1,4,16')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Download processes, the urls are spread over as many hosts, default: 1')
+    parser.add_argument('--engines', default=','.join(simpleandsolid.ENGINES),
+                        help='Comma separated download engines, default: all')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per configuration, the best counts, default: 3')
+    parser.add_argument('--save', help='Write the results to this json file')
+    parser.add_argument('--compare', help='Compare with the results in this json file, exit 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed loss of urls/s against --compare as a fraction, default: 0.1')
+    return parser
+
+
+def format_results(key, results):
+    """
+    Format the results of a configuration as a table row.
+
+    :param key: engine/workers
+    :param results: dictionary of results
+    :return: string
+    """
+    return '%-16s %8.1f %8.1f %8.1f %8.1f %8.1f %6d' % (
+        key,
+        results['downloaded'] / results['seconds'],
+        results['bytes'] / results['seconds'] / 1048576,
+        (results['p50'] or 0) * 1000,
+        (results['p99'] or 0) * 1000,
+        results['max_rss'] / 1024.0,
+        results['failed']
+    )
+
+
+def main():
+    """
+    Run all configurations and print a table of the results.
+
+    Main function
+    """
+    args = create_parser().parse_args()
+    if args.child:
+        sys.stdout.write(json.dumps(run_child(json.load(sys.stdin))))
+        return
+
+    # the processes shard the urls by host, so start a server for every shard
+    servers = {}
+    while len(servers) < args.processes:
+        server = start_server(args.latency / 1000.0)
+        shard = simpleandsolid.shard_of('http://127.0.0.1:%d/' % server.server_address[1], args.processes)
+        if shard in servers:
+            server.shutdown()
+            server.server_close()
+        else:
+            servers[shard] = server
+    base_urls = ['http://127.0.0.1:%d' % server.server_address[1] for server in servers.values()]
+    urls = ['%s/img/%d/%d.jpg' % (base_urls[number % len(base_urls)], args.sizes[number % len(args.sizes)], number)
+            for number in range(args.urls)]
+
+    print('%-16s %8s %8s %8s %8s %8s %6s' % ('engine/workers', 'urls/s', 'MB/s', 'p50 ms', 'p99 ms', 'RSS MB',
+                                              'failed'))
+    measured = {}
+    for engine in args.engines.split(','):
+        for workers in args.workers:
+            key = '%s/%d' % (engine, workers) + ('x%d' % args.processes if args.processes > 1 else '')
+            runs = [measure(urls, engine, workers, args.processes) for _ in range(args.repeat)]
+            measured[key] = min(runs, key=lambda results: results['seconds'])
+            print(format_results(key, measured[key]))
+    for server in servers.values():
+        server.shutdown()
+
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump(measured, outfile, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)
+        regressions = []
+        for key in sorted(set(baseline) & set(measured)):
+            before = baseline[key]['downloaded'] / baseline[key]['seconds']
+            after = measured[key]['downloaded'] / measured[key]['seconds']
+            if after < before * (1 - args.tolerance):
+                regressions.append('%s: %.1f urls/s, was %.1f' % (key, after, before))
+        if regressions:
+            sys.stderr.write('Throughput regressions:\n%s\n' % '\n'.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,19 +9,135 @@ Blue Yonder Coding Task - Image downloader - 3. Simple and solid solution.
 Usage: quickanddirty.py <path to input file>
 """
 # standard library modules
+import time
+# start of the imports for the --timing report
+IMPORT_STARTED = time.time()
+
 import argparse
+import array
+import atexit
+import bisect
+import asyncore
+import collections
+import ctypes
+import ctypes.util
+import email.utils
 import logging
+import math
 import os
+import random
+import select
+import signal
+import socket
+import sqlite3
+import ssl
+import struct
 import sys
 import tempfile
 import errno
-from urlparse import urlparse
-from pprint import pprint
+import fcntl
+import hashlib
+import itertools
+import heapq
+import re
+import shutil
+import threading
+import zlib
+from urllib import quote
+from urlparse import urlparse, urljoin, urlsplit, urlunsplit
 
-# 3rd party modules
+# 3rd party modules; magic, yaml and concurrent.futures are imported where they are needed, requests and urllib3 are
+# needed here for the connection classes
 import requests
-import magic
-import yaml
+import urllib3
+
+IMPORT_FINISHED = time.time()
+
+# number of bytes at the start of the input file or of a download that libmagic looks at to tell its type
+MAGIC_SNIFF_SIZE = 8192
+
+# storage modes: 'plain' writes every download to its own file, 'hardlink' and 'symlink' store identical content
+# only once in the blob directory and link the generated filename to it
+STORAGE_MODES = ['plain', 'hardlink', 'symlink']
+
+# output layouts: 'flat' puts every file directly into the output directory, 'hashed' fans the files out over two
+# levels of subdirectories named after the hash of the url and adds it to the filename, so no two urls share a file
+LAYOUTS = ['flat', 'hashed']
+
+# policies to order the urls by after probing their size: 'shortest' first, hosts of a higher 'priority' first, or
+# 'fair', taking turns between the hosts; the shortest first within each of them
+PLAN_POLICIES = ['shortest', 'priority', 'fair']
+
+# query parameters which only track the visitor and don't change the image; names ending with '_' are prefixes
+TRACKING_PARAMS = ['utm_', 'fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid', 'igshid', '_ga', '_hsenc']
+
+# ports urls are canonicalized without
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# names of the subdirectories of the hashed layout
+FANOUT_NAME = re.compile(r'^[0-9a-f]{2}$')
+
+# array type code of the hashes in the index of the output directory; python 2 arrays have no 'q', but a C long has
+# 64 bits on 64-bit Linux
+INDEX_TYPECODE = 'l'
+
+# available download engines: 'requests' uses blocking requests calls, optionally in a thread pool; 'asyncore' runs
+# all downloads on non-blocking sockets in a single thread
+ENGINES = ['requests', 'asyncore']
+
+# fsync policies: 'none' leaves writing back to the operating system, 'file' syncs every download before it is moved
+# into place, 'full' also syncs the directory after the rename so the new name survives a crash
+FSYNC_POLICIES = ['none', 'file', 'full']
+
+# bounds for the adaptive chunk size of write_file; bigger chunks mean less python code per byte, but more memory
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# timing histograms have logarithmic buckets, each 10% wider than the one before, starting at 100 microseconds; that
+# keeps percentiles within 10% with a few dozen counters instead of a list of all values
+HISTOGRAM_BASE = 0.0001
+HISTOGRAM_GROWTH = 1.1
+
+# bucket bounds in seconds of the histograms in the Prometheus metrics file
+PROMETHEUS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# HTTP status codes a server asks the client to slow down with
+THROTTLE_CODES = (429, 503)
+
+# longest pause in seconds for a host which asks to slow down, whatever its Retry-After says, and the longest wait
+# before retrying an url
+MAX_BACKOFF = 300
+
+# why the urls not started by the deadline, or whose host is paused past it, are left to the next run
+OVERDUE = 'it can\'t be started before the deadline'
+
+# seconds without any network activity before a download is given up
+IDLE_TIMEOUT = 60
+
+# seconds to wait for a connection to be established; a host which is up accepts it long before
+CONNECT_TIMEOUT = 5
+
+# seconds to wait before looking again when all hosts with queued urls are busy
+BUSY_POLL = 0.05
+
+# number of failed connections to a host in a row after which its urls aren't retried anymore
+UNREACHABLE_AFTER = 3
+
+# number of least recently used files looked at at once when the output directory is over its quota
+EVICTION_BATCH = 100
+
+# points per node on the hash ring of the fleet; more points spread the urls more evenly over the nodes
+RING_REPLICAS = 100
+
+# HTTP status codes and exceptions of failures which may go away when the url is retried later
+TRANSIENT_CODES = (408, 429, 500, 502, 503, 504)
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# inotify flags from <sys/inotify.h>: report files written and closed or moved into the watched directory
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
 
 
 def create_parser(parserclass=argparse.ArgumentParser):
@@ -91,6 +207,235 @@ def create_parser(parserclass=argparse.ArgumentParser):
         type=lambda s: s.strip()
     )
 
+    # concurrency settings, a single worker keeps the plain serial download loop
+    parser.add_argument(
+        '--workers',
+        help='Number of downloads running in parallel',
+        type=int
+    )
+    parser.add_argument(
+        '--host_connections',
+        help='Maximum number of parallel connections to a single host',
+        type=int
+    )
+    parser.add_argument(
+        '--queue_size',
+        help='Maximum number of urls read ahead of the running downloads',
+        type=int
+    )
+    parser.add_argument(
+        '--processes',
+        help='Number of processes, each downloading the urls of its share of the hosts, default: 1',
+        type=int
+    )
+    # fleet settings, all nodes need the same list of peers
+    parser.add_argument(
+        '--peers',
+        help='Comma separated base urls the nodes of the fleet serve their output directories at, this one included',
+        type=lambda s: [peer.strip() for peer in s.split(',') if peer.strip()]
+    )
+    parser.add_argument(
+        '--node',
+        help='Base url of this node in the list of peers',
+        type=lambda s: s.strip()
+    )
+    parser.add_argument(
+        '--plan',
+        help='Probe the size of the urls with HEAD requests and order them: [shortest, priority, fair]; with a '
+             'deadline the urls which would not fit in anymore are deferred to the rejected file',
+        choices=PLAN_POLICIES,
+        type=lambda s: s.strip().lower()
+    )
+    parser.add_argument(
+        '--plan_size',
+        help='Number of urls probed and ordered at once, default: 1000',
+        type=int
+    )
+    parser.add_argument(
+        '--probe_workers',
+        help='Number of HEAD requests probing the sizes for the plan in parallel, default: 8',
+        type=int
+    )
+    parser.add_argument(
+        '--state_file',
+        help='SQLite file to keep download state like cache validators in across runs',
+        type=lambda s: s.strip()
+    )
+    parser.add_argument(
+        '--recheck_after',
+        help='Seconds after which an url downloaded before is requested again; needs a state file',
+        type=int
+    )
+    parser.add_argument(
+        '--incremental',
+        help='Only read the lines appended to the input file since the last run, needs a state file',
+        action='store_true',
+        default=None
+    )
+    parser.add_argument(
+        '--lock_file',
+        help='Exit with status 75 if another run holds this lock file',
+        type=lambda s: s.strip()
+    )
+    parser.add_argument(
+        '--deadline',
+        help='Seconds after which a run stops starting downloads and finishes the running ones; the urls read but not '
+             'started are deferred to the rejected file',
+        type=float
+    )
+    parser.add_argument(
+        '--quota_bytes',
+        help='Evict the least recently used downloads beyond this many bytes after a run, needs a state file',
+        type=int
+    )
+    parser.add_argument(
+        '--quota_files',
+        help='Evict the least recently used downloads beyond this many files after a run, needs a state file',
+        type=int
+    )
+    parser.add_argument(
+        '--list_failures',
+        help='List the urls whose last download failed from the state file and exit',
+        action='store_true',
+        default=None
+    )
+    parser.add_argument(
+        '--storage',
+        help='Storage mode: [plain, hardlink, symlink]; link modes keep identical images only once',
+        choices=STORAGE_MODES,
+        type=lambda s: s.strip().lower()
+    )
+    parser.add_argument(
+        '--dedup',
+        help='Canonicalize the urls and download each of an input file only once',
+        action='store_true',
+        default=None
+    )
+    parser.add_argument(
+        '--dedup_exact',
+        help='Number of urls remembered exactly before switching to a Bloom filter, default: 100000',
+        type=int
+    )
+    parser.add_argument(
+        '--dedup_bloom_bytes',
+        help='Size of the Bloom filter; 10 bits per url keep false duplicates around 1%%, default: 16777216',
+        type=int
+    )
+    parser.add_argument(
+        '--no_clobber',
+        help='Skip the urls whose file exists in the output directory, without asking the server',
+        action='store_true',
+        default=None
+    )
+    parser.add_argument(
+        '--snapshot_file',
+        help='Keep the index of the output directory for --no_clobber in this file between runs',
+        type=lambda s: s.strip()
+    )
+    parser.add_argument(
+        '--layout',
+        help='Output layout: [flat, hashed]; hashed spreads the files over subdirectories, default: flat',
+        choices=LAYOUTS,
+        type=lambda s: s.strip().lower()
+    )
+    parser.add_argument(
+        '--migrate_layout',
+        help='Move the downloads recorded in the state file to the configured layout and exit',
+        action='store_true',
+        default=None
+    )
+    # content checks, the body of an unwanted download is never transferred in full
+    parser.add_argument(
+        '--mime_types',
+        help='Comma separated MIME types a download has to be of by its first bytes, e.g. image/jpeg,image/png',
+        type=lambda s: [mime_type.strip() for mime_type in s.split(',') if mime_type.strip()]
+    )
+    parser.add_argument(
+        '--max_size',
+        help='Abort downloads larger than this many bytes, 0 = unlimited, default: 0',
+        type=int
+    )
+    parser.add_argument(
+        '--blob_dir',
+        help='Directory for the deduplicated image content, default: .blobs in the output directory',
+        type=lambda s: s.strip()
+    )
+    parser.add_argument(
+        '--engine',
+        help='Download engine: [requests, asyncore]',
+        choices=ENGINES,
+        type=lambda s: s.strip().lower()
+    )
+    parser.add_argument(
+        '--chunk_size',
+        help='Bytes read per write, 0 = adapt to the size of the image, default: 0',
+        type=int
+    )
+    parser.add_argument(
+        '--fsync',
+        help='Sync downloads to disk: [none, file, full], default: none',
+        choices=FSYNC_POLICIES,
+        type=lambda s: s.strip().lower()
+    )
+    parser.add_argument(
+        '--host_rate',
+        help='Requests per second per host, 0 = unlimited, default: 0',
+        type=float
+    )
+    parser.add_argument(
+        '--host_burst',
+        help='Requests a host may get at once after a pause, default: 1',
+        type=int
+    )
+    parser.add_argument(
+        '--retries',
+        help='Times a failed url is retried on timeouts, connection errors and 5xx responses, default: 3',
+        type=int
+    )
+    parser.add_argument(
+        '--retry_delay',
+        help='Seconds to wait before the first retry, doubled for every further one, default: 1',
+        type=float
+    )
+    parser.add_argument(
+        '--rejected_file',
+        help='Append the urls given up on to this file: url, status, attempts and reason separated by tabs',
+        type=lambda s: s.strip()
+    )
+    parser.add_argument(
+        '--skip_rejected',
+        help='Skip the urls listed in the rejected file by earlier runs',
+        action='store_true',
+        default=None
+    )
+    parser.add_argument(
+        '--timing',
+        help='Report the duration of the startup phases on stderr',
+        action='store_true',
+        default=None
+    )
+    parser.add_argument(
+        '--daemon',
+        help='Keep running and download the urls of every file put into the inbox directory',
+        action='store_true',
+        default=None
+    )
+    parser.add_argument(
+        '--inbox_dir',
+        help='Directory the daemon watches for input files, default: inbox',
+        type=lambda s: s.strip()
+    )
+    parser.add_argument(
+        '--poll_interval',
+        help='Seconds between looking for new input files where inotify is not available, default: 2',
+        type=int
+    )
+    parser.add_argument(
+        '--metrics_file',
+        help='Write the metrics of each run to this Prometheus textfile, e.g. for the node exporter',
+        type=lambda s: s.strip()
+    )
+
     return parser
 
 
@@ -130,6 +475,42 @@ def setup_logging(config):
     return logger
 
 
+_magic_lock = threading.Lock()
+_magic_handle = None
+
+
+def sniff_mime_type(path):
+    """
+    Tell the MIME type of a file by its first MAGIC_SNIFF_SIZE bytes.
+
+    :param path: path of the file
+    :return: MIME type, e.g. 'text/plain'
+    """
+    with open(path, 'rb') as infile:
+        return sniff_buffer(infile.read(MAGIC_SNIFF_SIZE))
+
+
+def sniff_buffer(data):
+    """
+    Tell the MIME type of some bytes, e.g. the start of a download.
+
+    libmagic is only loaded when it is needed the first time, then its handle is reused. The handle isn't thread
+    safe, so it is guarded by a lock.
+
+    :param data: bytes, only the first MAGIC_SNIFF_SIZE are looked at
+    :return: MIME type, e.g. 'text/plain'
+    """
+    data = data[:MAGIC_SNIFF_SIZE]
+    global _magic_handle
+    with _magic_lock:
+        if _magic_handle is None:
+            import magic
+            _magic_handle = magic.Magic(flags=magic.MAGIC_MIME_TYPE)
+            # close it before the interpreter shuts down, filemagic warns about handles cleaned up implicitly
+            atexit.register(_magic_handle.close)
+        return _magic_handle.id_buffer(data)
+
+
 def verify_file(filename, permission, mime_type):
     """
     Check if input/output file is a valid path and is suitable for reading/writing.
@@ -159,40 +540,41 @@ def verify_file(filename, permission, mime_type):
     path = os.path.abspath(filename)
     result = (0, 'File is fine')
 
-    with magic.Magic(flags=magic.MAGIC_MIME_TYPE) as wizzard:
-        # File is to be opened for reading and therefore has to exist
-        if permission == os.R_OK and not os.path.exists(path):
-            result = (66, 'Not a valid path: %s\n' % filename)
-        # File is to be opened for reading and therefore has be a valid file
-        elif permission == os.R_OK and not os.path.isfile(path):
-            result = (66, 'Not a valid file: %s\n' % filename)
-        # check file permission for reading
-        elif permission == os.R_OK and not os.access(path, permission):
-            result = (77, 'No permission to read file: %s\n' % filename)
-        # check the file type for files opened for reading
-        elif permission == os.R_OK and not wizzard.id_filename(path) == mime_type:
-            result = (74, 'Wrong file type "%s": %s\n' % (wizzard.id_filename(path), filename))
-        # when writing a file the target directory has to exist
-        elif permission == os.W_OK and not os.path.exists(os.path.dirname(path)):
-            result = (73, 'Not a valid path for output: %s\n' % (os.path.dirname(filename)))
-        # when writing a file the path has to resolve to a directory
-        elif permission == os.W_OK and not os.path.isdir(os.path.dirname(path)):
-            result = (73, 'Not a directory: %s\n' % (os.path.dirname(filename)))
-        # when writing a file the directory has to be writeable
-        elif permission == os.W_OK and os.path.isdir(os.path.dirname(path)):
-            # work around wonky behaviour of os.access()
-            try:
-                testfile = tempfile.TemporaryFile(dir=os.path.dirname(path))
-                testfile.close()
-            except OSError as err:
-                # catch access error
-                if err.errno == errno.EACCES:
-                    return 77, 'No permission to write to directory: %s\n' % (os.path.dirname(filename))
-                # all other errors reraise exception for unexpected error
-                err.filename = os.path.dirname(filename)
-                raise
+    # File is to be opened for reading and therefore has to exist
+    if permission == os.R_OK and not os.path.exists(path):
+        result = (66, 'Not a valid path: %s\n' % filename)
+    # File is to be opened for reading and therefore has be a valid file
+    elif permission == os.R_OK and not os.path.isfile(path):
+        result = (66, 'Not a valid file: %s\n' % filename)
+    # check file permission for reading
+    elif permission == os.R_OK and not os.access(path, permission):
+        result = (77, 'No permission to read file: %s\n' % filename)
+    # check the file type for files opened for reading
+    elif permission == os.R_OK:
+        found = sniff_mime_type(path)
+        if found != mime_type:
+            result = (74, 'Wrong file type "%s": %s\n' % (found, filename))
+    # when writing a file the target directory has to exist
+    elif permission == os.W_OK and not os.path.exists(os.path.dirname(path)):
+        result = (73, 'Not a valid path for output: %s\n' % (os.path.dirname(filename)))
+    # when writing a file the path has to resolve to a directory
+    elif permission == os.W_OK and not os.path.isdir(os.path.dirname(path)):
+        result = (73, 'Not a directory: %s\n' % (os.path.dirname(filename)))
+    # when writing a file the directory has to be writeable
+    elif permission == os.W_OK and os.path.isdir(os.path.dirname(path)):
+        # work around wonky behaviour of os.access()
+        try:
+            testfile = tempfile.TemporaryFile(dir=os.path.dirname(path))
+            testfile.close()
+        except OSError as err:
+            # catch access error
+            if err.errno == errno.EACCES:
+                return 77, 'No permission to write to directory: %s\n' % (os.path.dirname(filename))
+            # all other errors reraise exception for unexpected error
+            err.filename = os.path.dirname(filename)
+            raise
 
-        return result
+    return result
 
 
 def verify_configuration(config, exitfunc=sys.exit):
@@ -207,8 +589,12 @@ def verify_configuration(config, exitfunc=sys.exit):
     :param exitfunc: make the sys.exit call overwriteable for unittesting
     :return:
     """
-    # check for valid input file or abort
-    status = verify_file(config['input_file'], os.R_OK, 'text/plain')
+    # check for valid input file or abort; the daemon takes its input files from the inbox directory instead
+    if config.get('daemon'):
+        # a file to be written in it, so the inbox directory itself has to exist
+        status = verify_file(os.path.join(config['inbox_dir'], '.probe'), os.W_OK, '')
+    else:
+        status = verify_file(config['input_file'], os.R_OK, 'text/plain')
     if status[0] != 0:
         sys.stderr.write(status[1])
         exitfunc(status[0])
@@ -225,6 +611,20 @@ def verify_configuration(config, exitfunc=sys.exit):
         sys.stderr.write(status[1])
         exitfunc(status[0])
 
+    # check for a valid directory to keep the state database in
+    if config.get('state_file') is not None:
+        status = verify_file(config['state_file'], os.W_OK, '')
+        if status[0] != 0:
+            sys.stderr.write(status[1])
+            exitfunc(status[0])
+    elif config.get('list_failures'):
+        sys.stderr.write('Error: Listing failures needs a state file\n')
+        exitfunc(78)
+
+    if config.get('recheck_after', 0) < 0:
+        sys.stderr.write('Error: Invalid value for recheck_after: %s\n' % config['recheck_after'])
+        exitfunc(78)
+
     # skip checking config file that is already handled
 
     if config['verbosity'] not in [logging.FATAL, logging.DEBUG, logging.INFO, logging.WARN, logging.ERROR]:
@@ -235,6 +635,126 @@ def verify_configuration(config, exitfunc=sys.exit):
         sys.stderr.write('Error: Invalid log level')
         exitfunc(status[0])
 
+    # settings which have to be a positive number; 78 = EX_CONFIG
+    for key in ['workers', 'host_connections', 'pool_size', 'queue_size', 'cache_size', 'poll_interval', 'host_burst',
+                'processes', 'plan_size', 'probe_workers', 'dedup_exact', 'dedup_bloom_bytes']:
+        if key in config and (not isinstance(config[key], int) or config[key] < 1):
+            sys.stderr.write('Error: Invalid value for %s: %s\n' % (key, config[key]))
+            exitfunc(78)
+
+    if 'engine' in config and config['engine'] not in ENGINES:
+        sys.stderr.write('Error: Invalid engine: %s\n' % config['engine'])
+        exitfunc(78)
+
+    if 'storage' in config and config['storage'] not in STORAGE_MODES:
+        sys.stderr.write('Error: Invalid storage mode: %s\n' % config['storage'])
+        exitfunc(78)
+
+    # hard links can't cross filesystems, the blob directory has to be on the one of the output directory; it may
+    # not exist yet, then the directory it will be created in counts
+    if config.get('storage') == 'hardlink' and config.get('blob_dir') and os.path.isdir(config['output_dir']):
+        blob_dir = os.path.abspath(config['blob_dir'])
+        while not os.path.exists(blob_dir):
+            blob_dir = os.path.dirname(blob_dir)
+        if os.stat(blob_dir).st_dev != os.stat(config['output_dir']).st_dev:
+            sys.stderr.write('Error: Hardlink storage needs the blob directory on the filesystem of the output '
+                             'directory: %s\n' % config['blob_dir'])
+            exitfunc(78)
+
+    if not isinstance(config.get('tracking_params', []), list) or \
+            not all(isinstance(name, basestring) for name in config.get('tracking_params', [])):
+        sys.stderr.write('Error: Invalid tracking parameters: %s\n' % config['tracking_params'])
+        exitfunc(78)
+
+    if config.get('plan') is not None and config['plan'] not in PLAN_POLICIES:
+        sys.stderr.write('Error: Invalid plan policy: %s\n' % config['plan'])
+        exitfunc(78)
+    # priorities from the config file look like {'images.pexels.com': 10}, hosts not listed have 0
+    if not isinstance(config.get('priorities', {}), dict) or \
+            not all(isinstance(value, (int, float)) for value in config.get('priorities', {}).values()):
+        sys.stderr.write('Error: Invalid priorities: %s\n' % config['priorities'])
+        exitfunc(78)
+
+    # writing the snapshot into the output directory would change its modification time and outdate the snapshot
+    if config.get('snapshot_file') and \
+            os.path.dirname(os.path.abspath(config['snapshot_file'])) == os.path.abspath(config.get('output_dir', '.')):
+        sys.stderr.write('Error: The snapshot file can\'t be in the output directory: %s\n' % config['snapshot_file'])
+        exitfunc(78)
+
+    if 'layout' in config and config['layout'] not in LAYOUTS:
+        sys.stderr.write('Error: Invalid layout: %s\n' % config['layout'])
+        exitfunc(78)
+
+    # only the state file knows the url of an existing file
+    if config.get('migrate_layout') and not config.get('state_file'):
+        sys.stderr.write('Error: Migrating the layout needs a state file\n')
+        exitfunc(78)
+
+    if 'chunk_size' in config and (not isinstance(config['chunk_size'], int) or config['chunk_size'] < 0):
+        sys.stderr.write('Error: Invalid value for chunk_size: %s\n' % config['chunk_size'])
+        exitfunc(78)
+
+    if 'max_size' in config and (not isinstance(config['max_size'], int) or config['max_size'] < 0):
+        sys.stderr.write('Error: Invalid value for max_size: %s\n' % config['max_size'])
+        exitfunc(78)
+    mime_types = config.get('mime_types', [])
+    if not isinstance(mime_types, list) or \
+            not all(isinstance(mime_type, basestring) and '/' in mime_type for mime_type in mime_types):
+        sys.stderr.write('Error: Invalid MIME types: %s\n' % config['mime_types'])
+        exitfunc(78)
+
+    if 'fsync' in config and config['fsync'] not in FSYNC_POLICIES:
+        sys.stderr.write('Error: Invalid fsync policy: %s\n' % config['fsync'])
+        exitfunc(78)
+
+    # per host limits from the config file look like {'images.pexels.com': {'rate': 2, 'burst': 5}}
+    limits = [{'rate': config.get('host_rate', 0), 'burst': config.get('host_burst', 1)}]
+    if not isinstance(config.get('host_limits', {}), dict):
+        sys.stderr.write('Error: Invalid host limits: %s\n' % config['host_limits'])
+        exitfunc(78)
+    else:
+        limits.extend(config.get('host_limits', {}).values())
+    for limit in limits:
+        if not isinstance(limit, dict) or not isinstance(limit.get('rate', 0), (int, float)) or \
+                limit.get('rate', 0) < 0 or not isinstance(limit.get('burst', 1), int) or limit.get('burst', 1) < 1:
+            sys.stderr.write('Error: Invalid host limit: %s\n' % limit)
+            exitfunc(78)
+
+    if 'retries' in config and (not isinstance(config['retries'], int) or config['retries'] < 0):
+        sys.stderr.write('Error: Invalid value for retries: %s\n' % config['retries'])
+        exitfunc(78)
+    if 'retry_delay' in config and (not isinstance(config['retry_delay'], (int, float)) or config['retry_delay'] < 0):
+        sys.stderr.write('Error: Invalid value for retry_delay: %s\n' % config['retry_delay'])
+        exitfunc(78)
+
+    if config.get('deadline') is not None and \
+            (not isinstance(config['deadline'], (int, float)) or config['deadline'] <= 0):
+        sys.stderr.write('Error: Invalid value for deadline: %s\n' % config['deadline'])
+        exitfunc(78)
+
+    for key in ['quota_bytes', 'quota_files']:
+        if key in config and (not isinstance(config[key], (int, long)) or config[key] < 0):
+            sys.stderr.write('Error: Invalid value for %s: %s\n' % (key, config[key]))
+            exitfunc(78)
+    # the index of the downloaded files is kept in the state file
+    if (config.get('quota_bytes') or config.get('quota_files')) and not config.get('state_file'):
+        sys.stderr.write('Error: A quota for the output directory needs a state file\n')
+        exitfunc(78)
+
+    # the checkpoint of the input file is kept in the state file
+    if config.get('incremental') and not config.get('state_file'):
+        sys.stderr.write('Error: Reading the input incrementally needs a state file\n')
+        exitfunc(78)
+    # the checkpoint moves past the urls a deadline or a plan defers, only the rejected file takes them to the next run
+    if config.get('incremental') and (config.get('deadline') or config.get('plan')) and not config.get('rejected_file'):
+        sys.stderr.write('Error: Deferring urls in incremental runs needs a rejected file\n')
+        exitfunc(78)
+
+    # in a fleet every node has to know which of the peers it is
+    if config.get('peers') and config.get('node') not in config['peers']:
+        sys.stderr.write('Error: Node %s is not one of the peers: %s\n' % (config.get('node'), config['peers']))
+        exitfunc(78)
+
 
 def merge_configuration(args, config):
     """
@@ -253,7 +773,55 @@ def merge_configuration(args, config):
         'verbosity': logging.WARN,
         'log_level': logging.WARN,
         'log_file': 'logs/general.simpleandsolid.log',
-        'config_file': 'config/configuration.simpleandsolid.yaml'
+        'config_file': 'config/configuration.simpleandsolid.yaml',
+        'workers': 1,
+        'host_connections': 4,
+        'queue_size': 100,
+        'engine': 'requests',
+        'pool_size': 10,
+        'keep_alive': True,
+        'state_file': None,
+        'cache_size': 100000,
+        'recheck_after': 86400,
+        'list_failures': False,
+        'storage': 'plain',
+        'blob_dir': None,
+        'chunk_size': 0,
+        'fsync': 'none',
+        'metrics_file': None,
+        'daemon': False,
+        'inbox_dir': 'inbox',
+        'poll_interval': 2,
+        'timing': False,
+        'host_rate': 0,
+        'host_burst': 1,
+        'host_limits': {},
+        'retries': 3,
+        'retry_delay': 1,
+        'rejected_file': None,
+        'skip_rejected': False,
+        'processes': 1,
+        'peers': [],
+        'node': None,
+        'incremental': False,
+        'lock_file': None,
+        'deadline': None,
+        'layout': 'flat',
+        'migrate_layout': False,
+        'mime_types': [],
+        'max_size': 0,
+        'quota_bytes': 0,
+        'quota_files': 0,
+        'plan': None,
+        'plan_size': 1000,
+        'probe_workers': 8,
+        'priorities': {},
+        'no_clobber': False,
+        'snapshot_file': None,
+        'dedup': False,
+        'dedup_exact': 100000,
+        'dedup_bloom_bytes': 16777216,
+        'tracking_params': []
     }
 
     map_log_levels = {
@@ -304,6 +872,21 @@ def merge_configuration(args, config):
     elif config['config_file'] is not None:
         default['config_file'] = config['config_file']
 
+    # All further settings are taken over as they are without any mapping. They are not necessarily present in the
+    # arguments or the config file, so fall back to the default value quietly
+    for key in ['workers', 'host_connections', 'queue_size', 'engine', 'pool_size', 'keep_alive', 'state_file',
+                'cache_size', 'recheck_after', 'list_failures', 'storage', 'blob_dir', 'chunk_size', 'fsync',
+                'metrics_file', 'daemon', 'inbox_dir', 'poll_interval', 'timing',
+                'host_rate', 'host_burst', 'host_limits', 'retries', 'retry_delay', 'rejected_file', 'skip_rejected',
+                'processes', 'peers', 'node', 'incremental', 'lock_file', 'deadline',
+                'layout', 'migrate_layout', 'mime_types', 'max_size', 'quota_bytes', 'quota_files',
+                'plan', 'plan_size', 'probe_workers', 'priorities', 'no_clobber', 'snapshot_file',
+                'dedup', 'dedup_exact', 'dedup_bloom_bytes', 'tracking_params']:
+        if getattr(args, key, None) is not None:
+            default[key] = getattr(args, key)
+        elif config.get(key) is not None:
+            default[key] = config[key]
+
     return default
 
 
@@ -315,16 +898,62 @@ def configure():
 
     :return:
     """
+    timer = PhaseTimer(IMPORT_STARTED)
+    timer.lap('imports', IMPORT_FINISHED)
+
     # first get command line options. They override all other config
     args = create_parser().parse_args(sys.argv[1:])
+    timer.lap('arguments')
     config = load_config_file(args)
+    timer.lap('config_file')
     config = merge_configuration(args, config)
     verify_configuration(config)
+    timer.lap('verify')
     logger = setup_logging(config)
+    timer.lap('logging')
+
+    if config['timing']:
+        sys.stderr.write('Startup timing: %s\n' % timer.report())
 
     return config, logger
 
 
+class PhaseTimer(object):
+    """
+    Measure consecutive phases, e.g. of the startup.
+    """
+
+    def __init__(self, started):
+        """
+        Start timing the first phase.
+
+        :param started: time the first phase started
+        """
+        self.started = self.last = started
+        self.phases = []
+
+    def lap(self, name, now=None):
+        """
+        End the current phase and start the next one.
+
+        :param name: name of the phase ending now
+        :param now: end of the phase, default: now
+        :return:
+        """
+        now = time.time() if now is None else now
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        """
+        Format the phases in a single line.
+
+        :return: string
+        """
+        phases = self.phases + [('total', self.last - self.started)]
+        return ', '.join('%s=%.1fms' % (name, seconds * 1000) for name, seconds in phases)
+
+
 def load_config_file(args):
     """
     Try to load a configuration from a yaml file.
@@ -351,8 +980,10 @@ def load_config_file(args):
     try:
         # don't even try to check if the file exists beforehand we will get an exception
         with open(config['config_file'], 'r') as stream:
+            import yaml
             try:
-                parsed = yaml.load(stream)
+                # the C parser is a lot faster if PyYAML was built with it
+                parsed = yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
                 config.update(parsed['config'])  # overwrite none values from config
 
             # This probably doesn't cover all exeptions yet but all I stubled upon while testing
@@ -367,92 +998,4102 @@ def load_config_file(args):
     return config
 
 
-def download_images(config, logger, exitfunc=sys.exit):
+def lock_run(config, logger, exitfunc=sys.exit):
+    """
+    Make sure only one run at a time works on the input and output, e.g. if a cron job takes longer than its interval.
+
+    The lock is released when the lock file is closed or the process ends, however it ends.
+
+    :param config: dictionary of configuration values
+    :param logger: logger for output
+    :param exitfunc: make the sys.exit call overwriteable for testing
+    :return: the open lock file, keep it open while running; None without a lock file
+    """
+    if not config.get('lock_file'):
+        return None
+
+    lockfile = open(config['lock_file'], 'a+')
+    try:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as exc:
+        lockfile.close()
+        if exc.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        # 75 = EX_TEMPFAIL, the next run will do the work
+        logger.warn('Another run holds the lock file %s, exiting' % config['lock_file'])
+        exitfunc(75)
+        return None
+
+    # the pid tells who holds the lock
+    lockfile.truncate(0)
+    lockfile.write('%d\n' % os.getpid())
+    lockfile.flush()
+    return lockfile
+
+
+def download_images(config, logger, exitfunc=sys.exit, run=None):
     """
     Iterate over input file and process it line by line, downloading the images.
 
     Main loop
 
+    The input file is streamed, so memory usage doesn't depend on the number of urls in it.
+
     Todo: not sure how to test this without triggering actual downloads passing; the function doesn't work as expected
 
     :param config: dictionary of configuration values
     :param logger: logger for input and output
     :param exitfunc: make the sys.exit call overwriteable for testing
+    :param run: resources shared by all downloads, the caller finishes them; a fresh set is used if omitted
     :return: None
     """
+    if run is None:
+        run = create_run(config)
+        try:
+            return download_images(config, logger, exitfunc, run)
+        finally:
+            finish_run(run, logger)
+
+    # with --incremental the input isn't read again, the urls the last run deferred are only left in the rejected file
+    catch_up = 0
+    if config.get('incremental') and run['rejected'] is not None and 'shard' not in config:
+        deferred_urls, catch_up = run['rejected'].deferred()
+        if deferred_urls:
+            logger.info('Catching up on %d urls deferred by the last run' % len(deferred_urls))
+        # the shards get them with the configuration and skip the ones of the other shards
+        config = dict(config, deferred_urls=deferred_urls)
+
+    if config.get('processes', 1) > 1:
+        position = download_sharded(config, logger, run)
+        if position is not None and not run['stop'].is_set():
+            save_checkpoint(position, catch_up, logger, run)
+        evict_output(config, logger, run)
+        return
+
     # open input file for reading line by line
+    position = None
+    deferred = iter(config.get('deferred_urls', []))
     try:
         with open(config['input_file'], 'r') as infile:
-            for line in infile.readlines():
-                process_line(line, config, logger)
+            if config.get('incremental'):
+                lines, position = resume_input(infile, logger, run)
+                lines = itertools.chain(deferred, lines)
+            else:
+                lines = read_urls(infile, logger, run['stats'])
+            if run['deadline'] is not None:
+                lines = until_deadline(lines, run['deadline'], logger)
+            urls = until_stopped(lines, run['stop'])
+            if config.get('dedup'):
+                urls = canonical_urls(urls, config, run['stats'])
+            if 'shard' in config:
+                urls = in_shard(urls, *config['shard'])
+            # after sharding every process only remembers its own urls
+            if config.get('dedup'):
+                urls = unique_urls(urls, SeenUrls(config.get('dedup_exact', 100000),
+                                                  config.get('dedup_bloom_bytes', 16777216)), logger, run['stats'])
+            if config.get('skip_rejected') and run['rejected'] is not None:
+                urls = skip_rejected(urls, run['rejected'].urls(), logger, run['stats'])
+            if config.get('plan'):
+                urls = planned(urls, config, logger, run)
+            if config.get('engine') == 'asyncore':
+                AsyncEngine(config, logger, run).run(urls)
+            elif config.get('workers', 1) > 1:
+                download_parallel(urls, config, logger, run)
+            else:
+                slots = threading.BoundedSemaphore(config.get('queue_size', 100))
+
+                def overdue(url):
+                    defer_url(url, OVERDUE, logger, run)
+
+                for url in until_stopped(scheduled(urls, run['scheduler'], slots, overdue), run['stop']):
+                    try:
+                        process_line(url, config, logger, run)
+                    except sqlite3.OperationalError as exc:
+                        # e.g. the state file locked by another process for too long; the next url may do better
+                        logger.error('Exception recording %s in the state file: %s' % (url, str(exc)))
+                    finally:
+                        if not run['scheduler'].retrying(url):
+                            slots.release()
     except IOError as exc:
         # This really should never happen after all that input verification
         logger.error('Exception opening input file for reading: %s' % (str(exc)))
         exitfunc(74)
+        return
+
+    # after a stop the urls read ahead aren't done, the next run starts at the old checkpoint again and skips the
+    # urls done in the meantime
+    if position is not None and not run['stop'].is_set():
+        # the deferred urls not read, e.g. because of the deadline, stay deferred
+        remaining = in_shard(deferred, *config['shard']) if 'shard' in config else deferred
+        for url in remaining:
+            defer_url(url, OVERDUE, logger, run)
+        if 'shard' in config:
+            # every shard stops at its own offset, the parent saves the lowest once all of them are done
+            run['position'] = position
+        else:
+            save_checkpoint(position, catch_up, logger, run)
 
+    # the shards leave it to the parent process
+    if 'shard' not in config:
+        evict_output(config, logger, run)
 
-def generate_filename(url, output_dir):
+
+def save_checkpoint(position, catch_up, logger, run):
     """
-    Generate a sensible filename from an url and prepend output directory.
+    Save the input position of a finished run in the state file and forget the deferred urls it caught up on.
 
-    :param url: a url to process
-    :param output_dir: directory to write the file to
-    :return:
+    :param position: dictionary with the path, device, inode and offset of the input file
+    :param catch_up: number of deferred urls at the start of the rejected file the run caught up on
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the run
+    :return: None
     """
-    parsed = urlparse(url)
-    return os.path.join(
-        output_dir,
-        parsed[1].replace(".", "_").replace(":", "_") + parsed[2].replace("/", '_')
-    )
+    run['state'].set_checkpoint(**position)
+    logger.info('Input checkpoint: %s at byte %d' % (position['path'], position['offset']))
+    # after the checkpoint, if the run dies in between the deferred urls are tried again rather than lost
+    if catch_up:
+        run['rejected'].forget_deferred(catch_up)
 
 
-def write_file(response, outpath):
+def shard_of(url, count):
     """
-    Open output file for writing binary and write image chunk wise.
+    Get the shard of an url; all urls of a host belong to the same shard.
 
-    Todo: find out how to mock response and file
+    :param url: the url
+    :param count: number of shards
+    :return: index of the shard
+    """
+    return (zlib.crc32(HostScheduler.host(url)) & 0xffffffff) % count
 
-    :param response:
-    :param outpath:
-    :return:
+
+def in_shard(urls, index, count):
     """
-    with open(outpath, 'wb') as outfile:
-        # use iter_content() to force response body decoding and write 4kb chunks to output file
-        for chunk in response.iter_content(4096):
-            outfile.write(chunk)
+    Pass on the urls of a shard only.
 
+    Generator
 
-def process_line(line, config, logger):
+    :param urls: iterator over urls
+    :param index: index of the shard
+    :param count: number of shards
+    :return: iterator over urls
     """
-    Process a line of input, i.e. a single url.
+    for url in urls:
+        if shard_of(url, count) == index:
+            yield url
 
-    Todo: This is too hard to test, too. Refactor!
 
-    :param line: a line of input containing a url
-    :param config: the config dictionary
-    :param logger: the logger for output
+class ShardFilter(logging.Filter):
+    """
+    Prefix the log messages of a shard with its number, so the merged log tells the shards apart.
+    """
+
+    def __init__(self, index):
+        """
+        :param index: index of the shard
+        """
+        logging.Filter.__init__(self)
+        self.prefix = '[shard %d] ' % index
+
+    def filter(self, record):
+        record.msg = self.prefix + str(record.msg)
+        return True
+
+
+def download_shard(config, logger, index, results):
+    """
+    Download the urls of one shard in a child process and send back its statistics and input position.
+
+    SIGTERM and SIGINT stop taking new urls, like in the daemon, so the statistics are sent in any case.
+
+    :param config: dictionary of configuration values
+    :param logger: logger of the parent process
+    :param index: index of the shard
+    :param results: multiprocessing queue for the statistics and the input position (None if not finished)
     :return:
     """
-    logger.info("Loading %s ... " % line)
+    logger = logger.getChild('shard%d' % index)
+    logger.addFilter(ShardFilter(index))
+    config = dict(config, processes=1, shard=(index, config['processes']))
+    run = create_run(config)
 
-    # request the url via GET
-    response = requests.get(line, stream=True)
+    def stop(signum, frame):  # pylint: disable=unused-argument
+        run['stop'].set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
 
-    # generate a unique-ish filename that includes source information
-    outfile = generate_filename(line, config['output_dir'])
+    try:
+        download_images(config, logger, run=run)
+    finally:
+        close_run(run)
+        results.put((run['stats'].snapshot(), run['position']))
 
-    # If it worked then
-    if response.status_code == 200:
-        logger.info("S:%d writing file %s ... " % (response.status_code, outfile))
-        write_file(response, outfile)
-        logger.debug("done...")
 
-    # Status other than 200 = OK so request failed
-    else:
-        logger.warn("S:%d ERROR downloading %s\n" % (response.status_code, line))
+def download_sharded(config, logger, run):
+    """
+    Download the urls with 'processes' child processes, each taking the urls of its share of the hosts.
 
+    Every child reads the input file itself and skips the urls of the other shards, so nothing has to be passed
+    between the processes but the statistics and the input positions at the end. The statistics are merged into the
+    statistics of the run. As all urls of a host are downloaded by the same child, the children never write the same
+    output file.
 
-# Program starts off here
-if __name__ == "__main__":
-    CONF, LOG = configure()
-    download_images(CONF, LOG)
+    With --incremental every child stops at its own offset of the input file, the lowest of them is the position
+    all urls before it are done for.
+
+    SIGTERM and SIGINT set the stop event, which is passed on to the children, so a stopped run doesn't leave them
+    behind.
+
+    :param config: dictionary of configuration values
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the run; only the statistics and the stop event are used
+    :return: the lowest input position of the children, None if one of them didn't finish or without --incremental
+    """
+    import multiprocessing
+    import Queue
+
+    def stop(signum, frame):  # pylint: disable=unused-argument
+        logger.info('Received signal %d, stopping' % signum)
+        run['stop'].set()
+
+    # before the children are started, so a signal arriving before they installed their own doesn't kill them
+    previous = dict((signum, signal.signal(signum, stop)) for signum in (signal.SIGTERM, signal.SIGINT))
+    try:
+        results = multiprocessing.Queue()
+        shards = [multiprocessing.Process(target=download_shard, args=(config, logger, index, results))
+                  for index in range(config['processes'])]
+        for shard in shards:
+            shard.start()
+
+        remaining = len(shards)
+        positions = []
+        stopping = False
+        while remaining:
+            try:
+                snapshot, position = results.get(timeout=1)
+                run['stats'].merge(snapshot)
+                positions.append(position)
+                remaining -= 1
+            except Queue.Empty:
+                if run['stop'].is_set() and not stopping:
+                    # pass the stop on, the children finish their downloads and send their statistics
+                    stopping = True
+                    for shard in shards:
+                        if shard.is_alive():
+                            shard.terminate()
+                if not any(shard.is_alive() for shard in shards) and results.empty():
+                    break
+
+        for index, shard in enumerate(shards):
+            shard.join()
+            if shard.exitcode:
+                logger.error('Shard %d exited with status %d' % (index, shard.exitcode))
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+    # a shard which didn't send its position, or read another file after a rotation, leaves the old checkpoint
+    if remaining or None in positions:
+        return None
+    if len(set((position['device'], position['inode']) for position in positions)) != 1:
+        return None
+    return min(positions, key=lambda position: position['offset'])
+
+
+class HashRing(object):
+    """
+    Consistent hashing of urls to the nodes of the fleet.
+
+    Every node is put on the ring at RING_REPLICAS points; an url belongs to the node of the next point after the
+    url's hash. Adding or removing a node only moves the urls of that node.
+    """
+
+    def __init__(self, nodes):
+        """
+        Put the nodes on the ring.
+
+        :param nodes: list of node names, i.e. the base urls of the peers
+        """
+        points = sorted((self.hash('%s#%d' % (node, replica)), node)
+                        for node in nodes for replica in range(RING_REPLICAS))
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    @staticmethod
+    def hash(key):
+        """
+        Hash a key to a point on the ring.
+
+        :param key: string
+        :return: int
+        """
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def owner(self, url):
+        """
+        Get the node an url belongs to.
+
+        :param url: the url
+        :return: node name
+        """
+        return self.nodes[bisect.bisect(self.hashes, self.hash(url)) % len(self.nodes)]
+
+
+def source_url(url, config, run):
+    """
+    Get the url to download an url from.
+
+    In a fleet only the node an url belongs to downloads it from the origin, the others fetch the file from the output
+    directory of that node. The last attempt always goes to the origin, so an image is downloaded even if its node
+    is down or doesn't have it.
+
+    :param url: the url from the input
+    :param config: dictionary of configuration values
+    :param run: resources shared by all downloads of the run
+    :return: url on the origin or a peer
+    """
+    if run['ring'] is None:
+        return url
+    owner = run['ring'].owner(url)
+    if owner == config['node'] or run['scheduler'].attempted(url) >= config.get('retries', 3):
+        return url
+    return owner.rstrip('/') + '/' + quote(generate_filename(url, '', config.get('layout', 'flat')))
+
+
+def resume_input(infile, logger, run):
+    """
+    Continue reading the input file where the last run stopped.
+
+    The checkpoint in the state store holds device, inode and byte offset of the input file. If the file was
+    truncated it is read from the start. If it was replaced, e.g. rotated by logrotate, the rest of the old file is
+    read first if it is still there as '<input file>.1', then the new file from the start.
+
+    :param infile: input file open for reading
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the run
+    :return: tuple of an iterator over the urls and the position dictionary it advances; the keys match the
+             arguments of StateStore.set_checkpoint()
+    """
+    path = os.path.abspath(infile.name)
+    stat = os.fstat(infile.fileno())
+    position = {'path': path, 'device': stat.st_dev, 'inode': stat.st_ino, 'offset': 0}
+    lines = []
+
+    def rest_of(rotated):
+        with rotated:
+            for url in read_urls(rotated, logger, run['stats']):
+                yield url
+
+    checkpoint = run['state'].get_checkpoint(path)
+    if checkpoint is None:
+        pass
+    elif (checkpoint['device'], checkpoint['inode']) != (stat.st_dev, stat.st_ino):
+        logger.info('Input file %s was replaced, reading it from the start' % path)
+        try:
+            rotated = open(path + '.1', 'r')
+        except IOError:
+            rotated = None
+        if rotated is not None:
+            rotated_stat = os.fstat(rotated.fileno())
+            if (checkpoint['device'], checkpoint['inode']) == (rotated_stat.st_dev, rotated_stat.st_ino):
+                logger.info('Reading the rest of %s.1 from byte %d' % (path, checkpoint['offset']))
+                rotated.seek(checkpoint['offset'])
+                lines = rest_of(rotated)
+            else:
+                rotated.close()
+    elif checkpoint['offset'] > stat.st_size:
+        logger.warn('Input file %s was truncated, reading it from the start' % path)
+    else:
+        position['offset'] = checkpoint['offset']
+
+    infile.seek(position['offset'])
+    return itertools.chain(lines, read_urls(infile, logger, run['stats'], position)), position
+
+
+def read_urls(infile, logger, stats, position=None):
+    """
+    Read urls from an input file one by one.
+
+    Generator
+
+    Blank lines and comments starting with '#' are skipped, so are lines which aren't http(s) urls. Only the first
+    field of a line is used, so the output of --list_failures and the rejected file work as input, too.
+
+    With a position the offset after the last complete line is kept in it. A last line without line break may still
+    be being written, so it's left for the next run.
+
+    :param infile: file object open for reading
+    :param logger: logger for output
+    :param stats: RunStats to count skipped lines in
+    :param position: dictionary whose 'offset' is advanced by the lines read, None to read everything
+    :return: iterator over urls
+    """
+    # reading by line keeps the file position exact, iterating the file reads ahead
+    for line in iter(infile.readline, ''):
+        if position is not None:
+            if not line.endswith('\n'):
+                break
+            position['offset'] += len(line)
+
+        url = line.split(None, 1)[0] if line.strip() else ''
+        if not url or url.startswith('#'):
+            continue
+
+        parsed = urlparse(url)
+        if parsed.scheme.lower() not in ('http', 'https') or not parsed.netloc:
+            stats.increment('invalid')
+            logger.warn('Skipping invalid url: %s' % url)
+            continue
+
+        yield url
+
+
+def canonical_url(url, tracking_params=()):
+    """
+    Canonicalize an url, so the same image is known by the same url.
+
+    Scheme and host are lowercased, the default port, the fragment and tracking parameters of the query are removed
+    and an empty path becomes '/'. The path and the rest of the query are kept as they are, the server may well tell
+    their case or encoding apart.
+
+    :param url: the url
+    :param tracking_params: further names of tracking parameters besides TRACKING_PARAMS
+    :return: the canonical url; the url itself if it can't be parsed
+    """
+    try:
+        parsed = urlsplit(url)
+        port = parsed.port
+    except ValueError:
+        return url
+    if not parsed.hostname:
+        return url
+
+    scheme = parsed.scheme.lower()
+    netloc = '[%s]' % parsed.hostname if ':' in parsed.hostname else parsed.hostname
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc += ':%d' % port
+    if '@' in parsed.netloc:
+        netloc = parsed.netloc.rpartition('@')[0] + '@' + netloc
+
+    names = list(TRACKING_PARAMS) + list(tracking_params)
+    query = '&'.join(
+        pair for pair in parsed.query.split('&') if pair and not any(
+            pair.split('=', 1)[0].startswith(name) if name.endswith('_') else pair.split('=', 1)[0] == name
+            for name in names
+        )
+    )
+    return urlunsplit((scheme, netloc, parsed.path or '/', query, ''))
+
+
+def canonical_urls(urls, config, stats):
+    """
+    Canonicalize urls.
+
+    Generator
+
+    :param urls: iterator over urls
+    :param config: dictionary of configuration values
+    :param stats: RunStats to count the changed urls in
+    :return: iterator over canonical urls
+    """
+    for url in urls:
+        canonical = canonical_url(url, config.get('tracking_params', []))
+        if canonical != url:
+            stats.increment('canonicalized')
+        yield canonical
+
+
+class SeenUrls(object):
+    """
+    Remember the urls seen, in bounded memory.
+
+    Up to 'exact' urls are kept in a set. Beyond that they go into a Bloom filter of a fixed size, which may take an
+    url for one seen before, but never the other way round. With 10 bits per url about 1% of the new urls are taken
+    for duplicates.
+    """
+
+    # bits set per url; the best number for 10 bits per url
+    hashes = 7
+
+    def __init__(self, exact, bloom_bytes):
+        """
+        Start with an empty set; the Bloom filter is only allocated when the set is full.
+
+        :param exact: maximum number of urls in the set
+        :param bloom_bytes: size of the Bloom filter
+        """
+        self.exact = exact
+        self.bloom_bytes = bloom_bytes
+        self.urls = set()
+        self.bloom = None
+
+    def positions(self, url):
+        """
+        Get the bits of an url in the Bloom filter by double hashing.
+
+        :param url: the url
+        :return: list of bit positions
+        """
+        first, second = struct.unpack('<QQ', hashlib.sha1(url).digest()[:16])
+        size = len(self.bloom) * 8
+        return [(first + number * second) % size for number in range(self.hashes)]
+
+    def add(self, url):
+        """
+        Remember an url.
+
+        :param url: the url
+        :return: True if it wasn't seen before, False if it was or the Bloom filter takes it for one
+        """
+        if self.bloom is None:
+            if url in self.urls:
+                return False
+            self.urls.add(url)
+            if len(self.urls) > self.exact:
+                self.bloom = bytearray(self.bloom_bytes)
+                for seen in self.urls:
+                    self.set_bits(seen)
+                self.urls = None
+            return True
+
+        positions = self.positions(url)
+        if all(self.bloom[position >> 3] & (1 << (position & 7)) for position in positions):
+            return False
+        self.set_bits(url)
+        return True
+
+    def set_bits(self, url):
+        """
+        Set the bits of an url in the Bloom filter.
+
+        :param url: the url
+        :return:
+        """
+        for position in self.positions(url):
+            self.bloom[position >> 3] |= 1 << (position & 7)
+
+
+def unique_urls(urls, seen, logger, stats):
+    """
+    Pass every url on only once.
+
+    Generator
+
+    :param urls: iterator over urls
+    :param seen: SeenUrls
+    :param logger: logger for output
+    :param stats: RunStats to count the duplicates in
+    :return: iterator over urls
+    """
+    for url in urls:
+        approximate = seen.bloom is not None
+        if not seen.add(url):
+            stats.increment('duplicates')
+            logger.info('Skipping %s, a duplicate' % url)
+            continue
+        if not approximate and seen.bloom is not None:
+            logger.info('Remembering the urls in a Bloom filter of %d bytes after %d urls' % (
+                seen.bloom_bytes, seen.exact
+            ))
+        yield url
+
+
+def skip_rejected(urls, rejected, logger, stats):
+    """
+    Pass urls on unless an earlier run gave up on them.
+
+    Generator
+
+    :param urls: iterator over urls
+    :param rejected: set of rejected urls
+    :param logger: logger for output
+    :param stats: RunStats to count skipped urls in
+    :return: iterator over urls
+    """
+    for url in urls:
+        if url in rejected:
+            stats.increment('skipped_rejected')
+            logger.info('Skipping %s, rejected by an earlier run' % url)
+            continue
+        yield url
+
+
+def until_deadline(urls, deadline, logger):
+    """
+    Pass urls on until the deadline of the run.
+
+    Generator
+
+    :param urls: iterator over urls
+    :param deadline: time to stop at
+    :param logger: logger for output
+    :return: iterator over urls
+    """
+    # look at the clock before taking the next url, an url taken is one read for the checkpoint
+    while time.time() < deadline:
+        url = next(urls, None)
+        if url is None:
+            return
+        yield url
+    logger.info('Deadline reached, finishing the running downloads')
+
+
+def until_stopped(urls, stop):
+    """
+    Pass urls on until the run is stopped.
+
+    Generator
+
+    :param urls: iterator over urls
+    :param stop: threading.Event set to stop
+    :return: iterator over urls
+    """
+    for url in urls:
+        if stop.is_set():
+            return
+        yield url
+
+
+def probe_size(url, config, run):
+    """
+    Ask the server for the size of an url with a HEAD request.
+
+    Hosts with a rate limit aren't asked, the probe would take a request from the downloads.
+
+    :param url: the url
+    :param config: dictionary of configuration values
+    :param run: resources shared by all downloads of the run
+    :return: size in bytes, None if it is unknown
+    """
+    # skipped right away
+    if already_done(url, generate_filename(url, config['output_dir'], config.get('layout', 'flat')), config, run):
+        return 0
+    host = HostScheduler.host(url)
+    if config.get('host_rate') or host in config.get('host_limits', {}):
+        return None
+    try:
+        response = run['session'].head(url, allow_redirects=True, timeout=(CONNECT_TIMEOUT, IDLE_TIMEOUT))
+    except requests.RequestException:
+        return None
+    run['stats'].increment('probed')
+    if response.status_code != 200:
+        return None
+    return content_length(response.headers)
+
+
+def plan_order(urls, sizes, config):
+    """
+    Order urls by the plan policy.
+
+    Urls of unknown size come after the ones of known size, otherwise the order of the input is kept.
+
+    :param urls: list of urls
+    :param sizes: dictionary of the size of every url, None if it is unknown
+    :param config: dictionary of configuration values
+    :return: list of urls
+    """
+    def shortest(url):
+        return sizes[url] is None, sizes[url]
+
+    ordered = sorted(urls, key=shortest)
+    if config['plan'] == 'priority':
+        priorities = config.get('priorities', {})
+        ordered.sort(key=lambda url: -priorities.get(HostScheduler.host(url), 0))
+    elif config['plan'] == 'fair':
+        hosts = collections.OrderedDict()
+        for url in ordered:
+            hosts.setdefault(HostScheduler.host(url), collections.deque()).append(url)
+        ordered = []
+        while hosts:
+            for host in list(hosts):
+                ordered.append(hosts[host].popleft())
+                if not hosts[host]:
+                    del hosts[host]
+    return ordered
+
+
+def planned(urls, config, logger, run):
+    """
+    Probe the size of the urls and pass them on in the order of the plan policy, 'plan_size' urls at a time.
+
+    Generator
+
+    The probes run in 'probe_workers' threads on the pooled connections of the session, at most 'host_connections' per
+    host; they don't need the workers of the downloads, which are mostly idle while the batch is probed. With a
+    deadline an url is deferred to the rejected file if it can't be downloaded in the time left at the throughput of
+    the run so far; the shortest first policy leaves those for the end. So a few huge images can't keep thousands of
+    small ones from being done in time.
+
+    :param urls: iterator over urls
+    :param config: dictionary of configuration values
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the run
+    :return: iterator over urls
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    limiter = HostLimiter(config.get('host_connections', 4))
+
+    def probe(url):
+        with limiter.semaphore(url):
+            return probe_size(url, config, run)
+
+    with ThreadPoolExecutor(max_workers=config.get('probe_workers', 8)) as executor:
+        while True:
+            batch = list(itertools.islice(urls, config.get('plan_size', 1000)))
+            if not batch:
+                return
+            sizes = dict(zip(batch, executor.map(probe, batch)))
+            for url in plan_order(batch, sizes, config):
+                stats = run['stats']
+                if run['deadline'] is not None and sizes[url] and stats.get('bytes_downloaded'):
+                    rate = stats.get('bytes_downloaded') / (time.time() - stats.started)
+                    if sizes[url] / rate > run['deadline'] - time.time():
+                        defer_url(url, '%d bytes won\'t be done before the deadline' % sizes[url], logger, run)
+                        continue
+                yield url
+
+
+class InboxWatcher(object):
+    """
+    Report input files put into the inbox directory.
+
+    Uses inotify through ctypes on Linux: files are reported as soon as they are closed after writing or moved into
+    the directory. Elsewhere the directory is polled and files are reported once their size and modification time
+    stayed the same between two looks. Hidden files are ignored, so writers can create '.name' and rename it.
+    """
+
+    def __init__(self, path, poll_interval, logger):
+        """
+        Start watching the directory.
+
+        :param path: the inbox directory
+        :param poll_interval: seconds between two looks at the directory if inotify is not available
+        :param logger: logger for output
+        """
+        self.path = path
+        self.poll_interval = poll_interval
+        self.descriptor = None
+        self.signatures = {}
+        self.reported = set()
+        self.last_poll = 0
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if hasattr(libc, 'inotify_init1'):
+            descriptor = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if descriptor >= 0 and libc.inotify_add_watch(descriptor, path, IN_CLOSE_WRITE | IN_MOVED_TO) >= 0:
+                self.descriptor = descriptor
+            else:
+                if descriptor >= 0:
+                    os.close(descriptor)
+                logger.warn('inotify not available (%s), polling %s' % (os.strerror(ctypes.get_errno()), path))
+        else:
+            logger.info('inotify not available, polling %s' % path)
+
+    def existing(self):
+        """
+        Get the input files already in the inbox, oldest first.
+
+        :return: list of file names
+        """
+        names = [name for name in os.listdir(self.path) if self.is_input(name)]
+        return sorted(names, key=lambda name: os.path.getmtime(os.path.join(self.path, name)))
+
+    def is_input(self, name):
+        """
+        Check whether a file in the inbox is an input file.
+
+        :param name: file name
+        :return: bool
+        """
+        return not name.startswith('.') and os.path.isfile(os.path.join(self.path, name))
+
+    def wait(self, timeout):
+        """
+        Wait for new input files.
+
+        :param timeout: seconds to wait at most
+        :return: list of file names, may be empty
+        """
+        if self.descriptor is None:
+            return self.poll(timeout)
+
+        try:
+            readable = select.select([self.descriptor], [], [], timeout)[0]
+        except select.error as exc:
+            # interrupted by a signal
+            if exc.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+
+        names = []
+        data = os.read(self.descriptor, 65536)
+        offset = 0
+        while offset < len(data):
+            # struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+            length = ctypes.c_uint32.from_buffer_copy(data[offset + 12:offset + 16]).value
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if name not in names and self.is_input(name):
+                names.append(name)
+        return names
+
+    def poll(self, timeout):
+        """
+        Look for input files which didn't change since the last look.
+
+        :param timeout: seconds to wait at most
+        :return: list of file names, may be empty
+        """
+        delay = self.last_poll + self.poll_interval - time.time()
+        if delay > 0:
+            time.sleep(min(delay, timeout))
+            if delay > timeout:
+                return []
+        self.last_poll = time.time()
+
+        signatures = {}
+        for name in os.listdir(self.path):
+            if self.is_input(name):
+                stat = os.stat(os.path.join(self.path, name))
+                signatures[name] = (stat.st_size, stat.st_mtime)
+        names = sorted(name for name in signatures
+                       if name not in self.reported and self.signatures.get(name) == signatures[name])
+        self.signatures = signatures
+        # forget files which are gone, a new file of the same name is new input
+        self.reported = (self.reported & set(signatures)) | set(names)
+        return names
+
+    def close(self):
+        """
+        Stop watching.
+
+        :return:
+        """
+        if self.descriptor is not None:
+            os.close(self.descriptor)
+            self.descriptor = None
+
+
+def process_inbox_file(name, config, logger, run):
+    """
+    Download the urls of an input file from the inbox and move it to the 'done' directory in the inbox.
+
+    If the daemon is stopped in the middle of the file or the file can't be processed it stays in the inbox and is
+    processed again when the daemon starts the next time. Recently downloaded urls are skipped then if there is a
+    state file.
+
+    With --deadline every file gets the whole time, counted from when it is taken from the inbox.
+
+    :param name: name of the file in the inbox directory
+    :param config: dictionary of configuration values
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the daemon
+    :return:
+    """
+    path = os.path.join(config['inbox_dir'], name)
+    # reported twice, e.g. by inotify and the first look into the inbox
+    if not os.path.isfile(path):
+        return
+
+    logger.info('Processing inbox file %s' % path)
+    # the deadline is for each inbox file, the one of the daemon's start would have passed long ago
+    if config.get('deadline'):
+        run['deadline'] = run['scheduler'].deadline = time.time() + config['deadline']
+    exits = []
+    try:
+        download_images(dict(config, input_file=path), logger, exitfunc=exits.append, run=run)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.error('Exception processing inbox file %s: %s' % (path, str(exc)))
+        return
+    finally:
+        if run['state'] is not None:
+            run['state'].flush()
+        publish_metrics(run, logger)
+
+    if exits:
+        return
+    if run['stop'].is_set():
+        logger.info('Stopped in the middle of inbox file %s, keeping it' % path)
+        return
+
+    done = os.path.join(config['inbox_dir'], 'done')
+    if not os.path.isdir(done):
+        os.mkdir(done)
+    os.rename(path, os.path.join(done, name))
+    logger.info('Done with inbox file %s: %s' % (path, run['stats'].summary()))
+
+
+def run_daemon(config, logger):
+    """
+    Keep running and download the urls of every file put into the inbox directory.
+
+    Unlike cron runs the daemon keeps its connection pools, state database and statistics between input files.
+    SIGTERM and SIGINT stop it after the downloads in progress.
+
+    :param config: dictionary of configuration values
+    :param logger: logger for output
+    :return: None
+    """
+    run = create_run(config)
+
+    def stop(signum, frame):  # pylint: disable=unused-argument
+        logger.info('Received signal %d, stopping' % signum)
+        run['stop'].set()
+
+    previous = dict((signum, signal.signal(signum, stop)) for signum in (signal.SIGTERM, signal.SIGINT))
+    watcher = InboxWatcher(config['inbox_dir'], config['poll_interval'], logger)
+    try:
+        logger.info('Watching %s for input files' % config['inbox_dir'])
+        names = watcher.existing()
+        while not run['stop'].is_set():
+            for name in names:
+                if run['stop'].is_set():
+                    break
+                process_inbox_file(name, config, logger, run)
+            names = watcher.wait(1)
+    finally:
+        watcher.close()
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        finish_run(run, logger)
+
+
+class RunStats(object):
+    """
+    Thread safe counters for the run summary and histograms of timings.
+    """
+
+    def __init__(self):
+        """
+        Initialize all counters with zero.
+        """
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.statuses = collections.Counter()
+        self.histograms = collections.defaultdict(collections.Counter)
+        self.sums = collections.Counter()
+
+    def increment(self, key, amount=1):
+        """
+        Add to a counter.
+
+        :param key: name of the counter
+        :param amount: value to add
+        :return:
+        """
+        with self.lock:
+            self.counters[key] += amount
+
+    def count_status(self, status):
+        """
+        Count a download result by HTTP status.
+
+        :param status: HTTP status, 0 if there was no (complete) response
+        :return:
+        """
+        with self.lock:
+            self.statuses[status] += 1
+
+    def get(self, key):
+        """
+        Get the current value of a counter.
+
+        :param key: name of the counter
+        :return: int
+        """
+        with self.lock:
+            return self.counters[key]
+
+    def observe(self, key, seconds):
+        """
+        Add a timing to a histogram.
+
+        :param key: name of the histogram
+        :param seconds: the duration
+        :return:
+        """
+        if seconds <= HISTOGRAM_BASE:
+            bucket = 0
+        else:
+            bucket = int(math.ceil(math.log(seconds / HISTOGRAM_BASE, HISTOGRAM_GROWTH)))
+        with self.lock:
+            self.histograms[key][bucket] += 1
+            self.sums[key] += seconds
+
+    def percentile(self, key, fraction):
+        """
+        Estimate a percentile of a histogram.
+
+        :param key: name of the histogram
+        :param fraction: the percentile as a fraction, e.g. 0.99
+        :return: upper bound in seconds of the bucket holding the percentile, None without any timings
+        """
+        with self.lock:
+            histogram = self.histograms.get(key, {})
+            rank = fraction * sum(histogram.values())
+            seen = 0
+            for bucket in sorted(histogram):
+                seen += histogram[bucket]
+                if seen >= rank:
+                    return HISTOGRAM_BASE * HISTOGRAM_GROWTH ** bucket
+        return None
+
+    def cumulative(self, key, bounds):
+        """
+        Count the timings of a histogram up to each of the given bounds.
+
+        A bucket is counted at the first bound at least as big as its upper bound, so a timing just below a bound may
+        be counted at the next one.
+
+        :param key: name of the histogram
+        :param bounds: ascending list of bounds in seconds
+        :return: list of counts per bound
+        """
+        counts = [0] * len(bounds)
+        with self.lock:
+            for bucket, count in self.histograms.get(key, {}).items():
+                upper = HISTOGRAM_BASE * HISTOGRAM_GROWTH ** bucket
+                for index, bound in enumerate(bounds):
+                    if upper <= bound * (1 + 1e-9):
+                        counts[index] += count
+                        break
+        total = 0
+        for index, count in enumerate(counts):
+            total += count
+            counts[index] = total
+        return counts
+
+    def snapshot(self):
+        """
+        Copy all counters and histograms, e.g. to pass them to another process.
+
+        :return: dictionary of plain counters
+        """
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'statuses': dict(self.statuses),
+                'histograms': dict((key, dict(histogram)) for key, histogram in self.histograms.items()),
+                'sums': dict(self.sums)
+            }
+
+    def merge(self, snapshot):
+        """
+        Add the counters and histograms of a snapshot.
+
+        :param snapshot: dictionary created by snapshot()
+        :return:
+        """
+        with self.lock:
+            self.counters.update(snapshot['counters'])
+            self.statuses.update(snapshot['statuses'])
+            for key, histogram in snapshot['histograms'].items():
+                self.histograms[key].update(histogram)
+            self.sums.update(snapshot['sums'])
+
+    def summary(self):
+        """
+        Format all counters in a single line for the log.
+
+        :return: string
+        """
+        with self.lock:
+            return ', '.join('%s=%d' % (key, self.counters[key]) for key in sorted(self.counters))
+
+
+class CountingConnectionMixin(object):
+    """
+    Count every socket a urllib3 connection opens.
+
+    urllib3 only counts the connection objects of a pool, a keep-alive connection dropped by the server is reconnected
+    silently. Counting the connect() calls catches those, too. The statistics object is passed in through the
+    connection keywords of the pool.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Take the statistics object out of the keywords before initializing the connection.
+
+        :param args: positional arguments for the connection
+        :param kwargs: keyword arguments for the connection plus 'stats'
+        """
+        self.stats = kwargs.pop('stats')
+        super(CountingConnectionMixin, self).__init__(*args, **kwargs)
+
+    def connect(self):
+        """
+        Count and open a new socket.
+
+        :return:
+        """
+        self.stats.increment('connections_opened')
+        super(CountingConnectionMixin, self).connect()
+
+    def _new_conn(self):
+        """
+        Resolve the host and connect to it, timing both separately.
+
+        urllib3 resolves and connects in one go, so the host is resolved here and its addresses are tried in turn.
+        The host name is only swapped for the address while connecting; the Host header is already sent and TLS
+        still checks the name.
+
+        :return: the connected socket
+        """
+        host = self.host
+        started = time.time()
+        try:
+            infos = socket.getaddrinfo(host.strip('[]'), self.port, urllib3.util.connection.allowed_gai_family(),
+                                       socket.SOCK_STREAM)
+        except socket.error as exc:
+            raise urllib3.exceptions.NewConnectionError(self, 'Failed to establish a new connection: %s' % exc)
+        resolved = time.time()
+        self.stats.observe('dns', resolved - started)
+
+        addresses = []
+        for info in infos:
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+        try:
+            for number, address in enumerate(addresses, 1):
+                self.host = address
+                try:
+                    conn = super(CountingConnectionMixin, self)._new_conn()
+                    break
+                except urllib3.exceptions.NewConnectionError:
+                    if number == len(addresses):
+                        raise
+        finally:
+            self.host = host
+
+        self.connected_at = time.time()
+        self.stats.observe('connect', self.connected_at - resolved)
+        return conn
+
+
+class CountingHTTPConnection(CountingConnectionMixin, urllib3.connection.HTTPConnection):
+    """
+    HTTP connection counting its connects.
+    """
+
+
+class CountingHTTPSConnection(CountingConnectionMixin, urllib3.connection.VerifiedHTTPSConnection):
+    """
+    HTTPS connection counting its connects.
+    """
+
+    def connect(self):
+        """
+        Open a new socket and time the TLS handshake on it.
+
+        :return:
+        """
+        super(CountingHTTPSConnection, self).connect()
+        self.stats.observe('tls', time.time() - self.connected_at)
+
+
+class CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTP adapter counting the requests sent and the connections opened for them.
+    """
+
+    def __init__(self, stats, **kwargs):
+        """
+        Initialize the adapter.
+
+        :param stats: RunStats to count in
+        :param kwargs: keyword arguments for requests.adapters.HTTPAdapter
+        """
+        self.stats = stats
+        super(CountingHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        """
+        Count the requests of each connection pool when the pool manager drops it.
+
+        :param args: positional arguments for the pool manager
+        :param kwargs: keyword arguments for the pool manager
+        :return:
+        """
+        super(CountingHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pools.dispose_func = self.dispose
+
+    def get_connection(self, url, proxies=None):
+        """
+        Get the connection pool for an url and make it use counting connections.
+
+        :param url: the url to request
+        :param proxies: proxy configuration
+        :return: urllib3 connection pool
+        """
+        pool = super(CountingHTTPAdapter, self).get_connection(url, proxies)
+        if 'stats' not in pool.conn_kw:
+            pool.conn_kw['stats'] = self.stats
+            pool.ConnectionCls = CountingHTTPSConnection if pool.scheme == 'https' else CountingHTTPConnection
+        return pool
+
+    def dispose(self, pool):
+        """
+        Count the requests of a pool and close it.
+
+        :param pool: urllib3 connection pool
+        :return:
+        """
+        self.stats.increment('requests', pool.num_requests)
+        pool.close()
+
+
+def create_session(config, stats):
+    """
+    Create a requests session that keeps connections open and reuses them for the same host.
+
+    Factory method
+
+    :param config: dictionary of configuration values
+    :param stats: RunStats to count connections in
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = CountingHTTPAdapter(
+        stats,
+        pool_connections=config.get('pool_size', 10),
+        pool_maxsize=config.get('pool_size', 10)
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if not config.get('keep_alive', True):
+        session.headers['Connection'] = 'close'
+
+    return session
+
+
+def create_run(config):
+    """
+    Create the resources shared by all downloads of a run.
+
+    Factory method
+
+    :param config: dictionary of configuration values
+    :return: dictionary with the run statistics, the http session, the state store (None if not configured), the
+             path of the metrics file (None if not configured), the host scheduler, the rejected file (None if not
+             configured), the hash ring of the fleet (None if not configured), the deadline (None if not configured),
+             the index of the output directory (None without --no_clobber or with several processes, each of them
+             has its own), the stop event and the input position a shard reached (None until it finished)
+    """
+    stats = RunStats()
+    deadline = time.time() + config['deadline'] if config.get('deadline') else None
+    return {
+        'stats': stats,
+        'session': create_session(config, stats),
+        # the processes of --processes share the state file, each commits every change to not lock out the others
+        'state': StateStore(config['state_file'], config.get('cache_size', 100000), 1 if 'shard' in config else None)
+                 if config.get('state_file') else None,
+        'metrics_file': config.get('metrics_file'),
+        'scheduler': HostScheduler(config, deadline),
+        'rejected': RejectedFile(config['rejected_file']) if config.get('rejected_file') else None,
+        'ring': HashRing(config['peers']) if config.get('peers') else None,
+        'deadline': deadline,
+        'index': OutputIndex.open(config) if config.get('no_clobber') and config.get('processes', 1) == 1 else None,
+        # set to stop taking new urls, e.g. on SIGTERM
+        'stop': threading.Event(),
+        'position': None
+    }
+
+
+def close_run(run):
+    """
+    Close the resources of a run.
+
+    :param run: dictionary created by create_run()
+    :return:
+    """
+    # closing the session disposes all connection pools which counts their requests
+    run['session'].close()
+    if run['state'] is not None:
+        run['state'].close()
+    if run['rejected'] is not None:
+        run['rejected'].close()
+    if run['index'] is not None:
+        run['index'].close()
+
+
+def finish_run(run, logger):
+    """
+    Close the resources of a run and log the run summary.
+
+    :param run: dictionary created by create_run()
+    :param logger: logger for output
+    :return:
+    """
+    close_run(run)
+    stats = run['stats']
+    stats.increment('connections_reused', max(stats.get('requests') - stats.get('connections_opened'), 0))
+    logger.info('Run summary: %s' % stats.summary())
+    publish_metrics(run, logger)
+
+
+def publish_metrics(run, logger):
+    """
+    Write the metrics file of a run if one is configured.
+
+    :param run: dictionary created by create_run()
+    :param logger: logger for output
+    :return:
+    """
+    if run.get('metrics_file'):
+        try:
+            write_metrics(run['stats'], run['metrics_file'])
+        except (IOError, OSError) as exc:
+            logger.error('Exception writing metrics file: %s' % str(exc))
+
+
+def format_metrics(stats):
+    """
+    Format the statistics of a run in the Prometheus text format.
+
+    The counters cover the last run only. Runs start from zero, which Prometheus handles like a restarted process.
+
+    :param stats: RunStats of the run
+    :return: string
+    """
+    lines = [
+        '# HELP simpleandsolid_last_run_timestamp_seconds End of the last run.',
+        '# TYPE simpleandsolid_last_run_timestamp_seconds gauge',
+        'simpleandsolid_last_run_timestamp_seconds %.3f' % time.time(),
+        '# HELP simpleandsolid_last_run_duration_seconds Duration of the last run.',
+        '# TYPE simpleandsolid_last_run_duration_seconds gauge',
+        'simpleandsolid_last_run_duration_seconds %.3f' % (time.time() - stats.started),
+        '# HELP simpleandsolid_responses_total Downloads by HTTP status, 0 without a complete response.',
+        '# TYPE simpleandsolid_responses_total counter'
+    ]
+    with stats.lock:
+        counters = dict(stats.counters)
+        statuses = dict(stats.statuses)
+        sums = dict(stats.sums)
+        histograms = sorted(stats.histograms)
+    lines.extend('simpleandsolid_responses_total{status="%d"} %d' % (status, statuses[status])
+                 for status in sorted(statuses))
+
+    for key in sorted(counters):
+        lines.extend([
+            '# TYPE simpleandsolid_%s_total counter' % key,
+            'simpleandsolid_%s_total %d' % (key, counters[key])
+        ])
+
+    lines.extend([
+        '# HELP simpleandsolid_phase_seconds Duration of the phases of the downloads; latency covers a whole url.',
+        '# TYPE simpleandsolid_phase_seconds histogram'
+    ])
+    for key in histograms:
+        counts = stats.cumulative(key, PROMETHEUS_BUCKETS)
+        lines.extend('simpleandsolid_phase_seconds_bucket{phase="%s",le="%s"} %d' % (key, bound, count)
+                     for bound, count in zip(PROMETHEUS_BUCKETS, counts))
+        total = sum(stats.histograms[key].values())
+        lines.extend([
+            'simpleandsolid_phase_seconds_bucket{phase="%s",le="+Inf"} %d' % (key, total),
+            'simpleandsolid_phase_seconds_sum{phase="%s"} %.6f' % (key, sums.get(key, 0)),
+            'simpleandsolid_phase_seconds_count{phase="%s"} %d' % (key, total)
+        ])
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(stats, path):
+    """
+    Write the metrics of a run to a Prometheus textfile.
+
+    The file is written under a temporary name in the same directory and renamed into place, so the node exporter
+    never reads half a file.
+
+    :param stats: RunStats of the run
+    :param path: path of the textfile
+    :return:
+    """
+    handle, temppath = tempfile.mkstemp(prefix='.simpleandsolid', suffix='.prom.tmp',
+                                        dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(handle, 'w') as outfile:
+            outfile.write(format_metrics(stats))
+        # mkstemp creates the file readable by the owner only
+        os.chmod(temppath, 0o644)
+        os.rename(temppath, path)
+    except Exception:
+        os.unlink(temppath)
+        raise
+
+
+class StateStore(object):
+    """
+    Keep the state of the downloader across runs in a SQLite database.
+
+    Stores the cache validators (ETag and Last-Modified) of every downloaded url, so unchanged images aren't
+    downloaded again. Only the most recently used 'max_validators' entries are kept.
+
+    Also keeps an index of the last download attempt of every url with output path, HTTP status (0 if there was no
+    response), size and SHA-256 hash of the file. A status of 200 or 304 means the file is complete.
+
+    For incremental runs it keeps a checkpoint of every input file: device, inode and the offset read up to.
+
+    For the quota of the output directory it keeps an index of the downloaded files with size, hash and the time they
+    were last used, i.e. downloaded, confirmed by a 304 response or read as far as the access time tells.
+
+    All downloads of a run share one connection, guarded by a lock. Changes are committed in batches and on close.
+    """
+
+    commit_interval = 100
+
+    def __init__(self, path, max_validators, commit_interval=None):
+        """
+        Open the database and create the tables if needed.
+
+        :param path: path of the database file
+        :param max_validators: number of validator entries to keep
+        :param commit_interval: number of changes per transaction, 1 if other processes write to the file at the same
+                                time; an open transaction keeps them from writing
+        """
+        self.max_validators = max_validators
+        if commit_interval is not None:
+            self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.changes = 0
+        # with --processes several processes write to the file, wait for each other's transactions
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS validators '
+            '(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, last_used REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS validators_last_used ON validators (last_used)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS downloads '
+            '(url TEXT PRIMARY KEY, path TEXT, status INTEGER NOT NULL, size INTEGER, sha256 TEXT, '
+            'attempted REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS downloads_status ON downloads (status)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoints '
+            '(path TEXT PRIMARY KEY, device INTEGER NOT NULL, inode INTEGER NOT NULL, offset INTEGER NOT NULL, '
+            'updated REAL NOT NULL)'
+        )
+        new_index = self.connection.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'files'"
+        ).fetchone()[0] == 0
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS files '
+            '(path TEXT PRIMARY KEY, size INTEGER NOT NULL, sha256 TEXT, used REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_used ON files (used)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)')
+        if new_index:
+            # state files from before the index know the complete downloads already
+            self.connection.execute(
+                'INSERT OR IGNORE INTO files (path, size, sha256, used) SELECT path, size, sha256, attempted '
+                'FROM downloads WHERE status IN (200, 304) AND size IS NOT NULL'
+            )
+        self.connection.row_factory = sqlite3.Row
+        self.connection.commit()
+
+    def execute(self, sql, parameters=()):
+        """
+        Run a modifying statement and commit every 'commit_interval' changes.
+
+        :param sql: SQL statement
+        :param parameters: statement parameters
+        :return:
+        """
+        with self.lock:
+            self.connection.execute(sql, parameters)
+            self.changes += 1
+            if self.changes >= self.commit_interval:
+                self.connection.commit()
+                self.changes = 0
+
+    def get_validators(self, url):
+        """
+        Get the cache validators stored for an url.
+
+        :param url: the url
+        :return: tuple of ETag and Last-Modified header values, each may be None
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT etag, last_modified FROM validators WHERE url = ?', (url,)
+            ).fetchone()
+        return tuple(row) if row is not None else (None, None)
+
+    def set_validators(self, url, etag, last_modified):
+        """
+        Store the cache validators of a downloaded url; forget the url if the server sent none.
+
+        :param url: the url
+        :param etag: ETag header value or None
+        :param last_modified: Last-Modified header value or None
+        :return:
+        """
+        if etag is None and last_modified is None:
+            self.execute('DELETE FROM validators WHERE url = ?', (url,))
+        else:
+            self.execute(
+                'INSERT OR REPLACE INTO validators (url, etag, last_modified, last_used) VALUES (?, ?, ?, ?)',
+                (url, etag, last_modified, time.time())
+            )
+
+    def touch(self, url):
+        """
+        Mark the validators of an url as used, so they are kept.
+
+        :param url: the url
+        :return:
+        """
+        self.execute('UPDATE validators SET last_used = ? WHERE url = ?', (time.time(), url))
+
+    def get_download(self, url):
+        """
+        Get the last download attempt of an url.
+
+        :param url: the url
+        :return: sqlite3.Row with path, status, size, sha256 and attempted or None
+        """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT path, status, size, sha256, attempted FROM downloads WHERE url = ?', (url,)
+            ).fetchone()
+
+    def record_download(self, url, path, status, size=None, sha256=None):
+        """
+        Record a download attempt.
+
+        :param url: the url
+        :param path: the output path of the url
+        :param status: HTTP status, 0 if there was no (complete) response
+        :param size: number of bytes written
+        :param sha256: hex digest of the file content
+        :return:
+        """
+        self.execute(
+            'INSERT OR REPLACE INTO downloads (url, path, status, size, sha256, attempted) VALUES (?, ?, ?, ?, ?, ?)',
+            (url, path, status, size, sha256, time.time())
+        )
+        if status == 200:
+            self.execute(
+                'INSERT OR REPLACE INTO files (path, size, sha256, used) VALUES (?, ?, ?, ?)',
+                (path, size or 0, sha256, time.time())
+            )
+
+    def record_not_modified(self, url):
+        """
+        Record a 304 response; size and hash of the existing file stay the same.
+
+        :param url: the url
+        :return:
+        """
+        self.execute('UPDATE downloads SET status = 304, attempted = ? WHERE url = ?', (time.time(), url))
+        self.execute('UPDATE files SET used = ? WHERE path = (SELECT path FROM downloads WHERE url = ?)',
+                     (time.time(), url))
+
+    def downloads(self, batch_size=1000):
+        """
+        Iterate over the url and output path of all downloads.
+
+        Generator
+
+        The rows are fetched in batches, so they may be changed while iterating.
+
+        :param batch_size: number of rows fetched at once
+        :return: iterator over sqlite3.Row with url and path
+        """
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    'SELECT rowid, url, path FROM downloads WHERE rowid > ? ORDER BY rowid LIMIT ?', (last, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            last = rows[-1]['rowid']
+
+    def move_download(self, url, path):
+        """
+        Record the new output path of a download.
+
+        :param url: the url
+        :param path: the new output path
+        :return:
+        """
+        self.execute('UPDATE files SET path = ? WHERE path = (SELECT path FROM downloads WHERE url = ?)', (path, url))
+        self.execute('UPDATE downloads SET path = ? WHERE url = ?', (path, url))
+
+    def usage(self):
+        """
+        Get the number and total size of the downloaded files.
+
+        :return: tuple of the number of files and their size in bytes
+        """
+        with self.lock:
+            return tuple(self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files').fetchone())
+
+    def least_used(self, limit):
+        """
+        Get the downloaded files used longest ago.
+
+        :param limit: maximum number of files
+        :return: list of sqlite3.Row with path, size, sha256 and used; least recently used first
+        """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT path, size, sha256, used FROM files ORDER BY used LIMIT ?', (limit,)
+            ).fetchall()
+
+    def use_file(self, path, used):
+        """
+        Record when a downloaded file was used last.
+
+        :param path: path of the file
+        :param used: time of the last use
+        :return:
+        """
+        self.execute('UPDATE files SET used = ? WHERE path = ?', (used, path))
+
+    def forget_file(self, path):
+        """
+        Remove a file which is gone from the index.
+
+        :param path: path of the file
+        :return:
+        """
+        self.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def content_used(self, sha256):
+        """
+        Check if any downloaded file has a certain content, e.g. before its blob is removed.
+
+        :param sha256: hex digest of the content
+        :return: bool
+        """
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM files WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone() \
+                is not None
+
+    def get_checkpoint(self, path):
+        """
+        Get how far an input file was read.
+
+        :param path: absolute path of the input file
+        :return: sqlite3.Row with device, inode and offset or None
+        """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT device, inode, offset FROM checkpoints WHERE path = ?', (path,)
+            ).fetchone()
+
+    def set_checkpoint(self, path, device, inode, offset):
+        """
+        Store how far an input file was read.
+
+        :param path: absolute path of the input file
+        :param device: device of the file
+        :param inode: inode of the file
+        :param offset: byte offset after the last line read
+        :return:
+        """
+        self.execute(
+            'INSERT OR REPLACE INTO checkpoints (path, device, inode, offset, updated) VALUES (?, ?, ?, ?, ?)',
+            (path, device, inode, offset, time.time())
+        )
+
+    def failures(self):
+        """
+        Get all urls whose last download attempt failed.
+
+        :return: list of sqlite3.Row with url, status and attempted; oldest first
+        """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT url, status, attempted FROM downloads WHERE status NOT IN (200, 304) ORDER BY attempted'
+            ).fetchall()
+
+    def evict(self):
+        """
+        Delete the least recently used validators beyond the configured number of entries.
+
+        :return: number of deleted entries
+        """
+        with self.lock:
+            count = self.connection.execute('SELECT COUNT(*) FROM validators').fetchone()[0]
+            excess = count - self.max_validators
+            if excess <= 0:
+                return 0
+            self.connection.execute(
+                'DELETE FROM validators WHERE url IN (SELECT url FROM validators ORDER BY last_used LIMIT ?)',
+                (excess,)
+            )
+            return excess
+
+    def flush(self):
+        """
+        Evict old entries and commit, e.g. between the input files of the daemon.
+
+        :return:
+        """
+        self.evict()
+        with self.lock:
+            self.connection.commit()
+            self.changes = 0
+
+    def close(self):
+        """
+        Evict old entries, commit and close the database.
+
+        :return:
+        """
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+def already_done(url, outpath, config, run):
+    """
+    Check the state store whether an url was downloaded recently and the file is still there, or with --no_clobber
+    the index of the output directory whether the file exists at all.
+
+    This needs no network I/O, just a set lookup or a database lookup and a stat call.
+
+    :param url: the url to download
+    :param outpath: path the url is written to
+    :param config: dictionary of configuration values
+    :param run: resources shared by all downloads of the run
+    :return: bool
+    """
+    if run['index'] is not None and outpath in run['index']:
+        return True
+    if run['state'] is None:
+        return False
+
+    row = run['state'].get_download(url)
+    if row is None or row['status'] not in (200, 304) or row['path'] != outpath:
+        return False
+    if time.time() - row['attempted'] > config.get('recheck_after', 86400):
+        return False
+
+    try:
+        return os.path.getsize(outpath) == row['size']
+    except OSError:
+        return False
+
+
+def skip_done(url, outpath, logger, run):
+    """
+    Log and count an url skipped because it was downloaded recently.
+
+    :param url: the skipped url
+    :param outpath: path of the existing file
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the run
+    :return:
+    """
+    run['stats'].increment('skipped')
+    logger.info("Skipping %s, already downloaded to %s" % (url, outpath))
+
+
+def record_result(url, outpath, status, run, size=None, sha256=None):
+    """
+    Record a download attempt in the state store if there is one.
+
+    :param url: the url
+    :param outpath: the output path of the url
+    :param status: HTTP status, 0 if there was no (complete or wanted) response
+    :param run: resources shared by all downloads of the run
+    :param size: number of bytes written
+    :param sha256: hex digest of the file content
+    :return:
+    """
+    run['stats'].count_status(status)
+    if status == 200:
+        run['scheduler'].forget(url)
+    if run['state'] is not None:
+        run['state'].record_download(url, outpath, status, size, sha256)
+
+
+def list_failures(config, stream=sys.stdout):
+    """
+    Write the urls whose last download failed to a stream, one per line with status and time of the attempt.
+
+    The url comes first so the output can be used as input file again.
+
+    :param config: dictionary of configuration values
+    :param stream: stream to write to
+    :return:
+    """
+    state = StateStore(config['state_file'], config.get('cache_size', 100000))
+    try:
+        for row in state.failures():
+            stream.write('%s\t%d\t%s\n' % (
+                row['url'], row['status'], time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(row['attempted']))
+            ))
+    finally:
+        state.close()
+
+
+def over_quota(usage, config):
+    """
+    Check if the downloaded files exceed the quota of the output directory.
+
+    :param usage: tuple of the number of files and their size in bytes
+    :param config: dictionary of configuration values
+    :return: bool
+    """
+    count, size = usage
+    return bool(config.get('quota_files') and count > config['quota_files'] or
+                config.get('quota_bytes') and size > config['quota_bytes'])
+
+
+def evict_output(config, logger, run):
+    """
+    Delete the least recently used downloads until the output directory is within its quota again.
+
+    Only the index in the state file is looked at, never the whole directory, and only as many files as have to go.
+    Before a file is deleted its access time is checked: a file the web server read since it was last used gets
+    another chance. Most filesystems are mounted with relatime, which updates the access time about once a day; with
+    noatime the least recently downloaded files go first.
+
+    Deleting a file doesn't disturb a web server reading it at the moment, the open file stays readable until it is
+    closed. Files are only ever replaced by renaming, so nobody sees a partial one either. In the link storage modes a
+    blob is deleted with the last downloaded file of its content; the quota counts the size of every link, so it
+    errs on the safe side.
+
+    :param config: dictionary of configuration values
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the run
+    :return: number of evicted files
+    """
+    state = run['state']
+    if state is None or not (config.get('quota_bytes') or config.get('quota_files')):
+        return 0
+
+    count, size = state.usage()
+    evicted = 0
+    while over_quota((count, size), config):
+        rows = state.least_used(EVICTION_BATCH)
+        if not rows:
+            break
+        for row in rows:
+            if not over_quota((count, size), config):
+                break
+            try:
+                info = os.stat(row['path'])
+                linked = os.path.islink(row['path']) or info.st_nlink > 1
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                info, linked = None, False
+            # read since it was last used; a file used at the same time as it was downloaded isn't
+            if info is not None and info.st_atime > row['used'] + 1:
+                state.use_file(row['path'], info.st_atime)
+                continue
+
+            if info is not None:
+                os.unlink(row['path'])
+                if run['index'] is not None:
+                    run['index'].discard(row['path'])
+                evicted += 1
+                run['stats'].increment('evicted')
+                run['stats'].increment('bytes_evicted', row['size'])
+            state.forget_file(row['path'])
+            count, size = count - 1, size - row['size']
+            if linked and row['sha256'] and not state.content_used(row['sha256']):
+                try:
+                    os.unlink(os.path.join(blob_directory(config), row['sha256'][:2], row['sha256']))
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+
+    if evicted:
+        logger.info('Evicted %d least recently used files to stay within the quota' % evicted)
+    return evicted
+
+
+def conditional_headers(url, outpath, run):
+    """
+    Get the headers for a conditional request if a previous download of the url exists.
+
+    Without the file a 304 response would leave us with nothing, so request unconditionally then.
+
+    :param url: the url to request
+    :param outpath: path the url is written to
+    :param run: resources shared by all downloads of the run
+    :return: dictionary of request headers
+    """
+    headers = {}
+    if run['state'] is None or not os.path.isfile(outpath):
+        return headers
+
+    etag, last_modified = run['state'].get_validators(url)
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def store_validators(url, headers, run):
+    """
+    Remember the cache validators of a successful download.
+
+    :param url: the downloaded url
+    :param headers: case insensitive dictionary of response headers
+    :param run: resources shared by all downloads of the run
+    :return:
+    """
+    if run['state'] is not None:
+        run['state'].set_validators(url, headers.get('etag'), headers.get('last-modified'))
+
+
+def not_modified(url, outpath, logger, run):
+    """
+    Handle a 304 response: the file from the last download is still current.
+
+    :param url: the requested url
+    :param outpath: path of the existing file
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the run
+    :return:
+    """
+    run['stats'].increment('not_modified')
+    run['stats'].count_status(304)
+    run['scheduler'].forget(url)
+    if run['state'] is not None:
+        run['state'].touch(url)
+        run['state'].record_not_modified(url)
+    logger.info("S:304 not modified, keeping file %s ... " % outpath)
+
+
+class TokenBucket(object):
+    """
+    Allow 'rate' requests per second on average, with bursts of up to 'burst' requests after a pause.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        Start with a full bucket.
+
+        :param rate: requests per second, 0 for no limit
+        :param burst: size of the bucket
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def wait_time(self, now):
+        """
+        Get the time until the next request is allowed.
+
+        :param now: current time
+        :return: seconds, 0 if a request is allowed now
+        """
+        if not self.rate:
+            return 0
+        # the clock may be read before the bucket was created
+        self.tokens = min(self.burst, self.tokens + max(now - self.updated, 0) * self.rate)
+        self.updated = max(now, self.updated)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """
+        Use up a request.
+
+        :return:
+        """
+        if self.rate:
+            self.tokens -= 1
+
+
+def retry_after(headers, now=None):
+    """
+    Get the pause a server asked for in the Retry-After header.
+
+    :param headers: case insensitive dictionary of response headers
+    :param now: current time
+    :return: seconds, None if the header is missing or invalid
+    """
+    value = headers.get('retry-after', '').strip()
+    if value.isdigit():
+        return int(value)
+    parsed = email.utils.parsedate_tz(value) if value else None
+    if parsed is None:
+        return None
+    return max(email.utils.mktime_tz(parsed) - (time.time() if now is None else now), 0)
+
+
+class HostScheduler(object):
+    """
+    Hand out urls so the hosts are interleaved and each host gets only as many requests as it allows.
+
+    Urls are queued per host and the hosts take turns. Every host has a token bucket with the 'host_rate' and
+    'host_burst' of the configuration, or the limits configured for it in 'host_limits'. A host answering with 429 or
+    503 is paused for as long as its Retry-After header says; without one the pause doubles with every further
+    throttled response, up to MAX_BACKOFF either way.
+
+    Urls to retry are deferred in a heap ordered by the time they are due; once due they go to the front of their
+    host's queue. So retries are interleaved with new urls and nobody waits for them.
+    """
+
+    def __init__(self, config, deadline=None):
+        """
+        Initialize an empty scheduler.
+
+        :param config: dictionary of configuration values
+        :param deadline: time the run ends at, None if it has no deadline
+        """
+        self.deadline = deadline
+        self.rate = config.get('host_rate', 0)
+        self.burst = config.get('host_burst', 1)
+        self.limits = config.get('host_limits') or {}
+        self.lock = threading.Lock()
+        self.queues = collections.OrderedDict()
+        self.buckets = {}
+        self.paused = {}
+        self.strikes = collections.Counter()
+        self.failures = collections.Counter()
+        self.deferred = []
+        self.attempts = collections.Counter()
+        self.count = 0
+
+    @staticmethod
+    def host(url):
+        """
+        Get the host of an url to schedule it by.
+
+        :param url: the url
+        :return: lowercase host and port
+        """
+        return urlparse(url)[1].lower()
+
+    def bucket(self, host):
+        """
+        Get the token bucket of a host, created on first use.
+
+        :param host: lowercase host and port
+        :return: TokenBucket
+        """
+        if host not in self.buckets:
+            limit = self.limits.get(host) or self.limits.get(host.rsplit(':', 1)[0]) or {}
+            self.buckets[host] = TokenBucket(limit.get('rate', self.rate), limit.get('burst', self.burst))
+        return self.buckets[host]
+
+    def add(self, url):
+        """
+        Queue an url.
+
+        :param url: the url
+        :return:
+        """
+        host = self.host(url)
+        with self.lock:
+            self.queues.setdefault(host, collections.deque()).append(url)
+            self.count += 1
+
+    def defer(self, url, seconds):
+        """
+        Queue an url again after a while.
+
+        :param url: the url
+        :param seconds: time to wait before the url is due
+        :return:
+        """
+        with self.lock:
+            heapq.heappush(self.deferred, (time.time() + seconds, url))
+            self.count += 1
+
+    def failed(self, url):
+        """
+        Count a failed attempt to download an url.
+
+        :param url: the url
+        :return: number of failed attempts so far
+        """
+        with self.lock:
+            self.attempts[url] += 1
+            return self.attempts[url]
+
+    def forget(self, url):
+        """
+        Forget the failed attempts of an url which is done.
+
+        :param url: the url
+        :return: number of failed attempts
+        """
+        with self.lock:
+            return self.attempts.pop(url, 0)
+
+    def attempted(self, url):
+        """
+        Get the number of failed attempts of an url.
+
+        :param url: the url
+        :return: int
+        """
+        with self.lock:
+            return self.attempts[url]
+
+    def retrying(self, url):
+        """
+        Check whether an url failed and is going to be retried.
+
+        :param url: the url
+        :return: bool
+        """
+        with self.lock:
+            return url in self.attempts
+
+    def pending(self):
+        """
+        Get the number of queued urls, including the deferred ones.
+
+        :return: int
+        """
+        with self.lock:
+            return self.count
+
+    def pop(self, busy=None):
+        """
+        Take the next url whose host allows a request now.
+
+        :param busy: function telling whether a host has no free connection, default: no host is busy
+        :return: tuple of the url, or None if no host is ready, and the seconds until the next host or deferred url is
+                 ready, or None if all hosts with queued urls are busy
+        """
+        now = time.time()
+        soonest = None
+        with self.lock:
+            while self.deferred and self.deferred[0][0] <= now:
+                url = heapq.heappop(self.deferred)[1]
+                host = self.host(url)
+                if host not in self.queues:
+                    self.queues[host] = collections.deque()
+                self.queues[host].appendleft(url)
+            if self.deferred:
+                soonest = self.deferred[0][0] - now
+
+            for host in list(self.queues):
+                if busy is not None and busy(host):
+                    continue
+                bucket = self.bucket(host)
+                wait = max(self.paused.get(host, 0) - now, bucket.wait_time(now))
+                if wait <= 0:
+                    queue = self.queues.pop(host)
+                    url = queue.popleft()
+                    # the host goes to the end of the line
+                    if queue:
+                        self.queues[host] = queue
+                    self.count -= 1
+                    bucket.take()
+                    return url, 0
+                soonest = wait if soonest is None else min(soonest, wait)
+        return None, soonest
+
+    def backoff(self, url, seconds=None):
+        """
+        Pause the host of an url which asked to slow down.
+
+        :param url: the throttled url
+        :param seconds: pause the server asked for, None to double the last one
+        :return:
+        """
+        host = self.host(url)
+        with self.lock:
+            self.strikes[host] += 1
+            if seconds is None:
+                seconds = 2 ** (self.strikes[host] - 1)
+            seconds = min(seconds, MAX_BACKOFF)
+            self.paused[host] = max(self.paused.get(host, 0), time.time() + seconds)
+
+    def overdue(self):
+        """
+        Take the urls out which can't be started before the deadline: the ones of hosts paused until after it, and
+        all of them once it has passed.
+
+        :return: list of urls
+        """
+        if self.deadline is None:
+            return []
+        now = time.time()
+        with self.lock:
+            if now >= self.deadline:
+                hosts = set(self.queues).union(self.host(item[1]) for item in self.deferred)
+            else:
+                hosts = set(host for host, until in self.paused.items() if until >= self.deadline)
+            urls = []
+            for host in hosts.intersection(self.queues):
+                urls.extend(self.queues.pop(host))
+            deferred = [item for item in self.deferred if self.host(item[1]) not in hosts]
+            if len(deferred) < len(self.deferred):
+                urls.extend(item[1] for item in self.deferred if self.host(item[1]) in hosts)
+                heapq.heapify(deferred)
+                self.deferred = deferred
+            self.count -= len(urls)
+            return urls
+
+    def reset(self, url):
+        """
+        Forget the throttling of the host of an url after a normal response.
+
+        :param url: the url
+        :return:
+        """
+        host = self.host(url)
+        with self.lock:
+            if host in self.strikes:
+                del self.strikes[host]
+
+    def connect_failed(self, url):
+        """
+        Count a failed connection to the host of an url.
+
+        :param url: the url
+        :return: number of failed connections to the host in a row
+        """
+        host = self.host(url)
+        with self.lock:
+            self.failures[host] += 1
+            return self.failures[host]
+
+    def unreachable(self, url):
+        """
+        Tell whether the host of an url failed to connect UNREACHABLE_AFTER times in a row.
+
+        :param url: the url
+        :return: bool
+        """
+        with self.lock:
+            return self.failures[self.host(url)] >= UNREACHABLE_AFTER
+
+    def reachable(self, url):
+        """
+        Forget the failed connections of the host of an url which answered.
+
+        :param url: the url
+        :return:
+        """
+        host = self.host(url)
+        with self.lock:
+            if host in self.failures:
+                del self.failures[host]
+
+
+def throttle(url, status, headers, run, logger):
+    """
+    Let the scheduler know how the host of an url answered.
+
+    :param url: the requested url
+    :param status: HTTP status of the response
+    :param headers: case insensitive dictionary of response headers
+    :param run: resources shared by all downloads of the run
+    :param logger: logger for output
+    :return:
+    """
+    run['scheduler'].reachable(url)
+    if status in THROTTLE_CODES:
+        seconds = retry_after(headers)
+        if seconds is not None:
+            seconds = min(seconds, MAX_BACKOFF)
+        run['scheduler'].backoff(url, seconds)
+        run['stats'].increment('throttled')
+        logger.warn('S:%d %s asks to slow down, pausing it%s' % (
+            status, HostScheduler.host(url), ' for %ds' % seconds if seconds is not None else ''
+        ))
+    else:
+        run['scheduler'].reset(url)
+
+
+def connect_failed(url, run, logger):
+    """
+    Let the scheduler know the host of an url couldn't be connected to.
+
+    :param url: the requested url
+    :param run: resources shared by all downloads of the run
+    :param logger: logger for output
+    :return:
+    """
+    if run['scheduler'].connect_failed(url) == UNREACHABLE_AFTER:
+        logger.warn('%s failed to connect %d times in a row, not retrying its urls anymore' % (
+            HostScheduler.host(url), UNREACHABLE_AFTER
+        ))
+
+
+def scheduled(lines, scheduler, slots, overdue=None, busy=None):
+    """
+    Read urls ahead into the scheduler and pass them on in the order it hands them out.
+
+    Generator
+
+    Every url read takes one of the slots, the caller releases it when the url is done; an url deferred for a retry
+    keeps its slot. So the number of urls read ahead plus the ones in progress stays bounded.
+
+    :param lines: iterable of urls
+    :param scheduler: HostScheduler
+    :param slots: semaphore limiting the number of urls read but not done
+    :param overdue: function called with the urls which can't be started before the deadline, default: drop them
+    :param busy: function telling whether a host has no free connection, default: no host is busy
+    :return: iterator over urls
+    """
+    lines = iter(lines)
+    exhausted = False
+    while True:
+        for url in scheduler.overdue():
+            slots.release()
+            if overdue is not None:
+                overdue(url)
+
+        # read ahead while there are free slots; with nothing queued wait for a slot to become free
+        while not exhausted and slots.acquire(not scheduler.pending()):
+            try:
+                scheduler.add(next(lines))
+            except StopIteration:
+                slots.release()
+                exhausted = True
+
+        url, delay = scheduler.pop(busy)
+        if url is not None:
+            yield url
+        elif exhausted and not scheduler.pending():
+            return
+        else:
+            # urls done in the meantime free slots to read more and connections of busy hosts
+            time.sleep(min(delay, 1) if delay is not None else BUSY_POLL)
+
+
+def retry_delay(attempts, config):
+    """
+    Get the time to wait before retrying an url: exponential backoff with jitter, so urls failing together aren't
+    retried together.
+
+    :param attempts: number of failed attempts so far
+    :param config: dictionary of configuration values
+    :return: seconds
+    """
+    delay = min(config.get('retry_delay', 1) * 2 ** (attempts - 1), MAX_BACKOFF)
+    return random.uniform(delay / 2.0, delay)
+
+
+def defer_url(url, why, logger, run):
+    """
+    Leave an url to the next run: it is written to the rejected file as 'deferred', which --skip_rejected doesn't skip.
+
+    :param url: the url
+    :param why: why it can't be done in this run
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the run
+    :return:
+    """
+    attempts = run['scheduler'].forget(url)
+    run['stats'].increment('deferred')
+    logger.info('Deferring %s, %s' % (url, why))
+    if run['rejected'] is not None:
+        run['rejected'].add(url, 0, attempts, 'deferred')
+
+
+def retry_or_reject(url, status, reason, transient, config, logger, run):
+    """
+    Retry an url later after a transient failure, or give up on it.
+
+    Urls given up on are counted as failed and written to the rejected file if there is one, so are the urls of a host
+    which is unreachable. A retry which wouldn't be before the deadline is left to the next run instead.
+
+    :param url: the url which failed
+    :param status: HTTP status, 0 if there was no (complete) response
+    :param reason: short description of the failure
+    :param transient: whether the failure may go away later
+    :param config: dictionary of configuration values
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the run
+    :return:
+    """
+    attempts = run['scheduler'].failed(url)
+    delay = retry_delay(attempts, config)
+    if transient and attempts <= config.get('retries', 3) and not run['scheduler'].unreachable(url):
+        if run['deadline'] is not None and time.time() + delay > run['deadline']:
+            defer_url(url, 'the retry won\'t be before the deadline', logger, run)
+            return
+        run['scheduler'].defer(url, delay)
+        run['stats'].increment('retried')
+        logger.info('Retrying %s in %.1fs, attempt %d of %d' % (url, delay, attempts + 1, config.get('retries', 3) + 1))
+        return
+
+    run['scheduler'].forget(url)
+    run['stats'].increment('failed')
+    if run['rejected'] is not None:
+        run['rejected'].add(url, status, attempts, reason)
+
+
+class RejectedFile(object):
+    """
+    Append the urls given up on to a file, one per line with status, number of attempts and reason separated by tabs.
+
+    The url comes first so the file can be used as input file again.
+    """
+
+    def __init__(self, path):
+        """
+        The file is only opened once there is something to write.
+
+        :param path: path of the file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.outfile = None
+
+    def urls(self):
+        """
+        Read the urls rejected so far; the ones only deferred by the plan of a run aren't given up on.
+
+        :return: set of urls
+        """
+        try:
+            with open(self.path) as infile:
+                return set(line.split('\t', 1)[0] for line in infile
+                           if line.strip() and not line.rstrip('\n').endswith('\tdeferred'))
+        except IOError:
+            return set()
+
+    def deferred(self):
+        """
+        Read the urls deferred to the next run so far.
+
+        :return: tuple of the list of urls, each once in the order they were deferred, and the number of bytes read
+        """
+        urls = collections.OrderedDict()
+        size = 0
+        try:
+            with open(self.path) as infile:
+                for line in iter(infile.readline, ''):
+                    size += len(line)
+                    if line.rstrip('\n').endswith('\tdeferred'):
+                        urls[line.split('\t', 1)[0]] = True
+        except IOError:
+            pass
+        return list(urls), size
+
+    def forget_deferred(self, size):
+        """
+        Remove the deferred urls from the start of the file once a run took care of them; the lines written after it
+        are kept, so are the urls deferred again.
+
+        :param size: number of bytes at the start of the file to remove the deferred urls from
+        :return:
+        """
+        with self.lock:
+            # the rest is written to a new file, which is renamed over this one
+            if self.outfile is not None:
+                self.outfile.close()
+                self.outfile = None
+            temppath = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(self.path) as infile:
+                with open(temppath, 'w') as outfile:
+                    while size > 0:
+                        line = infile.readline()
+                        if not line:
+                            break
+                        size -= len(line)
+                        if not line.rstrip('\n').endswith('\tdeferred'):
+                            outfile.write(line)
+                    shutil.copyfileobj(infile, outfile)
+            os.rename(temppath, self.path)
+
+    def add(self, url, status, attempts, reason):
+        """
+        Write a rejected url.
+
+        :param url: the url
+        :param status: HTTP status, 0 if there was no (complete) response
+        :param attempts: number of attempts
+        :param reason: short description of the failure
+        :return:
+        """
+        with self.lock:
+            if self.outfile is None:
+                self.outfile = open(self.path, 'a')
+            self.outfile.write('%s\t%d\t%d\t%s\n' % (url, status, attempts, ' '.join(reason.split())))
+            # the file is also read while the run continues, e.g. by a daemon's next input file
+            self.outfile.flush()
+
+    def close(self):
+        """
+        Close the file.
+
+        :return:
+        """
+        with self.lock:
+            if self.outfile is not None:
+                self.outfile.close()
+                self.outfile = None
+
+
+class HostLimiter(object):
+    """
+    Limit the number of parallel connections per host.
+
+    Every host gets its own semaphore which is created on first use. The lock only guards the creation of the
+    semaphores, waiting for a free connection slot happens outside of it.
+
+    Alternatively the downloads handed to workers are counted per host, so the scheduler can skip the busy hosts
+    instead of a worker waiting for one.
+    """
+
+    def __init__(self, limit):
+        """
+        Initialize an empty limiter.
+
+        :param limit: maximum number of parallel connections to a single host
+        """
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.active = collections.Counter()
+
+    def semaphore(self, url):
+        """
+        Get the semaphore for the host of an url.
+
+        :param url: the url to be downloaded
+        :return: semaphore object to be used as context manager
+        """
+        host = urlparse(url)[1].lower()
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[host]
+
+    def busy(self, host):
+        """
+        Tell whether a host has no free connection.
+
+        :param host: lowercase host and port
+        :return: bool
+        """
+        with self.lock:
+            return self.active[host] >= self.limit
+
+    def take(self, url):
+        """
+        Count a download of an url handed to a worker.
+
+        :param url: the url to be downloaded
+        :return:
+        """
+        with self.lock:
+            self.active[urlparse(url)[1].lower()] += 1
+
+    def release(self, url):
+        """
+        Count a download of an url as done.
+
+        :param url: the downloaded url
+        :return:
+        """
+        host = urlparse(url)[1].lower()
+        with self.lock:
+            self.active[host] -= 1
+            if not self.active[host]:
+                del self.active[host]
+
+
+def process_line_limited(line, config, logger, run, limiter, slots):
+    """
+    Process a line of input in a worker thread, counted in the connections of the url's host until it is done.
+
+    Exceptions would otherwise vanish silently inside the thread pool, so log them here.
+
+    :param line: a line of input containing a url
+    :param config: the config dictionary
+    :param logger: the logger for output
+    :param run: resources shared by all downloads of the run
+    :param limiter: HostLimiter shared by all workers, the url was taken from it
+    :param slots: semaphore limiting the number of queued urls; released when done unless the url is retried
+    :return:
+    """
+    try:
+        process_line(line, config, logger, run)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.error('Exception downloading %s: %s' % (line, str(exc)))
+    finally:
+        limiter.release(line)
+        if not run['scheduler'].retrying(line):
+            slots.release()
+
+
+def download_parallel(lines, config, logger, run):
+    """
+    Download the urls with a pool of worker threads.
+
+    Downloads are mostly waiting for the network so threads are sufficient here despite the GIL. All workers share
+    the session of the run, so connections to a host are reused across threads.
+
+    The scheduler reads up to 'queue_size' urls ahead, counting the running ones, and hands them to the workers so
+    the hosts are interleaved and their rate limits are kept; hosts with 'host_connections' downloads in the workers
+    are skipped. That way the input is only read as fast as it is downloaded, and no worker waits for a busy host.
+
+    :param lines: iterable of urls
+    :param config: dictionary of configuration values
+    :param logger: logger for output
+    :param run: resources shared by all downloads of the run
+    :return: None
+    """
+    limiter = HostLimiter(config['host_connections'])
+    # there is no point in a queue shorter than the number of workers
+    slots = threading.BoundedSemaphore(max(config.get('queue_size', 100), config['workers']))
+    # urls are only taken from the scheduler when a worker is free, so they are requested when the scheduler says
+    idle = threading.Semaphore(config['workers'])
+
+    def overdue(url):
+        defer_url(url, OVERDUE, logger, run)
+
+    urls = until_stopped(scheduled(lines, run['scheduler'], slots, overdue, limiter.busy), run['stop'])
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # leaving the with block waits for all submitted downloads to finish
+    with ThreadPoolExecutor(max_workers=config['workers']) as executor:
+        while True:
+            idle.acquire()
+            line = next(urls, None)
+            if line is None:
+                # the running downloads may still defer retries; wait until all workers are idle and look again
+                for _ in range(config['workers'] - 1):
+                    idle.acquire()
+                for _ in range(config['workers']):
+                    idle.release()
+                if run['stop'].is_set() or not run['scheduler'].pending():
+                    break
+                urls = until_stopped(scheduled([], run['scheduler'], slots, overdue, limiter.busy), run['stop'])
+                continue
+            # counted before the next url is taken from the scheduler
+            limiter.take(line)
+            future = executor.submit(process_line_limited, line, config, logger, run, limiter, slots)
+            future.add_done_callback(lambda future: idle.release())
+
+
+class AsyncDownload(asyncore.dispatcher):
+    """
+    Download a single url on a non-blocking socket driven by the asyncore event loop.
+
+    The request is sent as HTTP/1.0 with "Connection: close", so the server can't answer with a chunked body and the
+    body simply ends with the content length or the connection. That keeps the protocol handling small enough to do
+    without an HTTP library.
+    """
+
+    # follow redirects like requests does by default
+    max_redirects = 30
+    redirect_codes = (301, 302, 303, 307, 308)
+    # refuse absurdly large response headers instead of buffering them forever
+    max_head_size = 65536
+    read_size = 65536
+
+    def __init__(self, url, config, logger, engine, name_url=None, redirects=0, started=None):
+        """
+        Prepare the download; the connection is opened by start().
+
+        :param url: the url to request
+        :param config: the config dictionary
+        :param logger: the logger for output
+        :param engine: the AsyncEngine owning the socket map, ssl context and run resources
+        :param name_url: url to generate the filename from; differs from url after redirects
+        :param redirects: number of redirects followed so far
+        :param started: time the first request for the url was started, for the latency of redirected downloads
+        """
+        asyncore.dispatcher.__init__(self, map=engine.socket_map)
+        self.url = url
+        self.name_url = name_url or url
+        self.config = config
+        self.logger = logger
+        self.engine = engine
+        self.redirects = redirects
+        self.started = started or time.time()
+        # the first request goes to a peer of the fleet if it isn't for the url itself
+        self.from_peer = url != self.name_url and not redirects
+
+        parsed = urlparse(url)
+        self.scheme = parsed.scheme.lower()
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.scheme == 'https' else 80)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        self.outpath = generate_filename(self.name_url, config['output_dir'], config.get('layout', 'flat'))
+        self.partpath = partial_path(self.outpath)
+        self.offset = resume_offset(self.partpath)
+        headers = conditional_headers(self.name_url, self.outpath, engine.resources)
+        headers.update(range_headers(self.offset, load_validator(self.partpath)))
+        self.outbuffer = 'GET %s HTTP/1.0\r\nHost: %s\r\nAccept: */*\r\nConnection: close\r\n%s\r\n' % (
+            path, parsed.netloc.rpartition('@')[2], ''.join('%s: %s\r\n' % item for item in headers.items())
+        )
+        self.head = ''
+        self.status = None
+        self.headers = {}
+        self.outfile = None
+        # the first bytes of the body, held back until they tell its type
+        self.pending = None
+        self.unwanted = False
+        self.remaining = None
+        self.start_offset = 0
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.connect_started = self.handshake_started = self.body_started = None
+        self.write_seconds = 0
+        self.handshaking = False
+        self.want_write = False
+        self.successor = None
+        self.failure = None
+        self.finished = False
+        self.last_activity = time.time()
+
+    def start(self):
+        """
+        Resolve the host and start connecting.
+
+        Name resolution is blocking, the engine caches the results per host.
+
+        :return:
+        """
+        if self.scheme not in ('http', 'https') or not self.host:
+            raise ValueError('Not a valid http(s) url: %s' % self.url)
+
+        family, socktype, address = self.engine.resolve(self.host, self.port)
+        self.create_socket(family, socktype)
+        self.connect_started = time.time()
+        self.connect(address)
+
+    def handle_connect(self):
+        """
+        Wrap the connected socket for https; the handshake itself is driven by the read and write events.
+
+        :return:
+        """
+        self.handshake_started = time.time()
+        self.engine.stats.observe('connect', self.handshake_started - self.connect_started)
+        if self.scheme == 'https':
+            self.socket = self.engine.ssl_context.wrap_socket(
+                self.socket, server_hostname=self.host, do_handshake_on_connect=False
+            )
+            self.handshaking = True
+            self.want_write = True
+
+    def do_handshake(self):
+        """
+        Advance the TLS handshake as far as possible without blocking.
+
+        :return:
+        """
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self.want_write = False
+            return
+        except ssl.SSLWantWriteError:
+            self.want_write = True
+            return
+
+        self.handshaking = False
+        self.want_write = False
+        self.engine.stats.observe('tls', time.time() - self.handshake_started)
+
+    def writable(self):
+        """
+        Only wait for write events while connecting, handshaking or sending the request.
+
+        :return: bool
+        """
+        if not self.connected:
+            return True
+        if self.handshaking:
+            return self.want_write
+        return bool(self.outbuffer)
+
+    def handle_write(self):
+        """
+        Send the request.
+
+        :return:
+        """
+        self.last_activity = time.time()
+        if self.handshaking:
+            self.do_handshake()
+            return
+
+        try:
+            sent = self.send(self.outbuffer)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        self.outbuffer = self.outbuffer[sent:]
+
+    def handle_read(self):
+        """
+        Read everything available; ssl sockets may hold decrypted data the select call doesn't know about.
+
+        :return:
+        """
+        self.last_activity = time.time()
+        if self.handshaking:
+            self.do_handshake()
+            return
+
+        while not self.finished:
+            try:
+                data = self.recv(self.read_size)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+            except ssl.SSLEOFError:
+                # server closed the connection without a proper TLS shutdown; treat it like a closed connection
+                self.handle_close()
+                return
+            if not data:
+                return
+            self.feed(data)
+            if not self.finished and not getattr(self.socket, 'pending', lambda: 0)():
+                return
+
+    def feed(self, data):
+        """
+        Split response header and body and process them.
+
+        :param data: bytes received
+        :return:
+        """
+        if self.status is None:
+            self.head += data
+            if '\r\n\r\n' not in self.head:
+                if len(self.head) > self.max_head_size:
+                    raise IOError('Response header too large')
+                return
+            head, data = self.head.split('\r\n\r\n', 1)
+            self.handle_head(head)
+
+        if data and not self.finished:
+            self.handle_body(data)
+
+    def handle_head(self, head):
+        """
+        Parse the response header and decide what to do with the body.
+
+        :param head: response status line and header lines
+        :return:
+        """
+        lines = head.split('\r\n')
+        self.status = int(lines[0].split(None, 2)[1])
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+
+        # like requests, count the time to the first byte of the final response from the first request
+        if self.status not in self.redirect_codes:
+            self.engine.stats.observe('first_byte', time.time() - self.started)
+        if not self.from_peer:
+            throttle(self.url, self.status, self.headers, self.engine.resources, self.logger)
+
+        if self.status in self.redirect_codes and 'location' in self.headers and \
+                self.redirects < self.max_redirects:
+            self.successor = urljoin(self.url, self.headers['location'])
+            self.finish()
+
+        # If it worked then
+        elif resumed_at(self.status, self.headers, self.offset) is not None:
+            start = resumed_at(self.status, self.headers, self.offset)
+            # the announced size is enough to refuse the body
+            reason = unwanted_content(None, start + (content_length(self.headers) or 0), self.config)
+            if reason:
+                self.reject(reason)
+                return
+            if start or not self.config.get('mime_types'):
+                self.open_output(start)
+            else:
+                self.pending = ''
+            if 'content-length' in self.headers:
+                self.remaining = int(self.headers['content-length'])
+                if self.remaining == 0:
+                    self.handle_body('')
+
+        # the file from the last run is still current
+        elif self.status == 304:
+            discard_partial(self.partpath)
+            not_modified(self.name_url, self.outpath, self.logger, self.engine.resources)
+            self.finish()
+
+        # Status other than 200 = OK so request failed
+        else:
+            # the server can't continue the partial download, start over next time
+            if self.status == 416:
+                discard_partial(self.partpath)
+            self.logger.warn("S:%d ERROR downloading %s\n" % (
+                self.status, self.url if self.from_peer else self.name_url
+            ))
+            self.fail('HTTP %d' % self.status, self.from_peer or self.status in TRANSIENT_CODES)
+
+    def open_output(self, start):
+        """
+        Open the partial download for writing the response body.
+
+        :param start: offset of the response body in the file
+        :return:
+        """
+        self.start_offset = start
+        self.body_started = time.time()
+        if start:
+            self.engine.stats.increment('resumed')
+            self.logger.info("S:%d resuming file %s at byte %d ... " % (self.status, self.outpath, start))
+            # the hash has to cover the part downloaded before
+            self.digest = hash_file(self.partpath)
+            self.size = start
+            self.outfile = open(self.partpath, 'ab')
+        else:
+            self.logger.info("S:%d writing file %s ... " % (self.status, self.outpath))
+            save_validator(self.partpath, self.headers)
+            make_directory(os.path.dirname(self.partpath))
+            self.outfile = open(self.partpath, 'wb')
+        preallocate(self.outfile, start, content_length(self.headers))
+
+    def handle_body(self, data, end=False):
+        """
+        Write a piece of the response body to the output file.
+
+        The output file of a new download is only opened once the first MAGIC_SNIFF_SIZE bytes show it is of one of
+        the wanted types.
+
+        :param data: bytes of the response body
+        :param end: whether the connection was closed, i.e. no more bytes follow
+        :return:
+        """
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+
+        if self.pending is not None:
+            self.pending += data
+            if len(self.pending) < MAGIC_SNIFF_SIZE and self.remaining != 0 and not end:
+                return
+            data, self.pending = self.pending, None
+            reason = unwanted_content(data, len(data), self.config)
+            if reason:
+                self.reject(reason)
+                return
+            self.open_output(0)
+
+        if self.outfile is None:
+            return
+        reason = unwanted_content(None, self.size + len(data), self.config)
+        if reason:
+            self.reject(reason)
+            return
+        before = time.time()
+        self.outfile.write(data)
+        self.write_seconds += time.time() - before
+        self.size += len(data)
+        self.digest.update(data)
+
+        if self.remaining == 0:
+            self.finish()
+
+    def handle_close(self):
+        """
+        Connection closed by the server, without a content length this is the end of the body.
+
+        :return:
+        """
+        if self.status is None and not self.finished:
+            self.logger.error('Exception downloading %s: connection closed without response' % self.name_url)
+            self.fail('connection closed without response', True)
+        elif self.pending is not None:
+            self.handle_body('', True)
+        self.finish()
+
+    def handle_error(self):
+        """
+        Log any exception raised in the event handlers and give up on this attempt; network errors are retried.
+
+        :return:
+        """
+        exc = sys.exc_info()[1]
+        self.logger.error('Exception downloading %s: %s' % (self.name_url, str(exc)))
+        self.fail(str(exc), self.from_peer or isinstance(exc, socket.error))
+
+    def reject(self, reason):
+        """
+        Give up on a download which isn't wanted; closing the connection stops the transfer of the body.
+
+        :param reason: why the download isn't wanted
+        :return:
+        """
+        self.logger.warn('Aborted downloading %s: %s' % (self.url, reason))
+        self.engine.stats.increment('unwanted')
+        self.unwanted = True
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+            discard_partial(self.partpath)
+        self.fail(reason, False)
+
+    def fail(self, reason, transient):
+        """
+        Give up on this attempt; the url is retried later if the failure is transient.
+
+        :param reason: short description of the failure
+        :param transient: whether the failure may go away later
+        :return:
+        """
+        if self.failure is None:
+            self.failure = (reason, transient)
+            # a network error before the connection was established
+            if transient and not self.connected and not self.from_peer:
+                connect_failed(self.url, self.engine.resources, self.logger)
+        self.finish()
+
+    def finish(self):
+        """
+        Close connection and output file and hand back to the engine.
+
+        :return:
+        """
+        if self.finished:
+            return
+        self.finished = True
+        if self.socket is not None:
+            self.close()
+
+        run = self.engine.resources
+        if self.outfile is not None:
+            before = time.time()
+            if not self.remaining:
+                sync_file(self.outfile, self.config)
+            self.outfile.close()
+            self.write_seconds += time.time() - before
+            self.engine.stats.observe('transfer', time.time() - self.body_started - self.write_seconds)
+            self.engine.stats.observe('write', self.write_seconds)
+            self.engine.stats.increment('bytes_downloaded', self.size - self.start_offset)
+            if self.remaining:
+                # keep the partial download, the retry or the next run resumes it
+                record_result(self.name_url, self.outpath, 0, run)
+                self.logger.error('Exception downloading %s: connection closed %d bytes short' % (
+                    self.name_url, self.remaining
+                ))
+                self.failure = self.failure or ('connection closed %d bytes short' % self.remaining, True)
+            else:
+                commit_output(self.partpath, self.outpath, self.size, self.digest.hexdigest(), self.config, run)
+                store_validators(self.name_url, self.headers, run)
+                record_result(self.name_url, self.outpath, 200, run, self.size, self.digest.hexdigest())
+                self.engine.stats.increment('downloaded')
+                if self.from_peer:
+                    self.engine.stats.increment('from_peers')
+                self.logger.debug("done...")
+        elif self.successor is None and self.status != 304:
+            record_result(self.name_url, self.outpath, 0 if self.unwanted else self.status or 0, run)
+
+        if self.successor is None:
+            self.engine.stats.observe('latency', time.time() - self.started)
+        if self.failure is not None:
+            # like record_result, a response which broke off counts as no response
+            status = 0 if self.outfile is not None else self.status or 0
+            retry_or_reject(self.name_url, status, self.failure[0], self.failure[1], self.config, self.logger, run)
+
+        self.engine.done(self)
+
+
+class AsyncEngine(object):
+    """
+    Run many downloads in a single thread with the asyncore event loop.
+
+    The input is consumed lazily: urls are read ahead into the host scheduler up to 'queue_size' urls, counting the
+    ones in flight. The scheduler interleaves the hosts and keeps their rate limits; hosts that already have
+    'host_connections' downloads running are skipped until a slot frees up.
+    """
+
+    # seconds without any socket activity before a download is given up
+    idle_timeout = IDLE_TIMEOUT
+
+    def __init__(self, config, logger, run):
+        """
+        Initialize an engine without any downloads.
+
+        :param config: the config dictionary
+        :param logger: the logger for output
+        :param run: resources shared by all downloads of the run; the http session is not used here
+        """
+        self.config = config
+        self.logger = logger
+        self.resources = run
+        self.stats = run['stats']
+        self.socket_map = {}
+        self.active = collections.defaultdict(int)
+        self.scheduler = run['scheduler']
+        self.addresses = {}
+        self.ssl_context = ssl.create_default_context(cafile=requests.certs.where())
+
+    def resolve(self, host, port):
+        """
+        Resolve host and port to a socket address, caching the result for the duration of the run.
+
+        :param host: host name
+        :param port: port number
+        :return: tuple of address family, socket type and address
+        """
+        if (host, port) not in self.addresses:
+            started = time.time()
+            family, socktype, _, _, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            self.stats.observe('dns', time.time() - started)
+            self.addresses[(host, port)] = (family, socktype, address)
+        return self.addresses[(host, port)]
+
+    def run(self, lines):
+        """
+        Main loop: keep up to 'workers' downloads in flight until the input is exhausted.
+
+        :param lines: iterable of urls
+        :return: None
+        """
+        lines = iter(lines)
+        exhausted = False
+
+        while True:
+            exhausted, delay = self.fill(lines, exhausted)
+            if not self.socket_map:
+                if exhausted and (not self.scheduler.pending() or self.resources['stop'].is_set()):
+                    break
+                # every queued url waits for the rate limit of its host; look at the deadline now and then
+                time.sleep(min(delay or 0, 1))
+                continue
+
+            asyncore.loop(timeout=min(delay or 1, 1), map=self.socket_map, count=1)
+            self.expire()
+
+    def fill(self, lines, exhausted):
+        """
+        Read urls ahead and start downloads until the limits are reached.
+
+        :param lines: iterator over urls
+        :param exhausted: whether the input has been read completely already
+        :return: tuple of whether the input has been read completely and the seconds until the next host is ready,
+                 None if that depends on running downloads
+        """
+        limit = max(self.config.get('queue_size', 100), self.config['workers'])
+        while not exhausted and self.scheduler.pending() + len(self.socket_map) < limit:
+            try:
+                url = next(lines)
+            except StopIteration:
+                exhausted = True
+                break
+            self.logger.info("Loading %s ... " % url)
+
+            outpath = generate_filename(url, self.config['output_dir'], self.config.get('layout', 'flat'))
+            if already_done(url, outpath, self.config, self.resources):
+                skip_done(url, outpath, self.logger, self.resources)
+                continue
+            self.scheduler.add(url)
+
+        for url in self.scheduler.overdue():
+            defer_url(url, OVERDUE, self.logger, self.resources)
+
+        delay = None
+        while len(self.socket_map) < self.config['workers'] and not self.resources['stop'].is_set():
+            url, delay = self.scheduler.pop(
+                lambda host: self.active[host] >= self.config['host_connections']
+            )
+            if url is None:
+                break
+            self.start(source_url(url, self.config, self.resources), url)
+
+        return exhausted, delay
+
+    @staticmethod
+    def host(url):
+        """
+        Get the host of an url for the connection limit.
+
+        :param url: the url
+        :return: lowercase host and port
+        """
+        return urlparse(url)[1].lower()
+
+    def start(self, url, name_url=None, redirects=0, started=None):
+        """
+        Start a single download.
+
+        :param url: the url to request
+        :param name_url: url to generate the filename from
+        :param redirects: number of redirects followed so far
+        :param started: time the first request for the url was started
+        :return:
+        """
+        download = AsyncDownload(url, self.config, self.logger, self, name_url, redirects, started)
+        self.active[self.host(url)] += 1
+        try:
+            download.start()
+            # every download opens a connection of its own, there is no keep-alive with HTTP/1.0
+            self.stats.increment('connections_opened')
+            self.stats.increment('requests')
+        except (socket.error, ValueError) as exc:
+            self.logger.error('Exception downloading %s: %s' % (download.name_url, str(exc)))
+            download.fail(str(exc), download.from_peer or isinstance(exc, socket.error))
+
+    def done(self, download):
+        """
+        Free the connection slot of a finished download and follow a redirect if there is one.
+
+        :param download: the finished AsyncDownload
+        :return:
+        """
+        self.active[self.host(download.url)] -= 1
+        if download.successor is not None:
+            self.start(download.successor, download.name_url, download.redirects + 1, download.started)
+
+    def expire(self):
+        """
+        Give up on downloads without any activity for too long, or not connected within CONNECT_TIMEOUT.
+
+        :return:
+        """
+        now = time.time()
+        for download in list(self.socket_map.values()):
+            if download.last_activity < now - (self.idle_timeout if download.connected else CONNECT_TIMEOUT):
+                self.logger.error('Exception downloading %s: timed out' % download.name_url)
+                download.fail('timed out', True)
+
+
+def generate_filename(url, output_dir, layout='flat'):
+    """
+    Generate a sensible filename from an url and prepend output directory.
+
+    The flat name can be the same for different urls, e.g. for 'a.b/c' and 'a/b/c' or urls differing in the query
+    only. The hashed layout adds the first 8 hex digits of the url's SHA-1 to the name and puts the file into the
+    subdirectories named after the first two pairs of them, e.g. 'ab/cd/example_com_a.abcd1234.jpg'. Like the flat
+    name it only depends on the url.
+
+    :param url: a url to process
+    :param output_dir: directory to write the file to
+    :param layout: one of LAYOUTS
+    :return:
+    """
+    parsed = urlparse(url)
+    name = parsed[1].replace(".", "_").replace(":", "_") + parsed[2].replace("/", '_')
+    if layout != 'hashed':
+        return os.path.join(output_dir, name)
+
+    digest = hashlib.sha1(url).hexdigest()
+    base, extension = os.path.splitext(name)
+    return os.path.join(output_dir, digest[:2], digest[2:4], '%s.%s%s' % (base, digest[:8], extension))
+
+
+class OutputIndex(object):
+    """
+    Compact index of the files in the output directory for --no_clobber: 64-bit hashes of their paths relative to it.
+
+    The files found at the start are kept as a sorted array of 8 bytes per file and looked up by bisection; the
+    files written or deleted during the run are kept in sets next to it. Partial downloads, hidden files and the
+    blob directory aren't part of it.
+
+    Building it takes a single listing of the output directory, and of the subdirectories of the hashed layout; no
+    file is stat'ed. With a snapshot file the index is saved at the end of the run with the modification times of the
+    directories, and loaded next time if none of them changed since. Files someone else adds to the output directory
+    during a run are only seen after the next full listing.
+    """
+
+    def __init__(self, output_dir, hashes, directories, snapshot=None):
+        """
+        Initialize the index.
+
+        :param output_dir: the output directory
+        :param hashes: array of the sorted hashes of the files
+        :param directories: list of the directories looked at, relative to the output directory
+        :param snapshot: path to save the index to on close, None to not save it
+        """
+        self.prefix = os.path.join(output_dir, '')
+        self.hashes = hashes
+        self.directories = set(directories)
+        self.snapshot = snapshot
+        self.added = set()
+        self.removed = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, config):
+        """
+        Load the index from the snapshot file if it is still current, otherwise list the output directory.
+
+        Factory method
+
+        The processes of --processes each list the output directory and don't save the snapshot, they would overwrite
+        each other's.
+
+        :param config: dictionary of configuration values
+        :return: OutputIndex
+        """
+        snapshot = config.get('snapshot_file') if 'shard' not in config else None
+        if snapshot is not None:
+            index = cls.load(config['output_dir'], snapshot)
+            if index is not None:
+                return index
+        return cls.scan(config['output_dir'], snapshot)
+
+    @staticmethod
+    def hash(name):
+        """
+        Hash the path of a file relative to the output directory.
+
+        :param name: the relative path
+        :return: signed integer of INDEX_TYPECODE
+        """
+        return struct.unpack(INDEX_TYPECODE, hashlib.sha1(name).digest()[:struct.calcsize(INDEX_TYPECODE)])[0]
+
+    @classmethod
+    def scan(cls, output_dir, snapshot=None):
+        """
+        List the output directory and the subdirectories of the hashed layout.
+
+        :param output_dir: the output directory
+        :param snapshot: path to save the index to on close
+        :return: OutputIndex
+        """
+        directories = []
+
+        def listing(name):
+            path = os.path.join(output_dir, name)
+            try:
+                names = os.listdir(path)
+            except OSError as err:
+                if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                    return None
+                raise
+            directories.append(name)
+            return names
+
+        hashes = array.array(INDEX_TYPECODE)
+        for name in listing('') or []:
+            if name.startswith('.') or name.endswith('.part'):
+                continue
+            # a file which just looks like a subdirectory isn't listed
+            subdirectories = listing(name) if FANOUT_NAME.match(name) else None
+            if subdirectories is None:
+                hashes.append(cls.hash(name))
+                continue
+            for subdirectory in subdirectories:
+                if FANOUT_NAME.match(subdirectory):
+                    for filename in listing(os.path.join(name, subdirectory)) or []:
+                        if not filename.startswith('.') and not filename.endswith('.part'):
+                            hashes.append(cls.hash(os.path.join(name, subdirectory, filename)))
+        return cls(output_dir, array.array(INDEX_TYPECODE, sorted(hashes)), directories, snapshot)
+
+    @classmethod
+    def load(cls, output_dir, snapshot):
+        """
+        Load the index from a snapshot file.
+
+        The file starts with a line of modification time and relative path for every directory, followed by an empty
+        line and the sorted hashes as an array of INDEX_TYPECODE.
+
+        :param output_dir: the output directory
+        :param snapshot: path of the snapshot file
+        :return: OutputIndex, None if there is no snapshot or a directory changed since
+        """
+        try:
+            with open(snapshot, 'rb') as infile:
+                directories = []
+                for line in iter(infile.readline, '\n'):
+                    mtime, _, name = line.rstrip('\n').partition('\t')
+                    if not line or os.stat(os.path.join(output_dir, name)).st_mtime != float(mtime):
+                        return None
+                    directories.append(name)
+                hashes = array.array(INDEX_TYPECODE)
+                hashes.fromstring(infile.read())
+        except (IOError, OSError, ValueError):
+            return None
+        return cls(output_dir, hashes, directories, snapshot)
+
+    def relative(self, path):
+        """
+        Get the path of a file relative to the output directory.
+
+        :param path: path as generated by generate_filename()
+        :return: relative path
+        """
+        return path[len(self.prefix):] if path.startswith(self.prefix) else path
+
+    def __contains__(self, path):
+        """
+        Check if a file exists.
+
+        :param path: path as generated by generate_filename()
+        :return: bool
+        """
+        key = self.hash(self.relative(path))
+        with self.lock:
+            if key in self.added:
+                return True
+            if key in self.removed:
+                return False
+            position = bisect.bisect_left(self.hashes, key)
+            return position < len(self.hashes) and self.hashes[position] == key
+
+    def add(self, path):
+        """
+        Add a file written during the run.
+
+        :param path: path as generated by generate_filename()
+        :return:
+        """
+        key = self.hash(self.relative(path))
+        with self.lock:
+            self.removed.discard(key)
+            self.added.add(key)
+            self.directories.add(os.path.dirname(self.relative(path)))
+
+    def discard(self, path):
+        """
+        Remove a file deleted during the run.
+
+        :param path: path as generated by generate_filename()
+        :return:
+        """
+        key = self.hash(self.relative(path))
+        with self.lock:
+            self.added.discard(key)
+            self.removed.add(key)
+
+    def close(self):
+        """
+        Save the index to the snapshot file if there is one.
+
+        The modification times are taken now, after the run changed the directories. The file is written under a
+        temporary name and renamed, so a run reading it never sees half of it.
+
+        :return:
+        """
+        if self.snapshot is None:
+            return
+        with self.lock:
+            # both are sorted already, merging them doesn't need another copy of the index in memory
+            merged = heapq.merge((key for key in self.hashes if key not in self.removed), sorted(self.added))
+            hashes = array.array(INDEX_TYPECODE, (key for key, _ in itertools.groupby(merged)))
+            # the parent directories of the new subdirectories changed, too
+            for name in list(self.directories):
+                while name:
+                    name = os.path.dirname(name)
+                    self.directories.add(name)
+            lines = []
+            for name in sorted(self.directories):
+                try:
+                    lines.append('%r\t%s\n' % (os.stat(os.path.join(self.prefix, name)).st_mtime, name))
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+        temporary = '%s.%d.tmp' % (self.snapshot, os.getpid())
+        with open(temporary, 'wb') as outfile:
+            outfile.write(''.join(lines) + '\n')
+            hashes.tofile(outfile)
+        os.rename(temporary, self.snapshot)
+
+
+def make_directory(path):
+    """
+    Create a directory and its parents unless it exists.
+
+    :param path: path of the directory
+    :return:
+    """
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            # another worker may have created it in the meantime
+            if err.errno != errno.EEXIST:
+                raise
+
+
+def migrate_layout(config, logger):
+    """
+    Move the downloads recorded in the state file to the paths of the configured layout, in place.
+
+    Files are renamed, so this is quick and a web server never sees a partial file. Relative symlinks of the symlink
+    storage mode are created again to point to the same blob from their new directory. Partial downloads are moved
+    along. Files the state file doesn't know, or knows in another output directory, stay where they are.
+
+    :param config: dictionary of configuration values
+    :param logger: logger for output
+    :return: number of moved files
+    """
+    state = StateStore(config['state_file'], config.get('cache_size', 100000))
+    output_dir = os.path.join(os.path.abspath(config['output_dir']), '')
+    moved = 0
+    try:
+        for row in state.downloads():
+            path = generate_filename(row['url'], config['output_dir'], config.get('layout', 'flat'))
+            # downloads to another output directory are none of our business
+            if row['path'] == path or not os.path.abspath(row['path']).startswith(output_dir):
+                continue
+
+            partials = [partial_path(row['path']), partial_path(path)]
+            for old, new in [(row['path'], path), partials, [validator_path(partial) for partial in partials]]:
+                if not os.path.lexists(old):
+                    continue
+                make_directory(os.path.dirname(new))
+                if os.path.islink(old) and not os.path.isabs(os.readlink(old)):
+                    target = os.path.join(os.path.dirname(old), os.readlink(old))
+                    # replaces a file at the new path like the rename does
+                    linkpath = '%s.%d.link' % (new, os.getpid())
+                    os.symlink(os.path.relpath(target, os.path.dirname(os.path.abspath(new))), linkpath)
+                    os.rename(linkpath, new)
+                    os.unlink(old)
+                else:
+                    os.rename(old, new)
+                moved += 1
+            state.move_download(row['url'], path)
+    finally:
+        state.close()
+
+    logger.info('Moved %d files to the %s layout' % (moved, config.get('layout', 'flat')))
+    return moved
+
+
+def content_length(headers):
+    """
+    Get the length of the body the server announced for a response.
+
+    :param headers: case insensitive dictionary of response headers
+    :return: length in bytes, None if it is unknown or refers to encoded content
+    """
+    if headers.get('content-encoding', 'identity') != 'identity':
+        return None
+    try:
+        return int(headers['content-length'])
+    except (KeyError, ValueError):
+        return None
+
+
+def chunk_size(length, config):
+    """
+    Get the number of bytes to read per write.
+
+    Small chunks cost a python loop iteration, a string object and a hash update per few kilobytes, which dominates
+    the cpu time for big images. A configured chunk size is used as it is, otherwise about an eighth of the image is
+    read at once within MIN_CHUNK_SIZE and MAX_CHUNK_SIZE.
+
+    :param length: length of the response body, None if it is unknown
+    :param config: dictionary of configuration values
+    :return: chunk size in bytes
+    """
+    if config.get('chunk_size'):
+        return config['chunk_size']
+    if length is None:
+        return MIN_CHUNK_SIZE * 4
+    return min(max(length // 8, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+
+class UnwantedContent(Exception):
+    """
+    A download turned out to be of a MIME type or a size it must not have; the reason is the message.
+    """
+
+
+def unwanted_content(data, size, config):
+    """
+    Tell why a download isn't wanted: its first bytes aren't of one of the 'mime_types' or it is larger than
+    'max_size'. Either can be told before the body is transferred.
+
+    :param data: the first bytes of the body, None if they aren't checked, e.g. for a resumed download
+    :param size: size of the file, as announced by the server or as far as it is written
+    :param config: dictionary of configuration values
+    :return: the reason, None if the download is wanted
+    """
+    if config.get('max_size') and size > config['max_size']:
+        return 'larger than %d bytes' % config['max_size']
+    if data is not None and config.get('mime_types'):
+        found = sniff_buffer(data)
+        if found not in config['mime_types']:
+            return 'unwanted type %s' % found
+    return None
+
+
+_fallocate = None
+
+
+def preallocate(outfile, offset, length):
+    """
+    Reserve the disk space for the rest of a download.
+
+    The file system can then place the image in one piece instead of growing it chunk by chunk. The size of the file
+    is kept, so an interrupted download still resumes at the right offset. Only Linux has fallocate(); elsewhere
+    nothing is reserved.
+
+    :param outfile: file object opened for writing
+    :param offset: where the rest of the download starts in the file
+    :param length: number of bytes still to come
+    :return:
+    """
+    global _fallocate
+    if not length:
+        return
+    if _fallocate is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _fallocate = getattr(libc, 'fallocate', False)
+        if _fallocate:
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if _fallocate:
+        # FALLOC_FL_KEEP_SIZE; a file system without support just doesn't get the hint
+        _fallocate(outfile.fileno(), 1, offset, length)
+
+
+def sync_file(outfile, config):
+    """
+    Write a download through to the disk before it is moved into place, depending on the fsync policy.
+
+    :param outfile: file object opened for writing
+    :param config: dictionary of configuration values
+    :return:
+    """
+    if config.get('fsync', 'none') != 'none':
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+
+def sync_directory(path, config):
+    """
+    Write the directory entry of a renamed download through to the disk with the 'full' fsync policy.
+
+    :param path: the new path of the download
+    :param config: dictionary of configuration values
+    :return:
+    """
+    if config.get('fsync', 'none') == 'full':
+        descriptor = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+
+def write_file(response, outpath, offset=0, config=None, stats=None):
+    """
+    Open output file for writing binary and write image chunk wise.
+
+    Todo: find out how to mock response and file
+
+    :param response:
+    :param outpath:
+    :param offset: number of bytes already in the file; the response body is appended to them
+    :param config: dictionary of configuration values for chunk size and fsync policy
+    :param stats: RunStats to time the transfer and the disk writes in
+    :return: tuple of the size of the file and the SHA-256 hex digest of its content
+    :raise UnwantedContent: if the first chunk isn't of an allowed type or the file gets too large
+    """
+    config = config or {}
+    length = content_length(response.headers)
+    # the announced size is enough to refuse the body
+    reason = unwanted_content(None, offset + (length or 0), config)
+    if reason:
+        raise UnwantedContent(reason)
+    size = offset
+    started = time.time()
+    write_seconds = 0
+    # the hash has to cover the part downloaded before
+    digest = hash_file(outpath) if offset else hashlib.sha256()
+    if not offset:
+        make_directory(os.path.dirname(outpath))
+    # urllib3 doesn't hold the body to the announced length by default; a body cut short has to stay a partial
+    # download, not become a truncated image
+    response.raw.enforce_content_length = True
+    with open(outpath, 'ab' if offset else 'wb') as outfile:
+        preallocate(outfile, offset, length)
+        # iter_content() decodes the body for Content-Encoding and chunked transfers
+        chunks = response.iter_content(chunk_size(length, config))
+        if not offset and config.get('mime_types'):
+            # the type is told by the first bytes, an unwanted body is dropped before a whole large chunk is read
+            first = next(response.iter_content(MAGIC_SNIFF_SIZE), '')
+            chunks = itertools.chain([first] if first else [], chunks)
+        for chunk in chunks:
+            # the type is told by the start of the file, which a resumed download doesn't see
+            reason = unwanted_content(None if size else chunk, size + len(chunk), config)
+            if reason:
+                raise UnwantedContent(reason)
+            before = time.time()
+            outfile.write(chunk)
+            write_seconds += time.time() - before
+            size += len(chunk)
+            digest.update(chunk)
+        # an empty body has no type at all
+        reason = unwanted_content(None if size else '', size, config)
+        if reason:
+            raise UnwantedContent(reason)
+        before = time.time()
+        sync_file(outfile, config)
+        write_seconds += time.time() - before
+
+    if stats is not None:
+        stats.observe('transfer', time.time() - started - write_seconds)
+        stats.observe('write', write_seconds)
+        stats.increment('bytes_downloaded', size - offset)
+    return size, digest.hexdigest()
+
+
+def partial_path(outpath):
+    """
+    Get the path a download is written to before it is complete.
+
+    It is in the same directory as the output path, so it can be renamed into place atomically. A partial file left
+    behind by an interrupted run is resumed by the next one.
+
+    :param outpath: output path generated for the url
+    :return: path of the partial download
+    """
+    return outpath + '.part'
+
+
+def resume_offset(partpath):
+    """
+    Get the number of bytes already downloaded by an interrupted run.
+
+    :param partpath: path of the partial download
+    :return: size of the partial download, 0 if there is none
+    """
+    try:
+        return os.path.getsize(partpath)
+    except OSError:
+        return 0
+
+
+def validator_path(partpath):
+    """
+    Get the path of the file keeping the validator of a partial download.
+
+    It is hidden, so listings of the output directory skip it like the partial download.
+
+    :param partpath: path of the partial download
+    :return: path of the validator file
+    """
+    directory, name = os.path.split(partpath)
+    return os.path.join(directory, '.%s.validator' % name)
+
+
+def save_validator(partpath, headers):
+    """
+    Remember which content a new partial download is of, so resuming it can ask for the rest of that same content.
+
+    A weak ETag isn't allowed in an If-Range header, the Last-Modified date is taken then. Without either the partial
+    download can't be resumed safely and starts over.
+
+    :param partpath: path of the partial download
+    :param headers: case insensitive dictionary of response headers
+    :return:
+    """
+    etag = headers.get('etag')
+    validator = etag if etag and not etag.startswith('W/') else headers.get('last-modified')
+    if validator is None:
+        remove_file(validator_path(partpath))
+        return
+    make_directory(os.path.dirname(partpath))
+    with open(validator_path(partpath), 'w') as outfile:
+        outfile.write(validator)
+
+
+def load_validator(partpath):
+    """
+    Get the validator of a partial download.
+
+    :param partpath: path of the partial download
+    :return: ETag or Last-Modified date, None if there is none
+    """
+    try:
+        with open(validator_path(partpath)) as infile:
+            return infile.read().strip() or None
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def range_headers(offset, validator=None):
+    """
+    Get the headers to request the rest of a partial download.
+
+    The If-Range header makes the server send the complete content instead if it changed since the partial download
+    was started, so the rest of a different image is never appended. A partial download without a validator is
+    requested completely again.
+
+    Ranges refer to the encoded content, so ask for the content unencoded to be able to append it to the file.
+
+    :param offset: number of bytes already downloaded
+    :param validator: ETag or Last-Modified date of the partial download
+    :return: dictionary of request headers
+    """
+    if not offset or validator is None:
+        return {}
+    return {'Range': 'bytes=%d-' % offset, 'If-Range': validator, 'Accept-Encoding': 'identity'}
+
+
+def resumed_at(status, headers, offset):
+    """
+    Find out where the body of a response starts in the file.
+
+    A server not supporting ranges answers with the complete content, a partial response is only usable if it
+    starts right where the partial download ends.
+
+    :param status: HTTP status of the response
+    :param headers: case insensitive dictionary of response headers
+    :param offset: number of bytes already downloaded
+    :return: offset of the body in the file, None if the response has no usable body
+    """
+    if status == 200:
+        return 0
+    if status == 206 and offset:
+        match = re.match(r'bytes\s+(\d+)-', headers.get('content-range', ''))
+        if match and int(match.group(1)) == offset:
+            return offset
+    return None
+
+
+def hash_file(path):
+    """
+    Hash the content of a file.
+
+    :param path: path of the file
+    :return: hashlib sha256 object, to be continued with the rest of the content
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(65536), b''):
+            digest.update(block)
+    return digest
+
+
+def blob_directory(config):
+    """
+    Get the directory for the deduplicated content.
+
+    It has to be on the same filesystem as the output directory for hardlinks, so the default is inside of it.
+
+    :param config: dictionary of configuration values
+    :return: path of the blob directory
+    """
+    return config.get('blob_dir') or os.path.join(config['output_dir'], '.blobs')
+
+
+def commit_output(partpath, outpath, size, sha256, config, run):
+    """
+    Move a completed download to its output path.
+
+    The rename is atomic, so a web server reading the file always sees a complete image, either the old or the new
+    one.
+
+    In the link storage modes the content is stored once per hash in the blob directory and the output path becomes a
+    link to it. The links are created under a temporary name and renamed over the output path for the same reason.
+
+    :param partpath: path the download was written to
+    :param outpath: output path generated for the url
+    :param size: number of bytes downloaded
+    :param sha256: hex digest of the content
+    :param config: dictionary of configuration values
+    :param run: resources shared by all downloads of the run
+    :return:
+    """
+    if run['index'] is not None:
+        run['index'].add(outpath)
+    remove_file(validator_path(partpath))
+    storage = config.get('storage', 'plain')
+    if storage == 'plain':
+        os.rename(partpath, outpath)
+        sync_directory(outpath, config)
+        return
+
+    blob = os.path.join(blob_directory(config), sha256[:2], sha256)
+    if os.path.exists(blob):
+        os.unlink(partpath)
+        run['stats'].increment('deduplicated')
+        run['stats'].increment('bytes_deduplicated', size)
+    else:
+        make_directory(os.path.dirname(blob))
+        # a blob directory on another filesystem only works for symlinks; shutil falls back to copying there
+        shutil.move(partpath, blob)
+
+    linkpath = '%s.%d-%d.link' % (outpath, os.getpid(), threading.current_thread().ident)
+    if storage == 'hardlink':
+        os.link(blob, linkpath)
+    else:
+        # relative links keep working if the output directory is moved or mounted elsewhere
+        os.symlink(os.path.relpath(blob, os.path.dirname(os.path.abspath(outpath))), linkpath)
+    os.rename(linkpath, outpath)
+
+
+def remove_file(path):
+    """
+    Remove a file if it exists.
+
+    :param path: path of the file
+    :return:
+    """
+    try:
+        os.unlink(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def discard_partial(partpath):
+    """
+    Remove a partial download which doesn't match the content on the server anymore, and its validator.
+
+    :param partpath: path of the partial download
+    :return:
+    """
+    remove_file(partpath)
+    remove_file(validator_path(partpath))
+
+
+def save_response(response, url, outpath, start, config, logger, run):
+    """
+    Write a successful response to the partial download and move it into place once it is complete.
+
+    If the download is interrupted the partial file stays, so the next run can resume it.
+
+    :param response: the response with status 200 or a matching 206
+    :param url: the requested url
+    :param outpath: output path generated for the url
+    :param start: offset of the response body in the file
+    :param config: the config dictionary
+    :param logger: the logger for output
+    :param run: resources shared by all downloads of the run
+    :return:
+    """
+    if start:
+        run['stats'].increment('resumed')
+        logger.info("S:%d resuming file %s at byte %d ... " % (response.status_code, outpath, start))
+    else:
+        logger.info("S:%d writing file %s ... " % (response.status_code, outpath))
+
+    partpath = partial_path(outpath)
+    if not start:
+        save_validator(partpath, response.headers)
+    size, sha256 = write_file(response, partpath, start, config, run['stats'])
+    commit_output(partpath, outpath, size, sha256, config, run)
+    store_validators(url, response.headers, run)
+    record_result(url, outpath, 200, run, size, sha256)
+    run['stats'].increment('downloaded')
+    logger.debug("done...")
+
+
+def process_line(line, config, logger, run=None):
+    """
+    Process a line of input, i.e. a single url.
+
+    Todo: This is too hard to test, too. Refactor!
+
+    :param line: a line of input containing a url
+    :param config: the config dictionary
+    :param logger: the logger for output
+    :param run: resources shared by all downloads of the run; a fresh set is used if omitted
+    :return:
+    """
+    if run is None:
+        run = create_run(config)
+        try:
+            return process_line(line, config, logger, run)
+        finally:
+            finish_run(run, logger)
+
+    logger.info("Loading %s ... " % line)
+
+    # generate a unique-ish filename that includes source information
+    outfile = generate_filename(line, config['output_dir'], config.get('layout', 'flat'))
+
+    # no need for any network I/O if the file was downloaded recently
+    if already_done(line, outfile, config, run):
+        skip_done(line, outfile, logger, run)
+        return
+
+    # continue where an interrupted run left off
+    partpath = partial_path(outfile)
+    offset = resume_offset(partpath)
+    headers = conditional_headers(line, outfile, run)
+    headers.update(range_headers(offset, load_validator(partpath)))
+
+    # in a fleet the file may come from the peer downloading it from the origin; a peer not having it (yet) is
+    # worth another attempt, the last one goes to the origin
+    source = source_url(line, config, run)
+    from_peer = source != line
+    if from_peer:
+        logger.info("Fetching %s from peer %s ... " % (line, source))
+
+    # request the url via GET, reusing an open connection to the host if there is one
+    started = time.time()
+    try:
+        response = run['session'].get(source, stream=True, headers=headers, timeout=(CONNECT_TIMEOUT, IDLE_TIMEOUT))
+    except requests.RequestException as exc:
+        record_result(line, outfile, 0, run)
+        logger.error('Exception downloading %s: %s' % (source, str(exc)))
+        if isinstance(exc, requests.ConnectionError) and not from_peer:
+            connect_failed(line, run, logger)
+        retry_or_reject(line, 0, str(exc), from_peer or isinstance(exc, TRANSIENT_ERRORS), config, logger, run)
+        return
+
+    run['stats'].observe('first_byte', time.time() - started)
+    if not from_peer:
+        throttle(line, response.status_code, response.headers, run, logger)
+    start = resumed_at(response.status_code, response.headers, offset)
+
+    # If it worked then
+    if start is not None:
+        try:
+            save_response(response, line, outfile, start, config, logger, run)
+        except UnwantedContent as exc:
+            # closing the unread response drops the connection instead of reading the rest of the body
+            response.close()
+            discard_partial(partpath)
+            record_result(line, outfile, 0, run)
+            logger.warn('Aborted downloading %s: %s' % (source, str(exc)))
+            run['stats'].increment('unwanted')
+            retry_or_reject(line, response.status_code, str(exc), False, config, logger, run)
+            return
+        except TRANSIENT_ERRORS as exc:
+            # keep the partial download, the retry resumes it
+            record_result(line, outfile, 0, run)
+            logger.error('Exception downloading %s: %s' % (source, str(exc)))
+            retry_or_reject(line, 0, str(exc), True, config, logger, run)
+            return
+        if from_peer:
+            run['stats'].increment('from_peers')
+
+    # the file from the last run is still current
+    elif response.status_code == 304:
+        response.close()
+        discard_partial(partpath)
+        not_modified(line, outfile, logger, run)
+
+    # Status other than 200 = OK so request failed
+    else:
+        # the body isn't needed; don't leave the unread response hanging on the connection
+        response.close()
+        # the server can't continue the partial download, start over next time
+        if response.status_code == 416:
+            discard_partial(partpath)
+        record_result(line, outfile, response.status_code, run)
+        logger.warn("S:%d ERROR downloading %s\n" % (response.status_code, source))
+        retry_or_reject(line, response.status_code, 'HTTP %d' % response.status_code,
+                        from_peer or response.status_code in TRANSIENT_CODES, config, logger, run)
+
+    run['stats'].observe('latency', time.time() - started)
+
+
+# Program starts off here
+if __name__ == "__main__":
+    CONF, LOG = configure()
+    if CONF['list_failures']:
+        list_failures(CONF)
+    elif CONF['migrate_layout']:
+        # the files mustn't be moved under a running download
+        LOCK = lock_run(CONF, LOG)
+        migrate_layout(CONF, LOG)
+    else:
+        LOCK = lock_run(CONF, LOG)
+        if CONF['daemon']:
+            run_daemon(CONF, LOG)
+        else:
+            download_images(CONF, LOG)
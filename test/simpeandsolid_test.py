@@ -8,8 +8,23 @@ import simpleandsolid
 import sys
 import os
 import argparse
+import collections
+import re
+import hashlib
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+import urllib
+import signal
+import socket
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
 from pprint import pprint
 from testfixtures import LogCapture
+from httmock import HTTMock, all_requests, response
 import logging
 from nose.tools import with_setup
 
@@ -226,7 +241,55 @@ class TestSimpleAndSolid(unittest.TestCase):
                 'verbosity'  : logging.INFO,
                 'log_level'  : logging.INFO,
                 'log_file'   : 'arg_log_file',
-                'config_file': 'arg_config_file'
+                'config_file': 'arg_config_file',
+                'workers'    : 1,
+                'host_connections': 4,
+                'engine'     : 'requests',
+                'pool_size'  : 10,
+                'keep_alive' : True,
+                'queue_size': 100,
+                'state_file': None,
+                'cache_size': 100000,
+                'recheck_after': 86400,
+                'list_failures': False,
+                'storage': 'plain',
+                'blob_dir': None,
+                'chunk_size': 0,
+                'fsync': 'none',
+                'metrics_file': None,
+                'daemon': False,
+                'inbox_dir': 'inbox',
+                'poll_interval': 2,
+                'timing': False,
+                'host_rate': 0,
+                'host_burst': 1,
+                'host_limits': {},
+                'retries': 3,
+                'retry_delay': 1,
+                'rejected_file': None,
+                'skip_rejected': False,
+                'processes': 1,
+                'peers': [],
+                'node': None,
+                'incremental': False,
+                'lock_file': None,
+                'deadline': None,
+                'layout': 'flat',
+                'migrate_layout': False,
+                'mime_types': [],
+                'max_size': 0,
+                'quota_bytes': 0,
+                'quota_files': 0,
+                'plan': None,
+                'plan_size': 1000,
+                'priorities': {},
+                'no_clobber': False,
+                'snapshot_file': None,
+                'dedup': False,
+                'dedup_exact': 100000,
+                'dedup_bloom_bytes': 16777216,
+                'tracking_params': [],
+                'probe_workers': 8
             },
             simpleandsolid.merge_configuration(MockArguments(), empty_conf)
         )
@@ -255,7 +318,55 @@ class TestSimpleAndSolid(unittest.TestCase):
             'verbosity': logging.WARN,
             'log_level': logging.WARN,
             'log_file': 'logs/general.simpleandsolid.log',
-            'config_file': 'config/configuration.simpleandsolid.yaml'
+            'config_file': 'config/configuration.simpleandsolid.yaml',
+            'workers': 1,
+            'host_connections': 4,
+            'engine': 'requests',
+            'pool_size': 10,
+            'keep_alive': True,
+            'queue_size': 100,
+            'state_file': None,
+            'cache_size': 100000,
+            'recheck_after': 86400,
+            'list_failures': False,
+            'storage': 'plain',
+            'blob_dir': None,
+            'chunk_size': 0,
+            'fsync': 'none',
+            'metrics_file': None,
+            'daemon': False,
+            'inbox_dir': 'inbox',
+            'poll_interval': 2,
+            'timing': False,
+            'host_rate': 0,
+            'host_burst': 1,
+            'host_limits': {},
+            'retries': 3,
+            'retry_delay': 1,
+            'rejected_file': None,
+            'skip_rejected': False,
+            'processes': 1,
+            'peers': [],
+            'node': None,
+            'incremental': False,
+            'lock_file': None,
+            'deadline': None,
+            'layout': 'flat',
+            'migrate_layout': False,
+            'mime_types': [],
+            'max_size': 0,
+            'quota_bytes': 0,
+            'quota_files': 0,
+            'plan': None,
+            'plan_size': 1000,
+            'priorities': {},
+            'no_clobber': False,
+            'snapshot_file': None,
+            'dedup': False,
+            'dedup_exact': 100000,
+            'dedup_bloom_bytes': 16777216,
+            'tracking_params': [],
+            'probe_workers': 8
         }
 
         self.assertDictEqual(
@@ -297,7 +408,55 @@ class TestSimpleAndSolid(unittest.TestCase):
                 'verbosity': logging.CRITICAL,
                 'log_level': logging.ERROR,
                 'log_file': 'config_log_file',
-                'config_file': 'config/configuration.simpleandsolid.yaml'
+                'config_file': 'config/configuration.simpleandsolid.yaml',
+                'workers': 1,
+                'host_connections': 4,
+                'engine': 'requests',
+                'pool_size': 10,
+                'keep_alive': True,
+                'queue_size': 100,
+                'state_file': None,
+                'cache_size': 100000,
+                'recheck_after': 86400,
+                'list_failures': False,
+                'storage': 'plain',
+                'blob_dir': None,
+                'chunk_size': 0,
+                'fsync': 'none',
+                'metrics_file': None,
+                'daemon': False,
+                'inbox_dir': 'inbox',
+                'poll_interval': 2,
+                'timing': False,
+                'host_rate': 0,
+                'host_burst': 1,
+                'host_limits': {},
+                'retries': 3,
+                'retry_delay': 1,
+                'rejected_file': None,
+                'skip_rejected': False,
+                'processes': 1,
+                'peers': [],
+                'node': None,
+                'incremental': False,
+                'lock_file': None,
+                'deadline': None,
+                'layout': 'flat',
+                'migrate_layout': False,
+                'mime_types': [],
+                'max_size': 0,
+                'quota_bytes': 0,
+                'quota_files': 0,
+                'plan': None,
+                'plan_size': 1000,
+                'priorities': {},
+                'no_clobber': False,
+                'snapshot_file': None,
+                'dedup': False,
+                'dedup_exact': 100000,
+                'dedup_bloom_bytes': 16777216,
+                'tracking_params': [],
+                'probe_workers': 8
             },
             simpleandsolid.merge_configuration(MockArguments(), empty_conf)
         )
@@ -314,6 +473,13 @@ class TestSimpleAndSolid(unittest.TestCase):
         default = {
             'input_file': 'test/fixtures/sample_input.txt',
             'output_dir': './output',
+            'pool_size': 10,
+            'keep_alive': True,
+            'state_file': 'state/simpleandsolid.sqlite',
+            'cache_size': 100000,
+            'recheck_after': 86400,
+            'chunk_size': 0,
+            'fsync': 'none',
             'verbosity': 'warn',
             'log_level': 'warn',
             'log_file': 'logs/general_simpleandsolid.log',
@@ -371,3 +537,1689 @@ class TestSimpleAndSolid(unittest.TestCase):
             simpleandsolid.load_config_file(MockArguments())
         )
 
+    def test_argument_parser_concurrency_args(self):
+        result = self.validparser.parse_args(['--workers', '8', '--host_connections', '2'])
+
+        self.assertEqual(8, result.workers)
+        self.assertEqual(2, result.host_connections)
+
+    def test_merge_configuration_concurrency_from_config_file(self):
+        args = self.validparser.parse_args(['--workers', '8'])
+        conf = {
+            'input_file': None,
+            'output_dir': None,
+            'verbosity': None,
+            'log_level': None,
+            'log_file': None,
+            'config_file': None,
+            'workers': 2,  # overwritten by argument
+            'host_connections': 3  # no arg so overwrites default
+        }
+
+        result = simpleandsolid.merge_configuration(args, conf)
+
+        self.assertEqual(8, result['workers'])
+        self.assertEqual(3, result['host_connections'])
+
+    def test_verify_configuration_invalid_workers(self):
+        exits = []
+        self.conf['workers'] = 0
+
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+
+        self.assertEqual([78], exits)
+
+    def test_verify_configuration_invalid_fsync(self):
+        exits = []
+        self.conf['fsync'] = 'sometimes'
+
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+
+        self.assertEqual([78], exits)
+
+    def test_chunk_size(self):
+        self.assertEqual(simpleandsolid.MIN_CHUNK_SIZE, simpleandsolid.chunk_size(1000, {'chunk_size': 0}))
+        self.assertEqual(256 * 1024, simpleandsolid.chunk_size(2 * 1024 * 1024, {}))
+        self.assertEqual(simpleandsolid.MAX_CHUNK_SIZE, simpleandsolid.chunk_size(100 * 1024 * 1024, {}))
+        self.assertEqual(4 * simpleandsolid.MIN_CHUNK_SIZE, simpleandsolid.chunk_size(None, {}))
+        self.assertEqual(4096, simpleandsolid.chunk_size(100 * 1024 * 1024, {'chunk_size': 4096}))
+
+    def test_content_length(self):
+        self.assertEqual(42, simpleandsolid.content_length({'content-length': '42'}))
+        self.assertIsNone(simpleandsolid.content_length({}))
+        # the length of compressed content says nothing about the size of the file
+        self.assertIsNone(simpleandsolid.content_length({'content-length': '42', 'content-encoding': 'gzip'}))
+
+    def test_run_stats_percentile(self):
+        stats = simpleandsolid.RunStats()
+        self.assertIsNone(stats.percentile('latency', 0.5))
+
+        for millis in range(1, 101):
+            stats.observe('latency', millis / 1000.0)
+
+        # the buckets are 10% wide
+        self.assertTrue(0.05 <= stats.percentile('latency', 0.5) < 0.055)
+        self.assertTrue(0.099 <= stats.percentile('latency', 0.99) < 0.11)
+        self.assertTrue(0.1 <= stats.percentile('latency', 1.0) < 0.11)
+
+    def test_run_stats_cumulative(self):
+        stats = simpleandsolid.RunStats()
+        for seconds in [0.001, 0.02, 0.02, 0.3, 100]:
+            stats.observe('write', seconds)
+
+        self.assertEqual([1, 1, 3, 4, 4], stats.cumulative('write', [0.005, 0.01, 0.025, 0.5, 60]))
+        self.assertEqual([0], stats.cumulative('dns', [1]))
+
+    def test_run_stats_merge(self):
+        stats = simpleandsolid.RunStats()
+        stats.increment('downloaded')
+        other = simpleandsolid.RunStats()
+        other.increment('downloaded', 2)
+        other.count_status(404)
+        other.observe('latency', 0.5)
+
+        stats.merge(other.snapshot())
+
+        self.assertEqual(3, stats.get('downloaded'))
+        self.assertEqual({404: 1}, stats.statuses)
+        self.assertEqual(other.percentile('latency', 0.5), stats.percentile('latency', 0.5))
+
+    def test_shard_of(self):
+        self.assertEqual(
+            simpleandsolid.shard_of('https://images.pexels.com/photos/1.jpeg', 4),
+            simpleandsolid.shard_of('https://IMAGES.pexels.com/photos/2.jpeg', 4)
+        )
+        self.assertEqual(
+            set(range(4)),
+            set(simpleandsolid.shard_of('http://host%d.example.com/a.jpg' % number, 4) for number in range(100))
+        )
+
+    def test_hash_ring(self):
+        nodes = ['http://web%d.lan/images/' % number for number in range(4)]
+        ring = simpleandsolid.HashRing(nodes)
+        smaller = simpleandsolid.HashRing(nodes[:3])
+        urls = ['http://example.com/img/%d.jpg' % number for number in range(1000)]
+
+        owners = collections.Counter(ring.owner(url) for url in urls)
+        self.assertEqual(set(nodes), set(owners))
+        self.assertTrue(min(owners.values()) > 150)
+        # without the last node only its urls move
+        for url in urls:
+            if ring.owner(url) != nodes[3]:
+                self.assertEqual(ring.owner(url), smaller.owner(url))
+
+    def test_verify_configuration_node_not_a_peer(self):
+        exits = []
+        self.conf.update({'peers': ['http://web1.lan/images/', 'http://web2.lan/images/'],
+                          'node': 'http://web3.lan/images/'})
+
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+
+        self.assertEqual([78], exits)
+
+    def test_sniff_mime_type_reuses_handle(self):
+        self.assertEqual('text/plain', simpleandsolid.sniff_mime_type('test/fixtures/sample_input.txt'))
+        handle = simpleandsolid._magic_handle
+
+        self.assertEqual('text/plain', simpleandsolid.sniff_mime_type('test/fixtures/sample_input.txt'))
+        self.assertIs(handle, simpleandsolid._magic_handle)
+
+    def test_unwanted_content(self):
+        config = {'mime_types': ['image/png'], 'max_size': 100}
+
+        self.assertIsNone(simpleandsolid.unwanted_content(PNG_HEADER, 100, config))
+        self.assertEqual('unwanted type text/html',
+                         simpleandsolid.unwanted_content('<html><body>Not found</body></html>', 35, config))
+        self.assertEqual('larger than 100 bytes', simpleandsolid.unwanted_content(None, 101, config))
+        # without a limit or an allow-list everything goes
+        self.assertIsNone(simpleandsolid.unwanted_content('<html></html>', 10 ** 9, {'mime_types': [], 'max_size': 0}))
+
+    def test_verify_configuration_incremental_deadline_without_rejected_file(self):
+        self.conf.update({'incremental': True, 'state_file': os.path.join(tempfile.gettempdir(), 'state.sqlite'),
+                          'deadline': 270})
+        exits = []
+
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+        self.assertEqual([78], exits)
+
+        # the deferred urls go to the next run with the rejected file
+        self.conf['rejected_file'] = os.path.join(tempfile.gettempdir(), 'rejected.tsv')
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+        self.assertEqual([78], exits)
+
+    def test_verify_configuration_hardlink_blob_dir_elsewhere(self):
+        # /proc is a filesystem of its own everywhere
+        self.conf.update({'storage': 'hardlink', 'blob_dir': '/proc/blobs'})
+        exits = []
+
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+        self.assertEqual([78], exits)
+
+        # symlinks work across filesystems, and a blob directory not created yet counts as its parent
+        self.conf['storage'] = 'symlink'
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+        self.conf.update({'storage': 'hardlink', 'blob_dir': os.path.join(self.conf['output_dir'], 'new', 'blobs')})
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+        self.assertEqual([78], exits)
+
+    def test_verify_configuration_missing_inbox(self):
+        self.conf.update({'daemon': True, 'inbox_dir': os.path.join(tempfile.gettempdir(), 'missing-inbox')})
+        exits = []
+
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+
+        self.assertEqual([73], exits)
+
+    def test_verify_configuration_invalid_mime_types(self):
+        self.conf['mime_types'] = ['jpeg']
+        exits = []
+
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+
+        self.assertEqual([78], exits)
+
+    def test_verify_configuration_snapshot_in_output_dir(self):
+        self.conf['snapshot_file'] = './snapshot'
+        exits = []
+
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+
+        self.assertEqual([78], exits)
+
+    def test_phase_timer_report(self):
+        timer = simpleandsolid.PhaseTimer(100.0)
+        timer.lap('imports', 100.05)
+        timer.lap('arguments', 100.0525)
+
+        self.assertEqual('imports=50.0ms, arguments=2.5ms, total=52.5ms', timer.report())
+
+    def test_host_limiter_one_semaphore_per_host(self):
+        limiter = simpleandsolid.HostLimiter(2)
+
+        self.assertIs(
+            limiter.semaphore('https://images.pexels.com/photos/1.jpeg'),
+            limiter.semaphore('https://IMAGES.pexels.com/photos/2.jpeg')
+        )
+        self.assertIsNot(
+            limiter.semaphore('https://images.pexels.com/photos/1.jpeg'),
+            limiter.semaphore('http://example.com/photos/1.jpeg')
+        )
+
+    def test_host_limiter_busy(self):
+        limiter = simpleandsolid.HostLimiter(2)
+
+        limiter.take('http://example.com/a.jpg')
+        self.assertFalse(limiter.busy('example.com'))
+        limiter.take('http://EXAMPLE.com/b.jpg')
+        self.assertTrue(limiter.busy('example.com'))
+        self.assertFalse(limiter.busy('example.org'))
+        limiter.release('http://example.com/a.jpg')
+        self.assertFalse(limiter.busy('example.com'))
+
+    def test_token_bucket(self):
+        bucket = simpleandsolid.TokenBucket(2, 2)
+        bucket.updated = 100
+
+        self.assertEqual(0, bucket.wait_time(100))
+        bucket.take()
+        bucket.take()
+        self.assertEqual(0.5, bucket.wait_time(100))
+        # refills at the rate, but never beyond the burst
+        self.assertEqual(0, bucket.wait_time(100.5))
+        self.assertEqual(0, bucket.wait_time(200))
+        self.assertEqual(2, bucket.tokens)
+
+    def test_host_scheduler_interleaves_hosts(self):
+        scheduler = simpleandsolid.HostScheduler({})
+        for url in ['http://a.com/1.jpg', 'http://a.com/2.jpg', 'http://a.com/3.jpg', 'http://b.com/1.jpg']:
+            scheduler.add(url)
+
+        urls = [scheduler.pop()[0] for _ in range(4)]
+
+        self.assertEqual(['http://a.com/1.jpg', 'http://b.com/1.jpg', 'http://a.com/2.jpg', 'http://a.com/3.jpg'],
+                         urls)
+        self.assertEqual((None, None), scheduler.pop())
+
+    def test_host_scheduler_rate_and_backoff(self):
+        scheduler = simpleandsolid.HostScheduler({'host_limits': {'a.com': {'rate': 1}}})
+        for url in ['http://a.com/1.jpg', 'http://a.com/2.jpg', 'http://b.com/1.jpg', 'http://b.com/2.jpg']:
+            scheduler.add(url)
+
+        self.assertEqual('http://a.com/1.jpg', scheduler.pop()[0])
+        scheduler.backoff('http://b.com/1.jpg', 60)
+        url, delay = scheduler.pop()
+
+        # a.com has to wait for its rate, b.com for its Retry-After
+        self.assertIsNone(url)
+        self.assertTrue(0.9 < delay <= 1)
+        self.assertEqual(3, scheduler.pending())
+        # a host busy with downloads is not counted
+        self.assertTrue(59 < scheduler.pop(lambda host: host == 'a.com')[1] <= 60)
+
+    def test_host_scheduler_backoff_doubles(self):
+        scheduler = simpleandsolid.HostScheduler({})
+        for _ in range(3):
+            scheduler.backoff('http://a.com/1.jpg')
+        self.assertTrue(3 < scheduler.paused['a.com'] - time.time() <= 4)
+
+        scheduler.reset('http://a.com/2.jpg')
+        self.assertNotIn('a.com', scheduler.strikes)
+
+    def test_retry_after(self):
+        self.assertEqual(120, simpleandsolid.retry_after({'retry-after': '120'}))
+        self.assertEqual(30, simpleandsolid.retry_after({'retry-after': 'Wed, 21 Oct 2015 07:28:30 GMT'},
+                                                        now=1445412480))
+        self.assertIsNone(simpleandsolid.retry_after({'retry-after': 'soon'}))
+        self.assertIsNone(simpleandsolid.retry_after({}))
+
+    def test_verify_configuration_invalid_host_limits(self):
+        exits = []
+        self.conf['host_limits'] = {'images.pexels.com': {'rate': -1}}
+
+        simpleandsolid.verify_configuration(self.conf, exits.append)
+
+        self.assertEqual([78], exits)
+
+
+@all_requests
+def image_response(url, request):
+    """
+    Answer every request with a tiny fake image, but fail for paths containing 'missing'.
+    """
+    if 'missing' in url.path:
+        return response(404, 'not found', request=request)
+    return response(200, 'image data of ' + url.path, request=request)
+
+
+class DownloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.output_dir, 'urls.txt')
+        self.logger = logging.getLogger('simpleandsolid.test')
+
+        self.conf = {
+            'input_file': self.input_file,
+            'output_dir': self.output_dir,
+            'workers': 1,
+            'host_connections': 4
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def write_input(self, lines):
+        with open(self.input_file, 'w') as infile:
+            infile.write('\n'.join(lines) + '\n')
+
+
+class TestDownload(DownloadTestCase):
+    def test_download_images_parallel(self):
+        self.write_input([
+            'http://example.com/img/a.jpg',
+            'http://example.com/img/b.jpg',
+            'http://example.org/img/missing.jpg',
+            'http://example.org/img/c.jpg'
+        ])
+        self.conf['workers'] = 3
+        self.conf['host_connections'] = 1
+
+        with HTTMock(image_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        self.assertEqual(
+            ['example_com_img_a.jpg', 'example_com_img_b.jpg', 'example_org_img_c.jpg', 'urls.txt'],
+            sorted(os.listdir(self.output_dir))
+        )
+        with open(os.path.join(self.output_dir, 'example_com_img_b.jpg')) as infile:
+            self.assertEqual('image data of /img/b.jpg', infile.read())
+
+    def test_write_file_sniffs_before_chunks(self):
+        body = StringIO.StringIO('<html><body>' + ' ' * 1000000 + '</body></html>')
+
+        class StreamedResponse(object):
+            headers = {}
+            raw = body
+
+            @staticmethod
+            def iter_content(size):
+                return iter(lambda: body.read(size), '')
+
+        outpath = os.path.join(self.output_dir, 'a.jpg')
+        with self.assertRaises(simpleandsolid.UnwantedContent):
+            simpleandsolid.write_file(StreamedResponse(), outpath, config={'mime_types': ['image/png'],
+                                                                          'chunk_size': 1000000})
+
+        # only the bytes telling the type were read, not a whole chunk
+        self.assertEqual(simpleandsolid.MAGIC_SNIFF_SIZE, body.tell())
+        self.assertEqual(0, os.path.getsize(outpath))
+
+    def test_plan_order(self):
+        urls = ['http://a/1.jpg', 'http://a/2.jpg', 'http://b/3.jpg', 'http://b/4.jpg', 'http://c/5.jpg']
+        sizes = dict(zip(urls, [300, 100, None, 200, 50]))
+
+        self.assertEqual(['http://c/5.jpg', 'http://a/2.jpg', 'http://b/4.jpg', 'http://a/1.jpg', 'http://b/3.jpg'],
+                         simpleandsolid.plan_order(urls, sizes, {'plan': 'shortest'}))
+        self.assertEqual(['http://b/4.jpg', 'http://b/3.jpg', 'http://c/5.jpg', 'http://a/2.jpg', 'http://a/1.jpg'],
+                         simpleandsolid.plan_order(urls, sizes, {'plan': 'priority', 'priorities': {'b': 1}}))
+        self.assertEqual(['http://c/5.jpg', 'http://a/2.jpg', 'http://b/4.jpg', 'http://a/1.jpg', 'http://b/3.jpg'],
+                         simpleandsolid.plan_order(urls, sizes, {'plan': 'fair'}))
+
+    def test_download_images_plan(self):
+        requested = []
+
+        @all_requests
+        def sized_response(url, request):
+            requested.append((request.method, url.path))
+            size = int(url.path.split('/')[2])
+            return response(200, '' if request.method == 'HEAD' else 'x' * size, {'Content-Length': str(size)},
+                            request=request)
+
+        self.write_input(['http://example.com/img/3000/a.jpg', 'http://example.com/img/10/b.jpg',
+                          'http://example.org/img/200/c.jpg'])
+        # no reading ahead and one probe at a time, so the requests show the order
+        self.conf.update({'plan': 'shortest', 'plan_size': 2, 'queue_size': 1, 'probe_workers': 1})
+
+        with HTTMock(sized_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        # the first two urls are planned together, the third one on its own
+        self.assertEqual([('HEAD', '/img/3000/a.jpg'), ('HEAD', '/img/10/b.jpg'), ('GET', '/img/10/b.jpg'),
+                          ('GET', '/img/3000/a.jpg'), ('HEAD', '/img/200/c.jpg'), ('GET', '/img/200/c.jpg')],
+                         requested)
+
+    def test_planned_defers_after_deadline(self):
+        @all_requests
+        def sized_response(url, request):
+            return response(200, '', {'Content-Length': url.path.split('/')[2]}, request=request)
+
+        self.conf.update({'plan': 'shortest', 'rejected_file': os.path.join(self.output_dir, 'rejected.tsv')})
+        run = simpleandsolid.create_run(self.conf)
+        # 1000 bytes per second so far, 2 seconds left
+        run['stats'].started = time.time() - 1
+        run['stats'].increment('bytes_downloaded', 1000)
+        run['deadline'] = time.time() + 2
+
+        with HTTMock(sized_response):
+            urls = list(simpleandsolid.planned(iter(['http://example.com/img/5000/a.jpg',
+                                                     'http://example.com/img/100/b.jpg']), self.conf, self.logger, run))
+        simpleandsolid.finish_run(run, self.logger)
+
+        self.assertEqual(['http://example.com/img/100/b.jpg'], urls)
+        self.assertEqual(1, run['stats'].get('deferred'))
+        with open(self.conf['rejected_file']) as infile:
+            self.assertEqual('http://example.com/img/5000/a.jpg\t0\t0\tdeferred\n', infile.read())
+        # a deferred url isn't given up on
+        self.assertEqual(set(), run['rejected'].urls())
+
+    def test_download_images_no_clobber(self):
+        os.mkdir(os.path.join(self.output_dir, 'state'))
+        self.conf.update({'no_clobber': True, 'snapshot_file': os.path.join(self.output_dir, 'state', 'snapshot')})
+        self.write_input(['http://example.com/img/a.jpg', 'http://example.com/img/b.jpg'])
+        with open(os.path.join(self.output_dir, 'example_com_img_a.jpg'), 'w') as outfile:
+            outfile.write('from an earlier run')
+
+        with HTTMock(image_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        with open(os.path.join(self.output_dir, 'example_com_img_a.jpg')) as infile:
+            self.assertEqual('from an earlier run', infile.read())
+        with open(os.path.join(self.output_dir, 'example_com_img_b.jpg')) as infile:
+            self.assertEqual('image data of /img/b.jpg', infile.read())
+
+        @all_requests
+        def no_requests(url, request):
+            self.fail('%s requested again' % url.geturl())
+
+        # the next run takes the index from the snapshot
+        self.assertIsNotNone(simpleandsolid.OutputIndex.load(self.output_dir, self.conf['snapshot_file']))
+        with HTTMock(no_requests):
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        # until the output directory changes
+        with open(os.path.join(self.output_dir, 'example_com_img_c.jpg'), 'w') as outfile:
+            outfile.write('from somewhere else')
+        self.assertIsNone(simpleandsolid.OutputIndex.load(self.output_dir, self.conf['snapshot_file']))
+
+    def test_output_index_scan(self):
+        hashed = simpleandsolid.generate_filename('http://example.com/img/a.jpg', self.output_dir, 'hashed')
+        for path in [hashed, hashed + '.part', os.path.join(self.output_dir, 'example_com_img_b.jpg'),
+                     os.path.join(self.output_dir, '.blobs', 'ab', 'abcdef')]:
+            simpleandsolid.make_directory(os.path.dirname(path))
+            with open(path, 'w') as outfile:
+                outfile.write('image')
+
+        index = simpleandsolid.OutputIndex.scan(self.output_dir)
+
+        self.assertIn(hashed, index)
+        self.assertIn(os.path.join(self.output_dir, 'example_com_img_b.jpg'), index)
+        self.assertNotIn(hashed + '.part', index)
+        self.assertNotIn(os.path.join(self.output_dir, '.blobs', 'ab', 'abcdef'), index)
+        index.discard(hashed)
+        self.assertNotIn(hashed, index)
+        index.add(hashed)
+        self.assertIn(hashed, index)
+
+    def test_canonical_url(self):
+        for url, canonical in [
+            ('HTTP://Example.COM:80/Img/A.jpg#top', 'http://example.com/Img/A.jpg'),
+            ('https://example.com:443', 'https://example.com/'),
+            ('http://example.com:8080/a.jpg?size=large&utm_source=feed&fbclid=x&utm_medium=mail',
+             'http://example.com:8080/a.jpg?size=large'),
+            ('http://user@[::1]:80/a.jpg?a=%20b', 'http://user@[::1]/a.jpg?a=%20b'),
+            ('http://example.com:port/a.jpg', 'http://example.com:port/a.jpg')
+        ]:
+            self.assertEqual(canonical, simpleandsolid.canonical_url(url))
+        self.assertEqual('http://example.com/a.jpg', simpleandsolid.canonical_url('http://example.com/a.jpg?ref=x',
+                                                                                 ['ref']))
+
+    def test_seen_urls_switches_to_bloom_filter(self):
+        seen = simpleandsolid.SeenUrls(10, 4096)
+        urls = ['http://example.com/%d.jpg' % number for number in range(1000)]
+
+        self.assertTrue(all(seen.add(url) for url in urls[:10]))
+        self.assertIsNone(seen.bloom)
+        self.assertFalse(seen.add(urls[0]))
+        new = [seen.add(url) for url in urls[10:]]
+
+        self.assertIsNone(seen.urls)
+        # no url seen before is taken for a new one, few new ones for seen ones
+        self.assertFalse(any(seen.add(url) for url in urls))
+        self.assertGreater(sum(new), 980)
+
+    def test_download_images_dedup(self):
+        requested = []
+
+        @all_requests
+        def counting_response(url, request):
+            requested.append(url.geturl())
+            return image_response(url, request)
+
+        self.write_input(['http://example.com/img/a.jpg', 'http://EXAMPLE.com:80/img/a.jpg#large',
+                          'http://example.com/img/a.jpg?utm_source=feed', 'http://example.com/img/b.jpg'])
+        self.conf['dedup'] = True
+
+        with HTTMock(counting_response):
+            with LogCapture() as logs:
+                simpleandsolid.download_images(self.conf, self.logger)
+
+        self.assertEqual(['http://example.com/img/a.jpg', 'http://example.com/img/b.jpg'], requested)
+        logs.check_present(
+            ('simpleandsolid.test', 'INFO', 'Run summary: bytes_downloaded=48, canonicalized=2, '
+                                            'connections_reused=0, downloaded=2, duplicates=2')
+        )
+
+    def test_read_urls(self):
+        self.write_input([
+            '# comment',
+            '  http://example.com/img/a.jpg  ',
+            '',
+            'ftp://example.com/img/b.jpg',
+            'not a url',
+            'https://example.com/img/c.jpg\t404\t1\tHTTP 404'
+        ])
+        stats = simpleandsolid.RunStats()
+
+        with open(self.input_file) as infile:
+            urls = simpleandsolid.read_urls(infile, self.logger, stats)
+            self.assertEqual('http://example.com/img/a.jpg', next(urls))
+            self.assertEqual(['https://example.com/img/c.jpg'], list(urls))
+
+        self.assertEqual(2, stats.get('invalid'))
+
+    def test_download_parallel_skips_busy_hosts(self):
+        events = []
+
+        @all_requests
+        def slow_response(url, request):
+            events.append(('start', url.geturl()))
+            if url.netloc == 'example.com':
+                time.sleep(0.2)
+            events.append(('end', url.geturl()))
+            return image_response(url, request)
+
+        self.write_input(['http://example.com/img/a.jpg', 'http://example.com/img/b.jpg',
+                          'http://example.org/img/c.jpg', 'http://example.org/img/d.jpg'])
+        self.conf.update({'workers': 2, 'host_connections': 1})
+
+        with HTTMock(slow_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        # after c.jpg the free worker doesn't wait for example.com with b.jpg but takes d.jpg
+        self.assertLess(events.index(('start', 'http://example.org/img/d.jpg')),
+                        events.index(('end', 'http://example.com/img/a.jpg')))
+        self.assertEqual(8, len(events))
+
+    def test_download_parallel_bounded_queue(self):
+        slots = []
+        run = simpleandsolid.create_run(self.conf)
+        self.conf['workers'] = 2
+        self.conf['queue_size'] = 3
+
+        def urls():
+            for number in range(10):
+                # never more than queue_size urls are waiting or running when the next one is read
+                slots.append(number - run['stats'].get('downloaded') - run['stats'].get('failed'))
+                yield 'http://example.com/img/%d.jpg' % number
+
+        with HTTMock(image_response):
+            simpleandsolid.download_parallel(urls(), self.conf, self.logger, run)
+
+        self.assertEqual(10, run['stats'].get('downloaded'))
+        self.assertLessEqual(max(slots), 3)
+
+
+# the start of a 1x1 PNG, enough for libmagic
+PNG_HEADER = '\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00'
+
+
+class ImageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve fake images for tests which need real connections and therefore can't use httmock.
+    """
+    # allow keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', '/img/' + self.path.rsplit('/', 1)[1])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path.startswith('/img/') or self.path.startswith('/changing/'):
+            body = 'image data of ' + self.path
+            etag = '"1"'
+            if self.path.startswith('/changing/'):
+                # a new version every time; the first one is cut short
+                self.server.versions[self.path] += 1
+                etag = '"%d"' % self.server.versions[self.path]
+                body = 'version %d of the image data of %s' % (self.server.versions[self.path], self.path)
+            match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+            if self.headers.get('If-Range', etag) != etag:
+                match = None
+            if match and int(match.group(1)) >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            elif match:
+                start = int(match.group(1))
+                self.send_response(206)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(body) - 1, len(body)))
+                self.send_header('Content-Length', str(len(body) - start))
+                self.end_headers()
+                self.wfile.write(body[start:])
+            else:
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.server.versions[self.path] == 1:
+                    self.wfile.write(body[:10])
+                    self.close_connection = 1
+                else:
+                    self.wfile.write(body)
+        elif self.path.startswith('/flaky/') and not self.server.flaky[self.path]:
+            # fails the first time only
+            self.server.flaky[self.path] += 1
+            self.send_error(503)
+        elif self.path.startswith('/flaky/'):
+            self.send_response(200)
+            self.send_header('Content-Length', '4')
+            self.end_headers()
+            self.wfile.write('fine')
+        elif self.path.startswith('/throttle/') or self.path.startswith('/throttlelong/'):
+            self.send_response(429)
+            self.send_header('Retry-After', '1' if self.path.startswith('/throttle/') else '3600')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path.startswith('/png/') or self.path.startswith('/bigpng/'):
+            body = PNG_HEADER + '\x00' * (100000 if self.path.startswith('/bigpng/') else 100)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except socket.error:
+                # the client hung up on the body
+                self.close_connection = 1
+        elif self.path.startswith('/nolength/'):
+            # no content length, the body ends when the connection is closed
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = 1
+            self.wfile.write('image data of ' + self.path)
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ServerTestCase(DownloadTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ImageServer(('127.0.0.1', 0), ImageRequestHandler)
+        cls.server.flaky = collections.Counter()
+        cls.server.versions = collections.Counter()
+        cls.base_url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def read_output(self, name):
+        with open(os.path.join(self.output_dir, name)) as infile:
+            return infile.read()
+
+
+class TestAsyncEngine(ServerTestCase):
+    def setUp(self):
+        super(TestAsyncEngine, self).setUp()
+        self.conf['engine'] = 'asyncore'
+        self.conf['workers'] = 3
+        self.conf['host_connections'] = 2
+
+    def test_download_images_asyncore(self):
+        self.write_input([
+            self.base_url + '/img/a.jpg',
+            self.base_url + '/missing.jpg',
+            self.base_url + '/nolength/b.jpg',
+            self.base_url + '/redirect/c.jpg',
+            'ftp://127.0.0.1/img/d.jpg'
+        ])
+        prefix = '127_0_0_1_%d' % self.server.server_address[1]
+
+        with LogCapture() as logs:
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        self.assertEqual(
+            sorted([prefix + '_img_a.jpg', prefix + '_nolength_b.jpg', prefix + '_redirect_c.jpg', 'urls.txt']),
+            sorted(os.listdir(self.output_dir))
+        )
+        self.assertEqual('image data of /img/a.jpg', self.read_output(prefix + '_img_a.jpg'))
+        self.assertEqual('image data of /nolength/b.jpg', self.read_output(prefix + '_nolength_b.jpg'))
+        # redirected downloads keep the name of the original url
+        self.assertEqual('image data of /img/c.jpg', self.read_output(prefix + '_redirect_c.jpg'))
+
+        messages = [record.getMessage() for record in logs.records]
+        self.assertIn('S:404 ERROR downloading %s/missing.jpg\n' % self.base_url, messages)
+        self.assertIn('Skipping invalid url: ftp://127.0.0.1/img/d.jpg', messages)
+
+
+class TestResume(ServerTestCase):
+    def write_partial(self, name, data, etag='"1"'):
+        partpath = os.path.join(self.output_dir, name + '.part')
+        with open(partpath, 'w') as outfile:
+            outfile.write(data)
+        # as saved by the run which started the download
+        simpleandsolid.save_validator(partpath, {'etag': etag})
+
+    def check_resume(self):
+        prefix = '127_0_0_1_%d' % self.server.server_address[1]
+        self.write_input([self.base_url + '/img/a.jpg', self.base_url + '/img/b.jpg'])
+        self.write_partial(prefix + '_img_a.jpg', 'image data')
+        # longer than the image, the server can't continue it
+        self.write_partial(prefix + '_img_b.jpg', 'image data of something else')
+
+        with LogCapture() as logs:
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        self.assertEqual('image data of /img/a.jpg', self.read_output(prefix + '_img_a.jpg'))
+        # the validators are gone with the partial downloads
+        self.assertEqual(sorted([prefix + '_img_a.jpg', 'urls.txt']), sorted(os.listdir(self.output_dir)))
+        messages = [record.getMessage() for record in logs.records]
+        self.assertIn('S:206 resuming file %s at byte 10 ... ' % os.path.join(self.output_dir, prefix + '_img_a.jpg'),
+                      messages)
+        self.assertIn('S:416 ERROR downloading %s/img/b.jpg\n' % self.base_url, messages)
+
+    def test_download_images_resume(self):
+        self.check_resume()
+
+    def test_download_images_resume_asyncore(self):
+        self.conf['engine'] = 'asyncore'
+        self.check_resume()
+
+    def test_download_images_resume_changed(self):
+        self.write_input([self.base_url + '/changing/a.jpg'])
+        self.conf['retries'] = 0
+        name = '127_0_0_1_%d_changing_a.jpg' % self.server.server_address[1]
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            self.server.versions.clear()
+            # the connection is closed after the first 10 bytes of the first version
+            simpleandsolid.download_images(self.conf, self.logger)
+            self.assertEqual('version 1 ', self.read_output(name + '.part'))
+
+            # the image changed in the meantime, the server sends all of the new one instead of the rest
+            with LogCapture() as logs:
+                simpleandsolid.download_images(self.conf, self.logger)
+
+            self.assertEqual('version 2 of the image data of /changing/a.jpg', self.read_output(name))
+            self.assertEqual(sorted([name, 'urls.txt']), sorted(os.listdir(self.output_dir)))
+            self.assertIn('S:200 writing file %s ... ' % os.path.join(self.output_dir, name),
+                          [record.getMessage() for record in logs.records])
+            os.unlink(os.path.join(self.output_dir, name))
+
+    def test_download_images_resume_without_validator(self):
+        self.write_input([self.base_url + '/img/a.jpg'])
+        name = '127_0_0_1_%d_img_a.jpg' % self.server.server_address[1]
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            with open(os.path.join(self.output_dir, name + '.part'), 'w') as outfile:
+                outfile.write('something else')
+
+            # it isn't known which content the partial download is of, so it starts over
+            simpleandsolid.download_images(self.conf, self.logger)
+
+            self.assertEqual('image data of /img/a.jpg', self.read_output(name))
+            os.unlink(os.path.join(self.output_dir, name))
+
+    def test_range_headers(self):
+        self.assertEqual({}, simpleandsolid.range_headers(0, '"1"'))
+        self.assertEqual({}, simpleandsolid.range_headers(10))
+        self.assertEqual({'Range': 'bytes=10-', 'If-Range': '"1"', 'Accept-Encoding': 'identity'},
+                         simpleandsolid.range_headers(10, '"1"'))
+
+    def test_save_validator(self):
+        partpath = os.path.join(self.output_dir, 'a.jpg.part')
+        date = 'Wed, 21 Oct 2015 07:28:00 GMT'
+
+        simpleandsolid.save_validator(partpath, {'etag': '"1"', 'last-modified': date})
+        self.assertEqual('"1"', simpleandsolid.load_validator(partpath))
+        # a weak ETag can't be used for ranges
+        simpleandsolid.save_validator(partpath, {'etag': 'W/"1"', 'last-modified': date})
+        self.assertEqual(date, simpleandsolid.load_validator(partpath))
+        simpleandsolid.save_validator(partpath, {})
+        self.assertIsNone(simpleandsolid.load_validator(partpath))
+
+    def test_download_images_resume_hash(self):
+        self.conf['state_file'] = os.path.join(self.output_dir, 'state.sqlite')
+        self.write_input([self.base_url + '/img/a.jpg'])
+        name = '127_0_0_1_%d_img_a.jpg' % self.server.server_address[1]
+        self.write_partial(name, 'image')
+
+        simpleandsolid.download_images(self.conf, self.logger)
+
+        state = simpleandsolid.StateStore(self.conf['state_file'], 10)
+        download = state.get_download(self.base_url + '/img/a.jpg')
+        state.close()
+        # size and hash cover the whole file, not just the resumed part
+        self.assertEqual(len('image data of /img/a.jpg'), download['size'])
+        self.assertEqual(hashlib.sha256('image data of /img/a.jpg').hexdigest(), download['sha256'])
+
+    def test_download_images_fsync(self):
+        self.conf['fsync'] = 'full'
+        self.write_input([self.base_url + '/img/a.jpg'])
+        name = '127_0_0_1_%d_img_a.jpg' % self.server.server_address[1]
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            simpleandsolid.download_images(self.conf, self.logger)
+
+            self.assertEqual('image data of /img/a.jpg', self.read_output(name))
+            self.assertEqual(sorted([name, 'urls.txt']), sorted(os.listdir(self.output_dir)))
+            os.unlink(os.path.join(self.output_dir, name))
+
+    def test_resumed_at(self):
+        self.assertEqual(0, simpleandsolid.resumed_at(200, {}, 10))
+        self.assertEqual(10, simpleandsolid.resumed_at(206, {'content-range': 'bytes 10-19/20'}, 10))
+        self.assertIsNone(simpleandsolid.resumed_at(206, {'content-range': 'bytes 0-19/20'}, 10))
+        self.assertIsNone(simpleandsolid.resumed_at(206, {}, 10))
+        self.assertIsNone(simpleandsolid.resumed_at(404, {}, 10))
+
+
+class TestSession(ServerTestCase):
+    def test_create_session_pool_size(self):
+        session = simpleandsolid.create_session({'pool_size': 3, 'keep_alive': True}, simpleandsolid.RunStats())
+        adapter = session.get_adapter('https://images.pexels.com/')
+
+        self.assertEqual(3, adapter._pool_connections)
+        self.assertEqual(3, adapter._pool_maxsize)
+        self.assertEqual('keep-alive', session.headers['Connection'])
+
+    def test_create_session_no_keep_alive(self):
+        session = simpleandsolid.create_session({'pool_size': 3, 'keep_alive': False}, simpleandsolid.RunStats())
+
+        self.assertEqual('close', session.headers['Connection'])
+
+    def test_download_images_latency(self):
+        self.write_input([self.base_url + '/img/a.jpg', self.base_url + '/redirect/b.jpg'])
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            run = simpleandsolid.create_run(self.conf)
+            simpleandsolid.download_images(self.conf, self.logger, run=run)
+
+            # a redirect doesn't count as a url of its own
+            self.assertEqual(2, sum(run['stats'].histograms['latency'].values()))
+            simpleandsolid.finish_run(run, self.logger)
+
+    def test_download_images_throttled(self):
+        self.write_input([self.base_url + '/throttle/a.jpg', self.base_url + '/img/b.jpg'])
+        self.conf['host_connections'] = 1
+        self.conf['retries'] = 0
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            run = simpleandsolid.create_run(self.conf)
+            started = time.time()
+            with LogCapture() as logs:
+                simpleandsolid.download_images(self.conf, self.logger, run=run)
+
+            # the next request to the host waits for the Retry-After
+            self.assertTrue(time.time() - started >= 0.9)
+            self.assertEqual(1, run['stats'].get('throttled'))
+            self.assertEqual(1, run['stats'].get('downloaded'))
+            self.assertIn('S:429 127.0.0.1:%d asks to slow down, pausing it for 1s' % self.server.server_address[1],
+                          [record.getMessage() for record in logs.records])
+            simpleandsolid.finish_run(run, self.logger)
+
+    def test_download_images_retries(self):
+        # nothing listens on a port which was just free
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        refused_url = 'http://127.0.0.1:%d/img/c.jpg' % closed.getsockname()[1]
+        closed.close()
+        self.conf.update({'retries': 1, 'retry_delay': 0.01,
+                          'rejected_file': os.path.join(self.output_dir, 'rejected.tsv')})
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            self.write_input([self.base_url + '/flaky/%s.jpg' % engine, self.base_url + '/missing.jpg', refused_url])
+            run = simpleandsolid.create_run(self.conf)
+            simpleandsolid.download_images(self.conf, self.logger, run=run)
+            simpleandsolid.finish_run(run, self.logger)
+
+            self.assertEqual('fine', self.read_output('127_0_0_1_%d_flaky_%s.jpg' % (
+                self.server.server_address[1], engine
+            )))
+            self.assertEqual(1, run['stats'].get('downloaded'))
+            # the flaky url once, the refused one once before giving up
+            self.assertEqual(2, run['stats'].get('retried'))
+            self.assertEqual(2, run['stats'].get('failed'))
+            with open(self.conf['rejected_file']) as infile:
+                rejected = dict((line.split('\t')[0], line.split('\t')[1:]) for line in infile.read().splitlines())
+            self.assertEqual(['404', '1', 'HTTP 404'], rejected[self.base_url + '/missing.jpg'])
+            self.assertEqual(['0', '2'], rejected[refused_url][:2])
+            os.remove(self.conf['rejected_file'])
+
+    def test_download_images_unreachable_host(self):
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        self.conf.update({'retries': 5, 'retry_delay': 0.01})
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            self.write_input(['http://127.0.0.1:%d/img/%d.jpg' % (port, number) for number in range(4)] +
+                             [self.base_url + '/img/a.jpg'])
+            run = simpleandsolid.create_run(self.conf)
+            with LogCapture() as logs:
+                simpleandsolid.download_images(self.conf, self.logger, run=run)
+            simpleandsolid.finish_run(run, self.logger)
+
+            # retried until the host failed to connect three times in a row, then given up on
+            self.assertEqual(2, run['stats'].get('retried'))
+            self.assertEqual(4, run['stats'].get('failed'))
+            self.assertEqual(1, run['stats'].get('downloaded'))
+            self.assertIn('127.0.0.1:%d failed to connect 3 times in a row, not retrying its urls anymore' % port,
+                          [record.getMessage() for record in logs.records])
+            os.unlink(os.path.join(self.output_dir, '127_0_0_1_%d_img_a.jpg' % self.server.server_address[1]))
+
+    def test_download_images_unwanted_content(self):
+        self.conf.update({'mime_types': ['image/png', 'image/gif'], 'max_size': 1000,
+                          'rejected_file': os.path.join(self.output_dir, 'rejected.tsv')})
+        prefix = '127_0_0_1_%d' % self.server.server_address[1]
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            self.write_input([self.base_url + '/png/%s.png' % engine, self.base_url + '/img/b.jpg',
+                              self.base_url + '/nolength/c.jpg', self.base_url + '/bigpng/d.png'])
+            run = simpleandsolid.create_run(self.conf)
+            simpleandsolid.download_images(self.conf, self.logger, run=run)
+            simpleandsolid.finish_run(run, self.logger)
+
+            self.assertEqual(sorted(['%s_png_%s.png' % (prefix, engine), 'rejected.tsv', 'urls.txt']),
+                             sorted(os.listdir(self.output_dir)))
+            self.assertEqual(1, run['stats'].get('downloaded'))
+            self.assertEqual(3, run['stats'].get('unwanted'))
+            # not worth a retry
+            self.assertEqual(0, run['stats'].get('retried'))
+            with open(self.conf['rejected_file']) as infile:
+                rejected = dict((line.split('\t')[0], line.split('\t')[1:]) for line in infile.read().splitlines())
+            self.assertEqual(['200', '1', 'unwanted type text/plain'], rejected[self.base_url + '/img/b.jpg'])
+            self.assertEqual(['200', '1', 'unwanted type text/plain'], rejected[self.base_url + '/nolength/c.jpg'])
+            self.assertEqual(['200', '1', 'larger than 1000 bytes'], rejected[self.base_url + '/bigpng/d.png'])
+            os.remove(self.conf['rejected_file'])
+            os.remove(os.path.join(self.output_dir, '%s_png_%s.png' % (prefix, engine)))
+
+    def test_rejected_file_forget_deferred(self):
+        rejected = simpleandsolid.RejectedFile(os.path.join(self.output_dir, 'rejected.tsv'))
+        rejected.add('http://example.com/a.jpg', 0, 0, 'deferred')
+        rejected.add('http://example.com/b.jpg', 404, 1, 'HTTP 404')
+        rejected.add('http://example.com/a.jpg', 0, 0, 'deferred')
+        urls, size = rejected.deferred()
+        self.assertEqual(['http://example.com/a.jpg'], urls)
+
+        # deferred again by the run catching up on it
+        rejected.add('http://example.com/a.jpg', 0, 0, 'deferred')
+        rejected.forget_deferred(size)
+        rejected.add('http://example.com/c.jpg', 503, 4, 'HTTP 503')
+        rejected.close()
+
+        with open(rejected.path) as infile:
+            self.assertEqual(['http://example.com/b.jpg\t404\t1\tHTTP 404', 'http://example.com/a.jpg\t0\t0\tdeferred',
+                              'http://example.com/c.jpg\t503\t4\tHTTP 503'], infile.read().splitlines())
+
+    def test_download_images_skip_rejected(self):
+        self.conf.update({'rejected_file': os.path.join(self.output_dir, 'rejected.tsv'), 'skip_rejected': True})
+        with open(self.conf['rejected_file'], 'w') as outfile:
+            outfile.write(self.base_url + '/img/a.jpg\t404\t1\tHTTP 404\n')
+        self.write_input([self.base_url + '/img/a.jpg', self.base_url + '/img/b.jpg'])
+
+        run = simpleandsolid.create_run(self.conf)
+        simpleandsolid.download_images(self.conf, self.logger, run=run)
+        simpleandsolid.finish_run(run, self.logger)
+
+        self.assertEqual(1, run['stats'].get('skipped_rejected'))
+        self.assertEqual(1, run['stats'].get('downloaded'))
+
+    def test_download_images_processes(self):
+        port = self.server.server_address[1]
+        self.write_input([
+            self.base_url + '/img/a.jpg',
+            'http://localhost:%d/img/b.jpg' % port,
+            'http://localhost:%d/missing.jpg' % port
+        ])
+        self.conf['processes'] = 2
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            run = simpleandsolid.create_run(self.conf)
+            simpleandsolid.download_images(self.conf, self.logger, run=run)
+            simpleandsolid.finish_run(run, self.logger)
+
+            self.assertEqual('image data of /img/a.jpg', self.read_output('127_0_0_1_%d_img_a.jpg' % port))
+            self.assertEqual('image data of /img/b.jpg', self.read_output('localhost_%d_img_b.jpg' % port))
+            # the statistics of both shards are merged
+            self.assertEqual(2, run['stats'].get('downloaded'))
+            self.assertEqual(1, run['stats'].get('failed'))
+            self.assertEqual({200: 2, 404: 1}, run['stats'].statuses)
+            self.assertEqual(3, sum(run['stats'].histograms['latency'].values()))
+
+    def test_download_sharded_position(self):
+        def fake_shard(config, logger, index, results):  # pylint: disable=unused-argument
+            # the shards stop at different offsets, the last one doesn't finish
+            position = {'path': self.input_file, 'device': 1, 'inode': 2, 'offset': 100 - index}
+            results.put((simpleandsolid.RunStats().snapshot(), position if index < finished else None))
+
+        download_shard = simpleandsolid.download_shard
+        simpleandsolid.download_shard = fake_shard
+        try:
+            self.conf['processes'] = 3
+            finished = 3
+            run = simpleandsolid.create_run(self.conf)
+            self.assertEqual(98, simpleandsolid.download_sharded(self.conf, self.logger, run)['offset'])
+            finished = 2
+            self.assertIsNone(simpleandsolid.download_sharded(self.conf, self.logger, run))
+            simpleandsolid.close_run(run)
+        finally:
+            simpleandsolid.download_shard = download_shard
+
+    def test_download_images_processes_stopped(self):
+        port = self.server.server_address[1]
+        # the hosts keep asking to slow down, the shards would be busy retrying for a while
+        self.write_input([self.base_url + '/throttle/a.jpg', 'http://localhost:%d/throttle/b.jpg' % port])
+        self.conf.update({'processes': 2, 'retries': 10})
+
+        def terminate():
+            # after the first request of each shard, before their retries
+            time.sleep(0.8)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        thread = threading.Thread(target=terminate)
+        thread.start()
+        run = simpleandsolid.create_run(self.conf)
+        started = time.time()
+        with LogCapture() as logs:
+            simpleandsolid.download_images(self.conf, self.logger, run=run)
+        simpleandsolid.finish_run(run, self.logger)
+        thread.join()
+
+        # the stop was passed on to the shards, which still sent their statistics
+        self.assertTrue(time.time() - started < 5)
+        self.assertIn('Received signal %d, stopping' % signal.SIGTERM, [record.getMessage() for record in logs.records])
+        self.assertEqual(2, run['stats'].get('throttled'))
+        self.assertEqual(signal.SIG_DFL, signal.getsignal(signal.SIGTERM))
+
+    def test_download_images_paused_past_deadline(self):
+        self.write_input([self.base_url + '/throttlelong/a.jpg', self.base_url + '/img/b.jpg',
+                          self.base_url + '/img/c.jpg'])
+        self.conf.update({'host_connections': 1, 'deadline': 60})
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf.update({'engine': engine, 'rejected_file': os.path.join(self.output_dir, engine + '.rejected')})
+            run = simpleandsolid.create_run(self.conf)
+            started = time.time()
+            with LogCapture() as logs:
+                simpleandsolid.download_images(self.conf, self.logger, run=run)
+            simpleandsolid.finish_run(run, self.logger)
+
+            # the Retry-After is capped, still the host won't be asked again in time; nobody waits for it
+            self.assertTrue(time.time() - started < 10)
+            self.assertIn('S:429 127.0.0.1:%d asks to slow down, pausing it for %ds' % (
+                self.server.server_address[1], simpleandsolid.MAX_BACKOFF
+            ), [record.getMessage() for record in logs.records])
+            self.assertEqual(3, run['stats'].get('deferred'))
+            self.assertEqual(0, run['stats'].get('failed'))
+            with open(self.conf['rejected_file']) as infile:
+                self.assertEqual(['deferred'] * 3, [line.rstrip('\n').split('\t')[-1] for line in infile])
+
+    def test_download_images_no_retries_after_deadline(self):
+        self.write_input([self.base_url + '/flaky/deadline.jpg'])
+        self.conf.update({'deadline': 60, 'retry_delay': 120})
+        self.conf['rejected_file'] = os.path.join(self.output_dir, 'rejected')
+
+        run = simpleandsolid.create_run(self.conf)
+        simpleandsolid.download_images(self.conf, self.logger, run=run)
+        simpleandsolid.finish_run(run, self.logger)
+
+        self.assertEqual(0, run['stats'].get('retried'))
+        self.assertEqual(0, run['stats'].get('failed'))
+        self.assertEqual(1, run['stats'].get('deferred'))
+        # not given up on, --skip_rejected lets the next run try again
+        with open(self.conf['rejected_file']) as infile:
+            self.assertEqual('%s/flaky/deadline.jpg\t0\t1\tdeferred\n' % self.base_url, infile.read())
+
+    def test_download_images_not_started_by_deadline(self):
+        self.write_input([self.base_url + '/img/%d.jpg' % number for number in range(3)])
+        self.conf.update({'host_rate': 1, 'deadline': 1.5})
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf.update({'engine': engine, 'rejected_file': os.path.join(self.output_dir, engine + '.rejected')})
+            run = simpleandsolid.create_run(self.conf)
+            simpleandsolid.download_images(self.conf, self.logger, run=run)
+            simpleandsolid.finish_run(run, self.logger)
+
+            # the third url read ahead would only be requested after the deadline
+            self.assertEqual(2, run['stats'].get('downloaded'))
+            self.assertEqual(1, run['stats'].get('deferred'))
+            with open(self.conf['rejected_file']) as infile:
+                self.assertEqual('%s/img/2.jpg\t0\t0\tdeferred\n' % self.base_url, infile.read())
+            for number in range(2):
+                os.unlink(os.path.join(self.output_dir, '127_0_0_1_%d_img_%d.jpg' % (
+                    self.server.server_address[1], number
+                )))
+
+    def test_lock_run(self):
+        self.conf['lock_file'] = os.path.join(self.output_dir, 'simpleandsolid.lock')
+        exits = []
+
+        lockfile = simpleandsolid.lock_run(self.conf, self.logger, exits.append)
+        self.assertIsNone(simpleandsolid.lock_run(self.conf, self.logger, exits.append))
+        self.assertEqual([75], exits)
+        lockfile.close()
+
+        # free again once the holder is gone
+        simpleandsolid.lock_run(self.conf, self.logger, exits.append).close()
+        self.assertEqual([75], exits)
+        with open(self.conf['lock_file']) as infile:
+            self.assertEqual('%d\n' % os.getpid(), infile.read())
+
+    def test_download_images_metrics_file(self):
+        self.write_input([self.base_url + '/img/a.jpg', self.base_url + '/missing.jpg'])
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        self.conf['metrics_file'] = os.path.join(metrics_dir, 'simpleandsolid.prom')
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            simpleandsolid.download_images(self.conf, self.logger)
+
+            # written atomically, no temporary file is left behind
+            self.assertEqual(['simpleandsolid.prom'], os.listdir(metrics_dir))
+            with open(self.conf['metrics_file']) as infile:
+                metrics = infile.read().splitlines()
+            self.assertIn('simpleandsolid_responses_total{status="200"} 1', metrics)
+            self.assertIn('simpleandsolid_responses_total{status="404"} 1', metrics)
+            self.assertIn('simpleandsolid_bytes_downloaded_total 24', metrics)
+            for phase in ['dns', 'connect', 'first_byte', 'transfer', 'write', 'latency']:
+                self.assertTrue([line for line in metrics
+                                 if line.startswith('simpleandsolid_phase_seconds_count{phase="%s"}' % phase)])
+            self.assertIn('simpleandsolid_phase_seconds_bucket{phase="latency",le="60"} 2', metrics)
+            self.assertIn('simpleandsolid_phase_seconds_count{phase="transfer"} 1', metrics)
+
+    def test_download_images_reuses_connections(self):
+        self.write_input([
+            self.base_url + '/img/a.jpg',
+            self.base_url + '/missing.jpg',
+            self.base_url + '/img/b.jpg'
+        ])
+
+        with LogCapture() as logs:
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        # the server closes the connection after the 404 response, so the last download needs a new connection
+        logs.check_present(
+            ('simpleandsolid.test', 'INFO',
+             'Run summary: bytes_downloaded=48, connections_opened=2, connections_reused=1, downloaded=2, failed=1, '
+             'requests=3')
+        )
+
+
+@all_requests
+def cached_image_response(url, request):
+    """
+    Answer with 304 if the client sends the current ETag.
+    """
+    if request.headers.get('If-None-Match') == '"v1"':
+        return response(304, '', request=request)
+    return response(200, 'image data of ' + url.path, {'ETag': '"v1"'}, request=request)
+
+
+class OutputRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Serve the files of the server's output directory like the web server of a node in the fleet.
+    """
+
+    def translate_path(self, path):
+        return os.path.join(self.server.directory, os.path.basename(urllib.unquote(path.split('?', 1)[0])))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFleet(ServerTestCase):
+    def setUp(self):
+        super(TestFleet, self).setUp()
+        self.peers = []
+        self.nodes = []
+        for output_dir in [self.output_dir, tempfile.mkdtemp()]:
+            peer = ImageServer(('127.0.0.1', 0), OutputRequestHandler)
+            peer.directory = output_dir
+            thread = threading.Thread(target=peer.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.peers.append(peer)
+            self.nodes.append('http://127.0.0.1:%d/' % peer.server_address[1])
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.shutdown()
+            peer.server_close()
+        shutil.rmtree(self.peers[1].directory)
+        super(TestFleet, self).tearDown()
+
+    def run_node(self, index, urls):
+        conf = dict(self.conf, output_dir=self.peers[index].directory, peers=self.nodes, node=self.nodes[index],
+                    retries=1, retry_delay=0.01)
+        run = simpleandsolid.create_run(conf)
+        simpleandsolid.download_images(conf, self.logger, run=run)
+        simpleandsolid.finish_run(run, self.logger)
+        return run['stats']
+
+    def test_download_images_fleet(self):
+        urls = [self.base_url + '/img/%d.jpg' % number for number in range(10)]
+        self.write_input(urls)
+        ring = simpleandsolid.HashRing(self.nodes)
+        second = [url for url in urls if ring.owner(url) == self.nodes[1]]
+
+        for engine in simpleandsolid.ENGINES:
+            self.conf['engine'] = engine
+            for peer in self.peers:
+                for name in os.listdir(peer.directory):
+                    if name != 'urls.txt':
+                        os.remove(os.path.join(peer.directory, name))
+
+            # the first node to run finds nothing at its peer and falls back to the origin
+            stats = self.run_node(1, urls)
+            self.assertEqual(10, stats.get('downloaded'))
+            self.assertEqual(0, stats.get('from_peers'))
+            self.assertEqual(10 - len(second), stats.get('retried'))
+
+            # the second one gets the share of the first one from it
+            stats = self.run_node(0, urls)
+            self.assertEqual(10, stats.get('downloaded'))
+            self.assertEqual(len(second), stats.get('from_peers'))
+            self.assertEqual(0, stats.get('retried'))
+            for number in range(10):
+                self.assertEqual('image data of /img/%d.jpg' % number, self.read_output(
+                    '127_0_0_1_%d_img_%d.jpg' % (self.server.server_address[1], number)
+                ))
+
+
+class TestStateStore(DownloadTestCase):
+    def setUp(self):
+        super(TestStateStore, self).setUp()
+        self.conf['state_file'] = os.path.join(self.output_dir, 'state.sqlite')
+
+    def test_validators_round_trip(self):
+        state = simpleandsolid.StateStore(self.conf['state_file'], 10)
+        state.set_validators('http://example.com/a.jpg', '"abc"', 'Sat, 07 Apr 2018 10:00:00 GMT')
+        state.set_validators('http://example.com/b.jpg', None, None)
+        state.close()
+
+        state = simpleandsolid.StateStore(self.conf['state_file'], 10)
+        self.assertEqual(
+            ('"abc"', 'Sat, 07 Apr 2018 10:00:00 GMT'),
+            state.get_validators('http://example.com/a.jpg')
+        )
+        self.assertEqual((None, None), state.get_validators('http://example.com/b.jpg'))
+        state.close()
+
+    def test_commit_every_change_for_other_processes(self):
+        first = simpleandsolid.StateStore(self.conf['state_file'], 10, commit_interval=1)
+        second = simpleandsolid.StateStore(self.conf['state_file'], 10, commit_interval=1)
+        second.connection.execute('PRAGMA busy_timeout = 0')
+
+        first.record_download('http://example.com/a.jpg', 'a.jpg', 200, 1, 'a')
+        # the first one holds no write lock anymore
+        second.record_download('http://example.com/b.jpg', 'b.jpg', 200, 1, 'b')
+
+        self.assertEqual(200, first.get_download('http://example.com/b.jpg')['status'])
+        first.close()
+        second.close()
+
+    def test_evict_least_recently_used(self):
+        state = simpleandsolid.StateStore(self.conf['state_file'], 2)
+        for name in ['a', 'b', 'c']:
+            state.set_validators('http://example.com/%s.jpg' % name, name, None)
+        state.touch('http://example.com/a.jpg')
+
+        self.assertEqual(1, state.evict())
+        self.assertEqual((None, None), state.get_validators('http://example.com/b.jpg'))
+        self.assertEqual(('a', None), state.get_validators('http://example.com/a.jpg'))
+        state.close()
+
+    def download_incremental(self):
+        self.conf['incremental'] = True
+        run = simpleandsolid.create_run(self.conf)
+        with HTTMock(image_response):
+            simpleandsolid.download_images(self.conf, self.logger, run=run)
+        simpleandsolid.finish_run(run, self.logger)
+        return run['stats']
+
+    def test_download_images_incremental(self):
+        with open(self.input_file, 'w') as outfile:
+            outfile.write('http://example.com/img/a.jpg\nhttp://example.com/img/b.jpg\n')
+        self.assertEqual(2, self.download_incremental().get('downloaded'))
+
+        # only the appended line is read; the last line is still being written
+        with open(self.input_file, 'a') as outfile:
+            outfile.write('http://example.com/img/c.jpg\nhttp://example.com/img/d')
+        stats = self.download_incremental()
+        self.assertEqual(1, stats.get('downloaded'))
+        self.assertEqual(0, stats.get('skipped'))
+
+        with open(self.input_file, 'a') as outfile:
+            outfile.write('.jpg\n')
+        stats = self.download_incremental()
+        self.assertEqual(1, stats.get('downloaded'))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'example_com_img_d.jpg')))
+
+        # nothing new
+        self.assertEqual({'connections_reused': 0}, self.download_incremental().counters)
+
+    def test_download_images_deadline(self):
+        self.write_input(['http://example.com/img/a.jpg', 'http://example.com/img/b.jpg'])
+        self.conf['deadline'] = 0.000001
+
+        # past the deadline before the first url; the checkpoint stays at the start
+        self.assertEqual(0, self.download_incremental().get('downloaded'))
+        del self.conf['deadline']
+        self.assertEqual(2, self.download_incremental().get('downloaded'))
+
+    def test_download_images_incremental_deferred(self):
+        self.write_input(['http://example.com/img/a.jpg', 'http://example.com/img/b.jpg'])
+        self.conf.update({'rejected_file': os.path.join(self.output_dir, 'rejected.tsv'), 'host_rate': 1,
+                          'deadline': 0.5})
+
+        # b.jpg is read before the deadline but the rate limit would only allow it after
+        stats = self.download_incremental()
+        self.assertEqual(1, stats.get('downloaded'))
+        self.assertEqual(1, stats.get('deferred'))
+
+        # the checkpoint is past it, still the next run catches up on it
+        del self.conf['deadline']
+        self.assertEqual(1, self.download_incremental().get('downloaded'))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'example_com_img_b.jpg')))
+        self.assertEqual(0, os.path.getsize(self.conf['rejected_file']))
+        self.assertEqual({'connections_reused': 0}, self.download_incremental().counters)
+
+    def test_download_images_incremental_truncated(self):
+        self.write_input(['http://example.com/img/a.jpg', 'http://example.com/img/b.jpg'])
+        self.download_incremental()
+
+        self.write_input(['http://example.com/img/c.jpg'])
+        self.assertEqual(1, self.download_incremental().get('downloaded'))
+
+    def test_download_images_incremental_rotated(self):
+        self.write_input(['http://example.com/img/a.jpg'])
+        self.download_incremental()
+
+        # lines appended before the rotation are read from the rotated file
+        with open(self.input_file, 'a') as outfile:
+            outfile.write('http://example.com/img/b.jpg\n')
+        os.rename(self.input_file, self.input_file + '.1')
+        self.write_input(['http://example.com/img/c.jpg'])
+        stats = self.download_incremental()
+
+        self.assertEqual(2, stats.get('downloaded'))
+        self.assertEqual(0, stats.get('skipped'))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'example_com_img_b.jpg')))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'example_com_img_c.jpg')))
+
+    def test_download_images_quota(self):
+        self.conf['quota_files'] = 2
+        self.write_input(['http://example.com/img/a.jpg', 'http://example.com/img/b.jpg'])
+        with HTTMock(image_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+        # the web server read a.jpg since
+        os.utime(os.path.join(self.output_dir, 'example_com_img_a.jpg'), (time.time() + 10, time.time()))
+
+        self.write_input(['http://example.com/img/c.jpg'])
+        with HTTMock(image_response):
+            with LogCapture() as logs:
+                simpleandsolid.download_images(self.conf, self.logger)
+
+        self.assertEqual(sorted(['example_com_img_a.jpg', 'example_com_img_c.jpg', 'state.sqlite', 'urls.txt']),
+                         sorted(os.listdir(self.output_dir)))
+        logs.check_present(
+            ('simpleandsolid.test', 'INFO', 'Evicted 1 least recently used files to stay within the quota')
+        )
+        state = simpleandsolid.StateStore(self.conf['state_file'], 10)
+        self.assertEqual((2, 48), state.usage())
+        state.close()
+
+    def test_generate_filename_hashed(self):
+        path = simpleandsolid.generate_filename('http://example.com/img/a.jpg', 'output', 'hashed')
+        digest = hashlib.sha1('http://example.com/img/a.jpg').hexdigest()
+
+        self.assertEqual('output/%s/%s/example_com_img_a.%s.jpg' % (digest[:2], digest[2:4], digest[:8]), path)
+        # the same flat name for both, but different files
+        self.assertNotEqual(
+            simpleandsolid.generate_filename('http://a.b/c.jpg', '', 'hashed'),
+            simpleandsolid.generate_filename('http://a/b/c.jpg', '', 'hashed')
+        )
+
+    def test_download_images_hashed_layout(self):
+        self.write_input(['http://example.com/img/a.jpg'])
+        self.conf['layout'] = 'hashed'
+        path = simpleandsolid.generate_filename('http://example.com/img/a.jpg', self.output_dir, 'hashed')
+
+        with HTTMock(image_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+            with LogCapture() as logs:
+                simpleandsolid.download_images(self.conf, self.logger)
+
+        with open(path) as infile:
+            self.assertEqual('image data of /img/a.jpg', infile.read())
+        logs.check_present(
+            ('simpleandsolid.test', 'INFO', 'Skipping http://example.com/img/a.jpg, already downloaded to %s' % path)
+        )
+
+    def test_migrate_layout(self):
+        self.write_input(['http://example.com/img/a.jpg', 'http://example.com/img/b.jpg'])
+        self.conf['storage'] = 'symlink'
+        with HTTMock(image_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+        # not known to the state file
+        with open(os.path.join(self.output_dir, 'unknown.jpg'), 'w') as outfile:
+            outfile.write('unknown')
+
+        self.conf['layout'] = 'hashed'
+        self.assertEqual(2, simpleandsolid.migrate_layout(self.conf, self.logger))
+        # moving again changes nothing
+        self.assertEqual(0, simpleandsolid.migrate_layout(self.conf, self.logger))
+
+        for name in ['a', 'b']:
+            path = simpleandsolid.generate_filename('http://example.com/img/%s.jpg' % name, self.output_dir, 'hashed')
+            with open(path) as infile:
+                self.assertEqual('image data of /img/%s.jpg' % name, infile.read())
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'unknown.jpg')))
+        self.assertFalse(os.path.lexists(os.path.join(self.output_dir, 'example_com_img_a.jpg')))
+
+        @all_requests
+        def no_requests(url, request):
+            self.fail('%s requested again' % url.geturl())
+
+        with HTTMock(no_requests):
+            simpleandsolid.download_images(self.conf, self.logger)
+
+    def test_migrate_layout_replaces_target(self):
+        self.write_input(['http://example.com/img/a.jpg'])
+        self.conf['storage'] = 'symlink'
+        with HTTMock(image_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+        # e.g. left by an interrupted migration
+        path = simpleandsolid.generate_filename('http://example.com/img/a.jpg', self.output_dir, 'hashed')
+        simpleandsolid.make_directory(os.path.dirname(path))
+        with open(path, 'w') as outfile:
+            outfile.write('stale')
+
+        self.conf['layout'] = 'hashed'
+        self.assertEqual(1, simpleandsolid.migrate_layout(self.conf, self.logger))
+
+        with open(path) as infile:
+            self.assertEqual('image data of /img/a.jpg', infile.read())
+        self.assertEqual([os.path.basename(path)], os.listdir(os.path.dirname(path)))
+
+    def test_download_images_not_modified(self):
+        self.write_input(['http://example.com/img/a.jpg'])
+        self.conf['recheck_after'] = 0
+
+        with HTTMock(cached_image_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+            with LogCapture() as logs:
+                simpleandsolid.download_images(self.conf, self.logger)
+
+        logs.check_present(
+            ('simpleandsolid.test', 'INFO',
+             'S:304 not modified, keeping file %s/example_com_img_a.jpg ... ' % self.output_dir)
+        )
+        with open(os.path.join(self.output_dir, 'example_com_img_a.jpg')) as infile:
+            self.assertEqual('image data of /img/a.jpg', infile.read())
+
+    def test_download_images_skips_recent_downloads(self):
+        self.write_input(['http://example.com/img/a.jpg', 'http://example.com/img/missing.jpg'])
+
+        with HTTMock(image_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        state = simpleandsolid.StateStore(self.conf['state_file'], 10)
+        row = state.get_download('http://example.com/img/a.jpg')
+        self.assertEqual(os.path.join(self.output_dir, 'example_com_img_a.jpg'), row['path'])
+        self.assertEqual(200, row['status'])
+        self.assertEqual(24, row['size'])
+        self.assertEqual(hashlib.sha256('image data of /img/a.jpg').hexdigest(), row['sha256'])
+        self.assertEqual(404, state.get_download('http://example.com/img/missing.jpg')['status'])
+        state.close()
+
+        @all_requests
+        def only_missing(url, request):
+            # the completed download must not be requested again
+            self.assertEqual('/img/missing.jpg', url.path)
+            return response(404, 'not found', request=request)
+
+        with HTTMock(only_missing):
+            with LogCapture() as logs:
+                simpleandsolid.download_images(self.conf, self.logger)
+
+        logs.check_present(
+            ('simpleandsolid.test', 'INFO', 'Skipping http://example.com/img/a.jpg, already downloaded to '
+                                            '%s/example_com_img_a.jpg' % self.output_dir)
+        )
+
+    def test_list_failures(self):
+        state = simpleandsolid.StateStore(self.conf['state_file'], 10)
+        state.record_download('http://example.com/a.jpg', '/tmp/a.jpg', 200, 10, 'abc')
+        state.record_download('http://example.com/b.jpg', '/tmp/b.jpg', 404)
+        state.record_download('http://example.com/c.jpg', '/tmp/c.jpg', 0)
+        state.close()
+        stream = StringIO.StringIO()
+
+        simpleandsolid.list_failures(self.conf, stream)
+
+        self.assertEqual(
+            ['http://example.com/b.jpg\t404', 'http://example.com/c.jpg\t0'],
+            [line.rsplit('\t', 1)[0] for line in stream.getvalue().splitlines()]
+        )
+
+
+@all_requests
+def mirrored_image_response(url, request):
+    """
+    Serve the same content for all urls.
+    """
+    return response(200, 'the same image everywhere', request=request)
+
+
+class TestDeduplication(DownloadTestCase):
+    def setUp(self):
+        super(TestDeduplication, self).setUp()
+        self.write_input([
+            'http://example.com/img/a.jpg',
+            'http://mirror.example.com/img/a.jpg',
+            'http://example.com/img/b.jpg?size=large'
+        ])
+        self.blob = os.path.join(
+            self.output_dir, '.blobs', hashlib.sha256('the same image everywhere').hexdigest()[:2],
+            hashlib.sha256('the same image everywhere').hexdigest()
+        )
+
+    def test_download_images_hardlink(self):
+        self.conf['storage'] = 'hardlink'
+
+        with HTTMock(mirrored_image_response):
+            with LogCapture() as logs:
+                simpleandsolid.download_images(self.conf, self.logger)
+
+        names = ['example_com_img_a.jpg', 'mirror_example_com_img_a.jpg', 'example_com_img_b.jpg']
+        for name in names:
+            self.assertTrue(os.path.samefile(self.blob, os.path.join(self.output_dir, name)))
+        self.assertEqual(4, os.stat(self.blob).st_nlink)
+        self.assertEqual([hashlib.sha256('the same image everywhere').hexdigest()[:2]],
+                         os.listdir(os.path.join(self.output_dir, '.blobs')))
+        logs.check_present(
+            ('simpleandsolid.test', 'INFO', 'Run summary: bytes_deduplicated=50, bytes_downloaded=75, '
+                                            'connections_reused=0, deduplicated=2, downloaded=3')
+        )
+
+    def test_download_images_symlink(self):
+        self.conf['storage'] = 'symlink'
+
+        with HTTMock(mirrored_image_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        link = os.path.join(self.output_dir, 'mirror_example_com_img_a.jpg')
+        self.assertEqual(os.path.join('.blobs', os.path.relpath(self.blob, os.path.join(self.output_dir, '.blobs'))),
+                         os.readlink(link))
+        with open(link) as infile:
+            self.assertEqual('the same image everywhere', infile.read())
+
+    def test_evict_output_symlink(self):
+        self.conf.update({'storage': 'symlink', 'state_file': os.path.join(self.output_dir, 'state.sqlite')})
+        with HTTMock(mirrored_image_response):
+            simpleandsolid.download_images(self.conf, self.logger)
+
+        run = simpleandsolid.create_run(dict(self.conf, quota_files=1))
+        self.assertEqual(2, simpleandsolid.evict_output(dict(self.conf, quota_files=1), self.logger, run))
+        # still used by the last link
+        self.assertTrue(os.path.isfile(self.blob))
+
+        self.assertEqual(1, simpleandsolid.evict_output(dict(self.conf, quota_bytes=1), self.logger, run))
+        self.assertFalse(os.path.exists(self.blob))
+        simpleandsolid.finish_run(run, self.logger)
+
+
+class TestDaemon(ServerTestCase):
+    def setUp(self):
+        super(TestDaemon, self).setUp()
+        self.conf['inbox_dir'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.conf['inbox_dir'])
+        self.conf['poll_interval'] = 1
+
+    def drop(self, name, urls):
+        # write under a hidden name and rename, like a well behaved producer
+        temppath = os.path.join(self.conf['inbox_dir'], '.' + name)
+        with open(temppath, 'w') as outfile:
+            outfile.write('\n'.join(urls) + '\n')
+        os.rename(temppath, os.path.join(self.conf['inbox_dir'], name))
+
+    def wait_for(self, name):
+        done = os.path.join(self.conf['inbox_dir'], 'done', name)
+        deadline = time.time() + 10
+        while not os.path.exists(done) and time.time() < deadline:
+            time.sleep(0.05)
+
+    def test_run_daemon(self):
+        prefix = '127_0_0_1_%d' % self.server.server_address[1]
+        self.drop('first.txt', [self.base_url + '/img/a.jpg'])
+
+        def producer():
+            self.wait_for('first.txt')
+            self.drop('second.txt', [self.base_url + '/img/b.jpg'])
+            self.wait_for('second.txt')
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        thread = threading.Thread(target=producer)
+        thread.start()
+        with LogCapture() as logs:
+            simpleandsolid.run_daemon(self.conf, self.logger)
+        thread.join()
+
+        self.assertEqual('image data of /img/a.jpg', self.read_output(prefix + '_img_a.jpg'))
+        self.assertEqual('image data of /img/b.jpg', self.read_output(prefix + '_img_b.jpg'))
+        self.assertEqual(['done'], os.listdir(self.conf['inbox_dir']))
+        self.assertEqual(['first.txt', 'second.txt'], sorted(os.listdir(os.path.join(self.conf['inbox_dir'], 'done'))))
+        # both files used the same connection pool
+        logs.check_present(
+            ('simpleandsolid.test', 'INFO',
+             'Run summary: bytes_downloaded=48, connections_opened=1, connections_reused=1, downloaded=2, requests=2')
+        )
+        self.assertEqual(signal.default_int_handler, signal.getsignal(signal.SIGINT))
+
+    def test_process_inbox_file_deadline(self):
+        self.drop('urls.txt', [self.base_url + '/img/a.jpg'])
+        self.conf['deadline'] = 60
+        run = simpleandsolid.create_run(self.conf)
+        # the daemon was started more than a deadline ago
+        run['deadline'] = run['scheduler'].deadline = time.time() - 1
+
+        simpleandsolid.process_inbox_file('urls.txt', self.conf, self.logger, run)
+        simpleandsolid.close_run(run)
+
+        self.assertEqual(1, run['stats'].get('downloaded'))
+        self.assertEqual(['urls.txt'], os.listdir(os.path.join(self.conf['inbox_dir'], 'done')))
+
+    def test_inbox_watcher_poll(self):
+        watcher = simpleandsolid.InboxWatcher(self.conf['inbox_dir'], 0, self.logger)
+        watcher.close()
+        self.drop('urls.txt', ['http://example.com/a.jpg'])
+        with open(os.path.join(self.conf['inbox_dir'], '.partial.txt'), 'w') as outfile:
+            outfile.write('http://example.com/b.jpg\n')
+
+        # reported once it didn't change between two looks
+        self.assertEqual([], watcher.wait(0))
+        self.assertEqual(['urls.txt'], watcher.wait(0))
+        self.assertEqual([], watcher.wait(0))
+
+    def test_until_stopped(self):
+        stop = threading.Event()
+        urls = simpleandsolid.until_stopped(iter(['a', 'b', 'c']), stop)
+
+        self.assertEqual('a', next(urls))
+        stop.set()
+        self.assertEqual([], list(urls))